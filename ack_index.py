@@ -0,0 +1,101 @@
+## Index of readings luftdaten has accepted
+# One bitmap file per sensor, X-PIN and UTC day with a bit for every second
+# (86400 bits, 10800 bytes a day), set once the server acknowledges a reading
+# with that timestamp. Lookups and updates are a single pread/pwrite at a
+# computed offset, nothing is held in memory but a few open files, and years
+# of data stay in single digit megabytes per pin. The live collector and the
+# backfill tool share the same directory; a byte range lock makes updates
+# from both safe.
+#
+import fcntl
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DAY = 86400
+DAY_BYTES = DAY // 8
+
+
+class AckIndex(object):
+    """Remember which (sensor, pin, timestamp) submissions were accepted."""
+
+    def __init__(self, path, max_open=16):
+        self.path = path
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.recorded = 0
+
+    def _file(self, sensor, pin, day, create):
+        key = (sensor, pin, day)
+        fd = self.files.get(key)
+        if fd is not None:
+            self.files.move_to_end(key)
+            return fd
+        directory = os.path.join(self.path, sensor, pin)
+        name = os.path.join(directory, time.strftime("%Y%m%d", time.gmtime(day * DAY)))
+        if create:
+            os.makedirs(directory, exist_ok=True)
+            fd = os.open(name, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < DAY_BYTES:
+                os.ftruncate(fd, DAY_BYTES)
+        else:
+            try:
+                fd = os.open(name, os.O_RDWR)
+            except FileNotFoundError:
+                return None
+        self.files[key] = fd
+        if len(self.files) > self.max_open:
+            _, old = self.files.popitem(last=False)
+            os.close(old)
+        return fd
+
+    def contains(self, sensor, pin, timestamp, within=0):
+        """True if a submission for sensor and pin within seconds of timestamp was accepted."""
+        first = int(timestamp) - within
+        last = int(timestamp) + within
+        with self.lock:
+            while first <= last:
+                day = first // DAY
+                end = min(last, day * DAY + DAY - 1)
+                fd = self._file(sensor, str(pin), day, False)
+                if fd is not None:
+                    lo = first - day * DAY
+                    hi = end - day * DAY
+                    size = hi // 8 - lo // 8 + 1
+                    # a file the other tool has only just created may still be short
+                    data = os.pread(fd, size, lo // 8).ljust(size, b"\0")
+                    for second in range(lo, hi + 1):
+                        if data[second // 8 - lo // 8] & (1 << (second % 8)):
+                            self.skipped += 1
+                            return True
+                first = end + 1
+        return False
+
+    def add(self, sensor, pin, timestamp):
+        """Record that the server accepted sensor and pin's reading at timestamp."""
+        timestamp = int(timestamp)
+        day = timestamp // DAY
+        second = timestamp - day * DAY
+        offset = second // 8
+        with self.lock:
+            fd = self._file(sensor, str(pin), day, True)
+            # the other tool may be setting a bit in the same byte
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset, os.SEEK_SET)
+            try:
+                byte = os.pread(fd, 1, offset)[0]
+                os.pwrite(fd, bytes((byte | (1 << (second % 8)),)), offset)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset, os.SEEK_SET)
+            self.recorded += 1
+
+    def close(self):
+        with self.lock:
+            for fd in self.files.values():
+                os.close(fd)
+            self.files.clear()
+
+    def stats(self):
+        return {"skipped": self.skipped, "recorded": self.recorded, "open_files": len(self.files)}
@@ -0,0 +1,184 @@
+## Windowed aggregation of readings for the low-rate sinks
+# Keeps running min/max/mean/count and a P-square median estimate per field,
+# so a sink that only uploads once a minute can send a summary of every
+# reading in that minute using a fixed amount of memory per field.
+#
+MEAN = "mean"
+MEDIAN = "median"
+MAX = "max"
+MIN = "min"
+LAST = "last"
+
+REDUCERS = (MEAN, MEDIAN, MAX, MIN, LAST)
+
+PM_FIELDS = ("pm1", "pm2", "pm10", "pm1_atmos", "pm2_atmos", "pm10_atmos")
+
+
+class P2Median(object):
+    """Streaming median estimate (Jain & Chlamtac's P-square algorithm)."""
+
+    def __init__(self):
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 2, 3, 4, 5]
+        self.increments = [0, 0.25, 0.5, 0.75, 1]
+
+    def add(self, x):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                h = self._parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        q = self.heights
+        if len(q) == 5 and self.positions[4] > 5:
+            return q[2]
+        # exact for the first five samples
+        middle = len(q) // 2
+        if len(q) % 2:
+            return q[middle]
+        return (q[middle - 1] + q[middle]) / 2
+
+
+class FieldStats(object):
+    """Running statistics for one numeric field."""
+
+    __slots__ = ("count", "total", "min", "max", "last", "median")
+
+    def __init__(self, track_median=False):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.median = P2Median() if track_median else None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.median is not None:
+            self.median.add(value)
+
+    def mean(self):
+        return self.total / self.count
+
+    def reduce(self, how):
+        if how == MEAN:
+            return self.mean()
+        if how == MEDIAN:
+            return self.median.value()
+        if how == MAX:
+            return self.max
+        if how == MIN:
+            return self.min
+        return self.last
+
+
+class Window(object):
+    """Aggregate the points offered to a sink between two sends.
+
+    reducers maps field names to one of REDUCERS, every other numeric field
+    uses default. Non-numeric fields keep their last value.
+    """
+
+    def __init__(self, reducers=None, default=MEAN):
+        self.reducers = reducers or {}
+        self.default = default
+        self.reset()
+
+    def reset(self):
+        self.fields = {}
+        self.other = {}
+        self.count = 0
+        self.latest = None
+
+    def add(self, point):
+        self.count += 1
+        self.latest = point
+        for k, v in point["fields"].items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                self.other[k] = v
+                continue
+            stats = self.fields.get(k)
+            if stats is None:
+                stats = FieldStats(self.reducers.get(k, self.default) == MEDIAN)
+                self.fields[k] = stats
+            stats.add(v)
+
+    def result(self):
+        """A point like the ones added, with each field reduced over the window."""
+        fields = dict(self.other)
+        for k, stats in self.fields.items():
+            fields[k] = stats.reduce(self.reducers.get(k, self.default))
+        point = dict(self.latest)
+        point["fields"] = fields
+        return point
+
+    def summary(self, measurement):
+        """A point carrying <field>_min/_max/_mean for every numeric field."""
+        fields = {"count": self.count}
+        for k, stats in self.fields.items():
+            fields[k + "_min"] = float(stats.min)
+            fields[k + "_max"] = float(stats.max)
+            fields[k + "_mean"] = float(stats.mean())
+        point = dict(self.latest)
+        point["measurement"] = measurement
+        point["fields"] = fields
+        # a summary is not the frame it was received with
+        point.pop("received", None)
+        return point
+
+
+class SummaryWindow(Window):
+    """A window whose result is its summary, for downsampled measurements."""
+
+    def __init__(self, measurement):
+        Window.__init__(self)
+        self.measurement = measurement
+
+    def result(self):
+        return self.summary(self.measurement)
+
+
+def pm_reducers(how):
+    return dict((field, how) for field in PM_FIELDS)
@@ -0,0 +1,213 @@
+## Columnar archive of the Influx history
+# Exports the environmental measurement into one directory per UTC day
+# holding a time.npy (int64 epoch seconds) and a <field>.npy (float64, NaN
+# where a reading lacked the field) per field, streamed from Influx a page at
+# a time. Analyses then memory-map the days they need and work on whole
+# columns with NumPy instead of querying the Pi. An archive holds one board,
+# picked by its location tag.
+#
+# python3 archive.py export --location driveway --start 2022-06-01 --end 2022-07-01 --out archive
+# python3 archive.py daily --out archive --field pm2 --start 2022-06-01 --end 2022-07-01
+#
+import argparse
+import datetime
+import os
+import shutil
+import time
+
+import numpy as np
+from influxdb import InfluxDBClient
+
+from frame_parser import FIELDS
+from influx_history import pages, parse_time
+
+DAY = 86400
+
+
+def day_name(day):
+    return time.strftime("%Y-%m-%d", time.gmtime(day * DAY))
+
+
+def write_day(out, day, times, columns):
+    """Write one day's columns to out/YYYY-MM-DD, replacing it in one rename."""
+    final = os.path.join(out, day_name(day))
+    tmp = final + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "time.npy"), np.array(times, dtype=np.int64))
+    for field, values in columns.items():
+        np.save(os.path.join(tmp, field + ".npy"), np.array(values, dtype=np.float64))
+    if os.path.exists(final):
+        shutil.rmtree(final)
+    os.rename(tmp, final)
+
+
+def export(client, out, measurement, location, start, end, page_size=5000, force=False):
+    """Export location's whole UTC days from start to end (epoch seconds); returns the days written.
+
+    Finished days already in the archive are skipped unless force is set,
+    so an interrupted export can simply be run again.
+    """
+    written = 0
+    first = start // DAY
+    last = -(-end // DAY)
+    today = int(time.time()) // DAY
+    for day in range(first, last):
+        if not force and day < today and os.path.exists(os.path.join(out, day_name(day))):
+            continue
+        started = time.monotonic()
+        times = []
+        columns = dict((field, []) for field in FIELDS)
+        for page in pages(client, measurement, day * DAY * 1000000000 - 1, (day + 1) * DAY * 1000000000,
+                          page_size, location, FIELDS):
+            for point in page:
+                times.append(point["time"] // 1000000000)
+                for field, values in columns.items():
+                    value = point.get(field)
+                    values.append(np.nan if value is None else value)
+        if not times:
+            continue
+        # drop fields that were never sent that day
+        columns = dict((field, values) for field, values in columns.items()
+                       if any(v == v for v in values))
+        write_day(out, day, times, columns)
+        written += 1
+        print("{} {:>6} points {:>3} fields in {:.1f}s".format(
+            day_name(day), len(times), len(columns), time.monotonic() - started))
+    return written
+
+
+class Archive(object):
+    """Read access to an exported archive, one memory-mapped day at a time."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def days(self, start=None, end=None):
+        """The archived days (epoch day numbers) overlapping start..end epoch seconds."""
+        days = []
+        for name in sorted(os.listdir(self.path)):
+            try:
+                day = int(datetime.datetime.strptime(name, "%Y-%m-%d")
+                          .replace(tzinfo=datetime.timezone.utc).timestamp()) // DAY
+            except ValueError:
+                continue
+            if (start is None or (day + 1) * DAY > start) and (end is None or day * DAY < end):
+                days.append(day)
+        return days
+
+    def day(self, day, field):
+        """(times, values) arrays for one day, memory mapped; values are NaN if the field is missing."""
+        directory = os.path.join(self.path, day_name(day))
+        times = np.load(os.path.join(directory, "time.npy"), mmap_mode="r")
+        name = os.path.join(directory, field + ".npy")
+        if not os.path.exists(name):
+            return times, np.full(len(times), np.nan)
+        return times, np.load(name, mmap_mode="r")
+
+    def load(self, field, start=None, end=None):
+        """(times, values) for field between start and end epoch seconds."""
+        times = []
+        values = []
+        for day in self.days(start, end):
+            t, v = self.day(day, field)
+            lo = 0 if start is None else np.searchsorted(t, start)
+            hi = len(t) if end is None else np.searchsorted(t, end)
+            times.append(t[lo:hi])
+            values.append(v[lo:hi])
+        if not times:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    def window_stats(self, field, window, start=None, end=None, percentiles=(50, 95)):
+        """Statistics of field over consecutive window second buckets.
+
+        Returns a dict of arrays: start, count, mean, min, max and p<N> for
+        each percentile, with one entry per bucket that has readings.
+        """
+        times, values = self.load(field, start, end)
+        keep = ~np.isnan(values)
+        times = times[keep]
+        values = values[keep]
+        if not len(values):
+            return dict((k, np.empty(0)) for k in ["start", "count", "mean", "min", "max"] +
+                        ["p{}".format(p) for p in percentiles])
+        buckets = times // window
+        # readings are in time order, so each bucket is a contiguous run
+        edges = np.flatnonzero(np.diff(buckets)) + 1
+        starts = np.concatenate(([0], edges))
+        counts = np.diff(np.concatenate((starts, [len(values)])))
+        result = {
+            "start": buckets[starts] * window,
+            "count": counts,
+            "mean": np.add.reduceat(values, starts) / counts,
+            "min": np.minimum.reduceat(values, starts),
+            "max": np.maximum.reduceat(values, starts),
+        }
+        groups = np.split(values, edges)
+        for p in percentiles:
+            result["p{}".format(p)] = np.array([np.percentile(g, p) for g in groups])
+        return result
+
+    def daily(self, field, start=None, end=None, percentiles=(50, 95)):
+        return self.window_stats(field, DAY, start, end, percentiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export influx history to a columnar archive and summarise it')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser("export", help="stream a time range from influx into the archive")
+    export_parser.add_argument('--dbhost', dest='dbhost', required=False, default="babbage.local",
+                               help="The IP or resolvable hostname of the influx data base")
+    export_parser.add_argument('--dbport', dest='port', required=False, default=8086, type=int,
+                               help="The port number for the influx data base")
+    export_parser.add_argument("--user", dest='user', required=False, default="enviropi")
+    export_parser.add_argument("--password", dest='password', required=False, default="enviropi")
+    export_parser.add_argument("--dbname", dest='dbname', required=False, default="enviro_sensor_data")
+    export_parser.add_argument("--measurement", dest='measurement', required=False, default="environmental")
+    export_parser.add_argument("--location", dest='location', required=True,
+                               help="location tag of the board to export, e.g. driveway")
+    export_parser.add_argument("--page-size", dest='page_size', required=False, type=int, default=5000,
+                               help="points fetched from influx per query")
+    export_parser.add_argument("--force", dest='force', action='store_true',
+                               help="export days that are already in the archive again")
+
+    daily_parser = commands.add_parser("daily", help="print daily statistics of one field")
+    daily_parser.add_argument("--field", dest='field', required=False, default="pm2")
+    daily_parser.add_argument("--window", dest='window', required=False, type=int, default=DAY,
+                              help="seconds per bucket, a day by default")
+
+    for sub in (export_parser, daily_parser):
+        sub.add_argument("--out", dest='out', required=False, default="archive",
+                         help="archive directory")
+        sub.add_argument("--start", dest='start', required=True, type=parse_time,
+                         help="epoch seconds or YYYY-MM-DD[THH:MM:SSZ]; exports cover whole UTC days")
+        sub.add_argument("--end", dest='end', required=True, type=parse_time)
+    args = parser.parse_args()
+    start = args.start // 1000000000
+    end = args.end // 1000000000
+
+    if args.command == "export":
+        client = InfluxDBClient(args.dbhost, args.port, args.user, args.password, args.dbname)
+        os.makedirs(args.out, exist_ok=True)
+        started = time.monotonic()
+        written = export(client, args.out, args.measurement, args.location, start, end, args.page_size,
+                         args.force)
+        print("Exported {} days in {:.0f}s".format(written, time.monotonic() - started))
+    else:
+        archive = Archive(args.out)
+        started = time.perf_counter()
+        stats = archive.window_stats(args.field, args.window, start, end)
+        elapsed = time.perf_counter() - started
+        print("{:<20} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format("start", "count", "mean", "min", "max", "p50", "p95"))
+        for i in range(len(stats["start"])):
+            print("{:<20} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(stats["start"][i])), stats["count"][i],
+                stats["mean"][i], stats["min"][i], stats["max"][i], stats["p50"][i], stats["p95"][i]))
+        print("{} readings summarised in {:.1f} ms".format(int(stats["count"].sum()), elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,158 @@
+## Backfill luftdaten from the Influx history
+# Streams environmental points for a time range out of Influx one page at a
+# time (keyset paginated on time, so memory stays flat whatever the range)
+# and submits them to luftdaten from a pool of rate limited workers. After
+# every acknowledged page the position is checkpointed, so rerunning the same
+# command after a crash carries on where it stopped.
+#
+# python3 batch_update_luftdaten.py --start 2022-06-12T03:44:00Z --end 2022-06-12T12:24:24Z
+#
 import argparse
-import json
 import datetime
-import requests
+import json
+import os
+import time
 
 from influxdb import InfluxDBClient
 
-def send_to_luftdaten(values, id):
-    luft_map = { 
-        "pm1":"P0",
-        "pm2":"P2",
-        "pm10":"P1",
-        "real_temp":"temperature",
-        "humidity":"humidity",
-        "pressure":"pressure"}
+from ack_index import AckIndex
+from http_pool import HttpPool
+from influx_history import pages, parse_time
+from luftdaten_submit import LUFTDATEN_URL, Submitter
 
-    pm_values = dict(i for i in values.items() if i[0] in ["pm1", "pm2", "pm10"])
-    temp_values = dict(i for i in values.items() if i[0] in ["humidity", "pressure", "real_temp"])
+FIELDS = ("real_temp", "humidity", "pressure", "pm1", "pm10", "pm2")
 
-    pm_values_json = [{"value_type": luft_map[key], "value": val}
-                      for key, val in pm_values.items()]
-    temp_values_json = [{"value_type": luft_map[key], "value": val}
-                        for key, val in temp_values.items()]
-    try:
-        resp_1 = requests.post(
-            "https://api.luftdaten.info/v1/push-sensor-data/",
-            json={
-                "timestamp": values['time'],
-                "software_version": "nhorlock/enviropi",
-                "sensordatavalues": pm_values_json
-            },
-            headers={
-                "X-PIN": "1",
-                "X-Sensor": id,
-                "Content-Type": "application/json",
-                "cache-control": "no-cache"
-            }
-        )
-    except Exception as e:
-        print("Timeout {}".format(e))
-        return False
 
-    try:
-        resp_2 = requests.post(
-            "https://api.luftdaten.info/v1/push-sensor-data/",
-            json={
-                "timestamp": values['time'],
-                "software_version": "nhorlock/enviropi",
-                "sensordatavalues": temp_values_json
-            },
-            headers={
-                "X-PIN": "11",
-                "X-Sensor": id,
-                "Content-Type": "application/json",
-                "cache-control": "no-cache"
-            }
-        )
-    except Exception as e:
-        print("Timeout {}".format(e))
-        return False
+def iso(ns):
+    return datetime.datetime.fromtimestamp(ns // 1000000000, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
 
-    if resp_1.ok and resp_2.ok:
-        return True
-    else:
-        return False    
+class Checkpoint(object):
+    """The time of the last point luftdaten acknowledged for one backfill run."""
 
+    def __init__(self, path, start, end, sensor):
+        self.path = path
+        self.key = {"start": start, "end": end, "sensor": sensor}
+        self.position = start
+        self.submitted = 0
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                saved = json.load(f)
+            if all(saved.get(k) == v for k, v in self.key.items()):
+                self.position = saved["position"]
+                self.submitted = saved.get("submitted", 0)
+            else:
+                print("Checkpoint {} is for another range or sensor, starting from the beginning".format(path))
 
-def main(dbhost='babbage.local', port=8086):
-    """Instantiate a connection to the InfluxDB."""
-    
-    dbname = "enviro_sensor_data"
-    user = 'enviropi'
-    password = 'enviropi'
-    query = 'select real_temp, humidity, pressure, pm1, pm10, pm2 from environmental where time< 1655036664000000000 and time > 1655005440000000000 order by time desc;'
-    
-    client = InfluxDBClient(dbhost, port, user, password, dbname)
+    def save(self, position, submitted):
+        self.position = position
+        self.submitted = submitted
+        if not self.path:
+            return
+        state = dict(self.key, position=position, submitted=submitted)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
 
-    result  = client.query(query)
-    for measurement in result.get_points():
-        print(measurement.items())
-        print("submitted: " + str(send_to_luftdaten(measurement, "raspi-24b3c744")))
+
+def backfill(client, submitter, args):
+    checkpoint = Checkpoint(args.checkpoint, args.start, args.end, args.sensor)
+    if checkpoint.position > args.start:
+        print("Resuming after {} ({} points already submitted)".format(iso(checkpoint.position), checkpoint.submitted))
+    submitted = checkpoint.submitted
+    done = 0
+    started = time.monotonic()
+    last_report = started
+    # resume at the checkpointed time itself, other points may share it; the
+    # ack index skips the ones that were accepted
+    for page in pages(client, args.measurement, checkpoint.position, args.end, args.page_size, args.location,
+                      FIELDS, inclusive=checkpoint.position > args.start):
+        results = submitter.submit_many((point, point["time"] // 1000000000) for point in page)
+        # checkpoint up to the first failure, the rest of the page is resent on resume
+        acked = results.index(False) if False in results else len(results)
+        if acked:
+            done += acked
+            submitted += acked
+            checkpoint.save(page[acked - 1]["time"], submitted)
+        if acked < len(page):
+            print("Giving up at {}, rerun to resume from {}".format(iso(page[acked]["time"]), iso(checkpoint.position)))
+            return False
+        now = time.monotonic()
+        if now - last_report >= args.progress_interval:
+            last_report = now
+            span = args.end - args.start
+            print("{} points submitted, at {} ({:.1f}%), {:.1f} points/s, {}".format(
+                submitted, iso(checkpoint.position), 100.0 * (checkpoint.position - args.start) / span,
+                done / (now - started), submitter.stats()))
+    elapsed = time.monotonic() - started
+    print("Backfill complete: {} points this run in {:.0f}s ({:.1f} points/s), {} in total".format(
+        done, elapsed, done / elapsed if elapsed else 0, submitted))
+    print("Requests: {}".format(submitter.stats()))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill luftdaten from the readings stored in influx')
+    parser.add_argument('--dbhost', dest='dbhost', required=False, default="babbage.local",
+                        help="The IP or resolvable hostname of the influx data base")
+    parser.add_argument('--dbport', dest='port', required=False, default=8086, type=int,
+                        help="The port number for the influx data base")
+    parser.add_argument("--user", dest='user', required=False, default="enviropi")
+    parser.add_argument("--password", dest='password', required=False, default="enviropi")
+    parser.add_argument("--dbname", dest='dbname', required=False, default="enviro_sensor_data")
+    parser.add_argument("--measurement", dest='measurement', required=False, default="environmental")
+    parser.add_argument("--location", dest='location', required=False, default="driveway",
+                        help="location tag of the board whose points are sent as --sensor")
+    parser.add_argument("--start", dest='start', required=True, type=parse_time,
+                        help="first time to backfill (exclusive), epoch seconds or YYYY-MM-DD[THH:MM:SSZ]")
+    parser.add_argument("--end", dest='end', required=True, type=parse_time,
+                        help="last time to backfill (exclusive)")
+    parser.add_argument("--sensor", dest='sensor', required=False, default="raspi-24b3c744",
+                        help="the luftdaten sensor id (X-Sensor)")
+    parser.add_argument("--page-size", dest='page_size', required=False, type=int, default=500,
+                        help="points fetched from influx per query")
+    parser.add_argument("--checkpoint", dest='checkpoint', required=False, default="backfill.checkpoint",
+                        help="file recording progress so an interrupted backfill resumes; '' to disable")
+    parser.add_argument("--workers", dest='workers', required=False, type=int, default=4,
+                        help="requests in flight at once")
+    parser.add_argument("--rate", dest='rate', required=False, type=float, default=5,
+                        help="requests per second sent to luftdaten on average")
+    parser.add_argument("--burst", dest='burst', required=False, type=int, default=10,
+                        help="requests that may be sent back to back above --rate")
+    parser.add_argument("--retries", dest='retries', required=False, type=int, default=3,
+                        help="retries per request before giving up")
+    parser.add_argument("--backoff", dest='backoff', required=False, type=float, default=2,
+                        help="seconds before the first retry, doubling each time")
+    parser.add_argument("--ack-index", dest='ack_index', required=False, default="luftdaten-acks",
+                        help="directory recording what luftdaten accepted, shared with serial2influx.py; '' to disable")
+    parser.add_argument("--skip-within", dest='skip_within', required=False, type=int, default=0,
+                        help="skip a reading if one was accepted this many seconds either side of it, "
+                             "e.g. half the live upload interval to fill only the gaps the collector left")
+    parser.add_argument("--url", dest='url', required=False, default=LUFTDATEN_URL,
+                        help="push-sensor-data endpoint, e.g. a local stub for testing")
+    parser.add_argument("--progress-interval", dest='progress_interval', required=False, type=float, default=10,
+                        help="seconds between progress reports")
+    args = parser.parse_args()
+    if args.end <= args.start:
+        parser.error("--end must be after --start")
+
+    client = InfluxDBClient(args.dbhost, args.port, args.user, args.password, args.dbname)
+    http_pool = HttpPool(retries=0, pool_size=args.workers)
+    index = AckIndex(args.ack_index) if args.ack_index else None
+    submitter = Submitter(http_pool, args.sensor, url=args.url, workers=args.workers, rate=args.rate,
+                          burst=args.burst, retries=args.retries, backoff=args.backoff,
+                          index=index, within=args.skip_within)
+    try:
+        ok = backfill(client, submitter, args)
+    finally:
+        submitter.close()
+        if index is not None:
+            index.close()
+    if not ok:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
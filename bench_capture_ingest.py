@@ -0,0 +1,51 @@
+## Benchmark: loading a raw serial capture into influx
+# Writes a synthetic capture of the given number of frames (or uses an
+# existing one) and loads it with CaptureIngest, as serial2influx.py --replay
+# does, into the stub influx server of bench_collector.py.
+#
+# python3 bench_capture_ingest.py --frames 200000 --influx-delay 0.02
+#
+import argparse
+import os
+import tempfile
+
+from influxdb import InfluxDBClient
+
+from bench_collector import StubInflux, encode, serve, synthetic_frames
+from capture_ingest import CaptureIngest
+from influx_batch import BatchWriter
+
+
+def write_capture(path, n):
+    frames = synthetic_frames()
+    with open(path, "wb") as f:
+        for seq in range(n):
+            f.write(encode(next(frames), seq))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark loading a raw serial capture into influx')
+    parser.add_argument("--frames", type=int, default=100000, help="frames in the synthetic capture")
+    parser.add_argument("--capture", help="existing capture to load instead of a synthetic one")
+    parser.add_argument("--influx-delay", type=float, default=0.01, help="influx stub response time in seconds")
+    parser.add_argument("--lines", type=int, default=5000, help="points per influx write")
+    parser.add_argument("--gzip", action='store_true', help="gzip compress influx writes")
+    args = parser.parse_args()
+
+    StubInflux.configure(args.influx_delay, 0.0)
+    influx = serve(StubInflux)
+    path = args.capture
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="bench-ingest-"), "capture.txt")
+        write_capture(path, args.frames)
+    client = InfluxDBClient("127.0.0.1", influx.server_address[1], gzip=args.gzip)
+    ingest = CaptureIngest(BatchWriter(client), "environmental", {"location": "bench", "device": "bench"},
+                           batch_size=args.lines)
+    stats = ingest.run(path, 1655000000)
+    print("{} MB, {frames} frames, {written} written in {seconds}s: {frames_per_second} frames/s, "
+          "{} influx requests".format(os.path.getsize(path) // 1000000, StubInflux.requests, **stats))
+    influx.shutdown()
+
+
+if __name__ == "__main__":
+    main()
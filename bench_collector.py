@@ -0,0 +1,270 @@
+## Benchmark: the whole collector, from serial port to influx
+# Runs serial2influx.py as it runs on the Pi, but reading a pty instead of
+# the Feather and talking to throwaway HTTP servers on localhost in place of
+# influx, luftdaten and iot.packets.global. Each stub can be given a response
+# delay and a share of failed (503) responses.
+#
+# Frames are synthetic, or taken from a raw serial capture (e.g. saved with
+# `cat /dev/ttyACM0 > capture.txt`), and each one carries its sequence number
+# in num_loops so its arrival at the influx stub can be matched to the moment
+# it was written to the pty. Reports frames/s, end-to-end latency percentiles
+# and the collector's CPU time and resident memory.
+#
+# python3 bench_collector.py --frames 2000 --rate 200 --influx-delay 0.01
+#
+import argparse
+import gzip
+import json
+import os
+import pty
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from frame_parser import FrameParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEQ = re.compile(rb"[ ,]num_loops=(\d+)i")
+
+
+class Stub(BaseHTTPRequestHandler):
+    """Accept every request after delay seconds, failing error_rate of them with a 503."""
+
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+    error_rate = 0.0
+
+    @classmethod
+    def configure(cls, delay, error_rate):
+        cls.delay = delay
+        cls.error_rate = error_rate
+        cls.requests = 0
+        cls.errors = 0
+        cls.lock = threading.Lock()
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+        if cls.delay:
+            time.sleep(cls.delay)
+        if random.random() < cls.error_rate:
+            with cls.lock:
+                cls.errors += 1
+            self.reply(503, b"")
+            return
+        status, reply = self.accept(body)
+        self.reply(status, reply)
+
+    do_POST = do_PUT = handle_request
+
+    def accept(self, body):
+        return 200, b"{}"
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubInflux(Stub):
+    arrivals = {}
+
+    def accept(self, body):
+        now = time.monotonic()
+        for line in body.split(b"\n"):
+            if line.startswith(b"environmental,") or line.startswith(b"environmental "):
+                m = SEQ.search(line)
+                if m:
+                    StubInflux.arrivals.setdefault(int(m.group(1)), now)
+        return 204, b""
+
+
+class StubLuftdaten(Stub):
+    def accept(self, body):
+        return 201, b"{}"
+
+
+class StubIot(Stub):
+    def accept(self, body):
+        if self.path.endswith("/token/request"):
+            return 200, json.dumps({"token": "bench", "expires_in": 3600}).encode()
+        return 200, b"{}"
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_frames():
+    while True:
+        yield {
+            "lux": round(random.uniform(0, 2000), 3), "ucontroller_cpu_temp": round(random.uniform(20, 40), 2),
+            "temperature": round(random.uniform(-5, 35), 2), "pressure": round(random.uniform(980, 1040), 2),
+            "humidity": round(random.uniform(20, 100), 2), "OX": round(random.uniform(0, 3.3), 4),
+            "RED": round(random.uniform(0, 3.3), 4), "NH3": round(random.uniform(0, 3.3), 4),
+            "OX_raw": random.randint(0, 65535), "RED_raw": random.randint(0, 65535),
+            "NH3_raw": random.randint(0, 65535), "sound_level": round(random.uniform(0, 2000), 2),
+            "num_loops": 0, "num_idle_loops": random.randint(1000, 50000),
+            "pm1": random.randint(0, 50), "pm2": random.randint(0, 80), "pm10": random.randint(0, 100),
+            "pm1_atmos": random.randint(0, 50), "pm2_atmos": random.randint(0, 80), "pm10_atmos": random.randint(0, 100),
+        }
+
+
+def capture_frames(path):
+    with open(path, "rb") as f:
+        readings = FrameParser().feed(f.read())
+    if not readings:
+        raise SystemExit("no frames in {}".format(path))
+    frames = [reading.fields() for reading in readings]
+    while True:
+        for frame in frames:
+            yield dict(frame)
+
+
+def encode(frame, seq):
+    frame["num_loops"] = seq
+    lines = ["BEGIN"] + ["{}={}".format(k, v) for k, v in frame.items()] + ["END", ""]
+    return "\r\n".join(lines).encode("utf-8")
+
+
+def proc_stats(pid):
+    """(cpu seconds, rss bytes, peak rss bytes) of a process, from /proc."""
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    rss = peak = 0
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1]) * 1024
+    return cpu, rss, peak
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark serial2influx.py end to end against local stubs')
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="frames per second to write, 0 for as fast as possible")
+    parser.add_argument("--capture", help="raw serial capture to replay instead of synthetic frames")
+    parser.add_argument("--influx-delay", type=float, default=0.005, help="influx stub response time in seconds")
+    parser.add_argument("--influx-error-rate", type=float, default=0.0, help="share of influx writes answered 503")
+    parser.add_argument("--upload-delay", type=float, default=0.05,
+                        help="luftdaten and iot.packets.global stub response time in seconds")
+    parser.add_argument("--upload-error-rate", type=float, default=0.0,
+                        help="share of luftdaten and iot.packets.global requests answered 503")
+    parser.add_argument("--batch-size", type=int, default=20, help="collector --batch-size")
+    parser.add_argument("--batch-age", type=float, default=1, help="collector --batch-age")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the last frame to arrive")
+    parser.add_argument("--collector-arg", action='append', default=[],
+                        help="extra argument for serial2influx.py, e.g. --collector-arg=--queue-size=1000")
+    args = parser.parse_args()
+
+    StubInflux.configure(args.influx_delay, args.influx_error_rate)
+    StubInflux.arrivals = {}
+    StubLuftdaten.configure(args.upload_delay, args.upload_error_rate)
+    StubIot.configure(args.upload_delay, args.upload_error_rate)
+    influx = serve(StubInflux)
+    luftdaten = serve(StubLuftdaten)
+    iot = serve(StubIot)
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    workdir = tempfile.mkdtemp(prefix="bench-collector-")
+    command = [
+        sys.executable, os.path.join(HERE, "serial2influx.py"),
+        "--serial-port", os.ttyname(slave),
+        "--dbhost", "127.0.0.1", "--dbport", str(influx.server_address[1]),
+        "--luftdaten-url", "http://127.0.0.1:{}/v1/push-sensor-data/".format(luftdaten.server_address[1]),
+        "--iot-url", "http://127.0.0.1:{}/api/1.0/".format(iot.server_address[1]),
+        "--no-therm", "--metrics-port", "0", "--metrics-interval", "0",
+        "--batch-size", str(args.batch_size), "--batch-age", str(args.batch_age),
+    ] + args.collector_arg
+    env = dict(os.environ, HOME=workdir)
+    collector = subprocess.Popen(command, cwd=workdir, env=env)
+    frames = capture_frames(args.capture) if args.capture else synthetic_frames()
+
+    try:
+        # frames written before the collector has opened the port, or cut in
+        # half by the parser.reset() when BoardMux opens it, never arrive, so
+        # repeat frame 0 until one gets through to influx
+        deadline = time.monotonic() + 30
+        while 0 not in StubInflux.arrivals:
+            if collector.poll() is not None or time.monotonic() > deadline:
+                raise SystemExit("collector did not start, see {}/enviropi.log".format(workdir))
+            os.write(master, encode(next(frames), 0))
+            time.sleep(0.2)
+
+        cpu_before, _, _ = proc_stats(collector.pid)
+        written = {}
+        start = time.monotonic()
+        for seq in range(1, args.frames + 1):
+            if args.rate:
+                delay = start + seq / args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            data = encode(next(frames), seq)
+            written[seq] = time.monotonic()
+            os.write(master, data)
+        deadline = time.monotonic() + args.timeout
+        while len([s for s in written if s in StubInflux.arrivals]) < args.frames and time.monotonic() < deadline:
+            time.sleep(0.1)
+        cpu_after, rss, peak = proc_stats(collector.pid)
+    finally:
+        collector.send_signal(signal.SIGINT)
+        try:
+            collector.wait(15)
+        except subprocess.TimeoutExpired:
+            collector.kill()
+
+    arrived = [s for s in written if s in StubInflux.arrivals]
+    latencies = [StubInflux.arrivals[s] - written[s] for s in arrived]
+    end = max(StubInflux.arrivals[s] for s in arrived) if arrived else time.monotonic()
+    elapsed = end - start
+    cpu = cpu_after - cpu_before
+    print("{} of {} frames reached influx in {:.2f}s: {:.1f} frames/s".format(
+        len(arrived), args.frames, elapsed, len(arrived) / elapsed))
+    if len(arrived) < args.frames:
+        print("missing frames were dropped from a full sink queue (try --rate or --collector-arg=--queue-size=N)"
+              " or are still spooled, see the collector log")
+    print("end-to-end latency ms: p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}".format(
+        *(percentile(latencies, p) * 1000 for p in (50, 90, 99, 100))))
+    print("collector CPU {:.2f}s ({:.0f}% of one core, {:.0f} us/frame), RSS {:.1f} MB, peak {:.1f} MB".format(
+        cpu, 100 * cpu / elapsed, cpu / max(1, len(arrived)) * 1e6, rss / 1e6, peak / 1e6))
+    print("stub requests: influx {} ({} failed), luftdaten {} ({} failed), iot.packets.global {} ({} failed)".format(
+        StubInflux.requests, StubInflux.errors, StubLuftdaten.requests, StubLuftdaten.errors,
+        StubIot.requests, StubIot.errors))
+    print("collector files and log in {}".format(workdir))
+    for server in (influx, luftdaten, iot):
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
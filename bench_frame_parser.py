@@ -0,0 +1,151 @@
+## Benchmark: the old readline/decode/split loop body against FrameParser
+# Feeds a serial capture (raw bytes as read from /dev/ttyACM0, e.g. saved
+# with `cat /dev/ttyACM0 > capture.txt`) through both parsers. Without
+# --capture a synthetic capture in code.py's format is generated.
+#
+# The capture is served by a RawIOBase port, like serial.Serial, so the old
+# loop's readline() goes through the same read-one-byte-at-a-time path it
+# takes on the Pi (minus the syscall per byte).
+#
+# python3 bench_frame_parser.py --capture capture.txt
+#
+import argparse
+import io
+import logging
+import random
+import time
+import tracemalloc
+
+from frame_parser import FrameParser
+
+
+class CapturePort(io.RawIOBase):
+    """Enough of serial.Serial for both loops; readline() is inherited as in pyserial."""
+
+    def __init__(self, capture):
+        self.data = io.BytesIO(capture)
+        self.size = len(capture)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.data.readinto(b)
+
+    @property
+    def in_waiting(self):
+        return self.size - self.data.tell()
+
+    def done(self):
+        return self.data.tell() >= self.size
+
+
+def synthetic_capture(frames):
+    out = io.StringIO()
+    for n in range(frames):
+        out.write("BEGIN\r\n")
+        for k, v in (("lux", random.uniform(0, 2000)), ("ucontroller_cpu_temp", random.uniform(20, 40)),
+                     ("temperature", random.uniform(-5, 35)), ("pressure", random.uniform(980, 1040)),
+                     ("humidity", random.uniform(20, 100)), ("OX", random.uniform(0, 3.3)),
+                     ("RED", random.uniform(0, 3.3)), ("NH3", random.uniform(0, 3.3)),
+                     ("OX_raw", random.randint(0, 65535)), ("RED_raw", random.randint(0, 65535)),
+                     ("NH3_raw", random.randint(0, 65535)), ("sound_level", random.uniform(0, 2000)),
+                     ("num_loops", random.randint(1000, 50000)), ("num_idle_loops", random.randint(1000, 50000)),
+                     ("pm1", random.randint(0, 50)), ("pm2", random.randint(0, 80)), ("pm10", random.randint(0, 100)),
+                     ("pm1_atmos", random.randint(0, 50)), ("pm2_atmos", random.randint(0, 80)),
+                     ("pm10_atmos", random.randint(0, 100))):
+            out.write("{}={}\r\n".format(k, v))
+        out.write("END\r\n")
+    return out.getvalue().encode("utf-8")
+
+
+def old_loop(capture):
+    # the body of the original serial2influx.py while loop, minus the sinks
+    ser = CapturePort(capture)
+    collecting = False
+    readings = {}
+    frames = []
+    while True:
+        line = ser.readline()
+        if not line:
+            break
+        read_serial = line.decode("utf-8").strip()
+        if collecting:
+            if read_serial == "END":
+                collecting = False
+                frames.append(readings)
+            else:
+                try:
+                    k, v = read_serial.split("=")
+                    if '.' in v:
+                        readings[k] = float(v)
+                    else:
+                        readings[k] = int(v)
+                except Exception as e:
+                    logging.warning("decode failed: [{}] exception [{}]".format(read_serial, e))
+        else:
+            if read_serial == "BEGIN":
+                collecting = True
+                readings = {}
+            else:
+                logging.debug("data outside of BEGIN/END: " + read_serial)
+    return frames
+
+
+def new_loop(capture):
+    port = CapturePort(capture)
+    parser = FrameParser()
+    frames = []
+    while not port.done():
+        frames.extend(parser.read_from(port))
+    return frames
+
+
+def new_loop_fields(capture):
+    # including the conversion back to a dict that the sinks need today
+    port = CapturePort(capture)
+    parser = FrameParser()
+    frames = []
+    while not port.done():
+        for reading in parser.read_from(port):
+            frames.append(reading.fields())
+    return frames
+
+
+def run(label, fn, capture, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = len(fn(capture))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # memory still held by the parsed records once parsing is done
+    tracemalloc.start()
+    kept = fn(capture)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    print("{:<24} {:>8} frames {:>10.0f} frames/s {:>8.1f} us/frame {:>8.0f} bytes/record".format(
+        label, frames, frames / best, best / frames * 1e6, held / frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the old serial loop body with FrameParser')
+    parser.add_argument("--capture", help="raw serial capture file")
+    parser.add_argument("--frames", type=int, default=20000, help="synthetic frames when no capture is given")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, "rb") as f:
+            capture = f.read()
+    else:
+        capture = synthetic_capture(args.frames)
+
+    run("readline/decode/split", old_loop, capture, args.repeat)
+    run("FrameParser", new_loop, capture, args.repeat)
+    run("FrameParser + fields()", new_loop_fields, capture, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+## Benchmark: per-row write_points() against the batched line-protocol writer
+# Runs a throwaway HTTP server on localhost that accepts /write like InfluxDB
+# and counts requests and bytes received, so no real database is needed.
+#
+# python3 bench_influx_batch.py --points 2000
+#
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from influxdb import InfluxDBClient
+
+from influx_batch import BatchWriter
+
+
+class StubInflux(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = 0
+    bytes = 0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        cls = type(self)
+        cls.requests += 1
+        cls.bytes += len(self.requestline) + len(str(self.headers)) + len(body)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def sample_point(i):
+    # roughly what code.py sends every 5 seconds
+    return {
+        "measurement": "environmental",
+        "tags": {"location": "driveway", "device": "enviro+ arduino"},
+        "time": 1655000000 + 5 * i,
+        "fields": {
+            "lux": 123.456 + i, "ucontroller_cpu_temp": 31.2, "temperature": 18.34,
+            "pressure": 1012.87, "humidity": 61.2, "OX": 1.8712, "RED": 0.9123, "NH3": 1.0234,
+            "OX_raw": 37210 + i, "RED_raw": 18145, "NH3_raw": 20354, "sound_level": 87.3,
+            "num_loops": 40012, "num_idle_loops": 40011, "pm1": 3, "pm2": 5, "pm10": 6,
+            "pm1_atmos": 3, "pm2_atmos": 5, "pm10_atmos": 6, "real_temp": 17.9375,
+        },
+    }
+
+
+def run(label, points, write):
+    StubInflux.requests = 0
+    StubInflux.bytes = 0
+    start = time.perf_counter()
+    write(points)
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>10.0f} points/s {:>7} requests {:>10} bytes {:>8.1f} bytes/point".format(
+        label, len(points) / elapsed, StubInflux.requests, StubInflux.bytes,
+        StubInflux.bytes / len(points)))
+
+
+def per_row(client):
+    def write(points):
+        for point in points:
+            client.write_points([point], time_precision='s')
+    return write
+
+
+def batched(client, batch_size):
+    def write(points):
+        writer = BatchWriter(client, batch_size=batch_size, max_age=3600)
+        for point in points:
+            writer.add(point)
+        writer.close()
+    return write
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-row and batched influx writes')
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="12,60,500")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubInflux)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    points = [sample_point(i) for i in range(args.points)]
+    plain = InfluxDBClient("127.0.0.1", port, "enviropi", "enviropi", "enviro_sensor_data")
+    gzipped = InfluxDBClient("127.0.0.1", port, "enviropi", "enviropi", "enviro_sensor_data", gzip=True)
+
+    run("per-row write_points", points, per_row(plain))
+    for size in [int(s) for s in args.batch_sizes.split(",")]:
+        run("batched x{}".format(size), points, batched(plain, size))
+        run("batched x{} gzip".format(size), points, batched(gzipped, size))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+## Benchmark: serial against concurrent luftdaten submission
+# Runs a throwaway HTTP server on localhost that accepts push-sensor-data
+# like Sensor.Community, with a configurable response delay and a share of
+# 503 and 429 responses, so backfill throughput can be measured offline.
+#
+# python3 bench_luftdaten_submit.py --readings 500 --delay 0.05 --workers 8
+#
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from http_pool import HttpPool
+from luftdaten_submit import Submitter
+
+
+class StubLuftdaten(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.05
+    error_rate = 0.0
+    throttle_rate = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        cls = type(self)
+        with cls.lock:
+            cls.requests += 1
+        time.sleep(cls.delay)
+        roll = random.random()
+        if roll < cls.throttle_rate:
+            self.send_response(429)
+            self.send_header("Retry-After", "0.2")
+        elif roll < cls.throttle_rate + cls.error_rate:
+            self.send_response(503)
+        else:
+            self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def sample_readings(n):
+    return [({"pm1": 3, "pm2": 5, "pm10": 6, "real_temp": 17.9 + i % 10 / 10.0, "humidity": 61.2,
+              "pressure": 1012.87}, 1655000000 + 5 * i)
+            for i in range(n)]
+
+
+def run(label, url, readings, workers, rate, burst):
+    StubLuftdaten.requests = 0
+    http_pool = HttpPool(retries=0, pool_size=workers)
+    submitter = Submitter(http_pool, "raspi-bench", url=url, workers=workers, rate=rate, burst=burst,
+                          retries=5, backoff=0.05)
+    start = time.perf_counter()
+    results = submitter.submit_many(readings)
+    elapsed = time.perf_counter() - start
+    submitter.close()
+    stats = submitter.stats()
+    connections = sum(host["connections"] for host in http_pool.stats().values())
+    print("{:<26} {:>8.1f} readings/s {:>5} ok {:>6} requests {:>4} conns {:>4} retried  p50 {} p90 {} p99 {} ms".format(
+        label, len(readings) / elapsed, sum(results), StubLuftdaten.requests, connections, stats["retried"],
+        stats["p50_ms"], stats["p90_ms"], stats["p99_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare serial and concurrent luftdaten submission')
+    parser.add_argument("--readings", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.05, help="stub server response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="share of 503 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.01, help="share of 429 responses")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=50, help="token bucket rate for the limited run")
+    args = parser.parse_args()
+
+    StubLuftdaten.delay = args.delay
+    StubLuftdaten.error_rate = args.error_rate
+    StubLuftdaten.throttle_rate = args.throttle_rate
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLuftdaten)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1/push-sensor-data/".format(server.server_address[1])
+
+    readings = sample_readings(args.readings)
+    unlimited = 1e6
+    run("serial (1 worker)", url, readings, 1, unlimited, 1)
+    run("{} workers".format(args.workers), url, readings, args.workers, unlimited, args.workers)
+    run("{} workers, {:g} req/s".format(args.workers, args.rate), url, readings, args.workers,
+        args.rate, args.workers)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
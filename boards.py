@@ -0,0 +1,123 @@
+## Several sensor boards in one collector
+# Each board has its own serial transport, parser state and tags. A single
+# selector loop reads whichever ports have data, so adding a board costs one
+# more file descriptor rather than another process with its own sinks.
+#
+import selectors
+import time
+
+from frame_parser import FrameParser
+from serial_port import SerialTransport
+
+# keys in a board spec that configure the board rather than becoming tags
+BOARD_OPTIONS = ("port", "vid", "pid", "serial", "baud", "upload", "therm")
+
+
+class Board(object):
+    """One sensor board: where to find it, how to tag it, and what it feeds.
+
+    upload: send this board's readings to luftdaten/iot.packets.global
+    therm: attach the Pi's DS18B20 temperature to this board's readings
+    """
+
+    def __init__(self, transport, tags, upload=True, therm=True):
+        self.transport = transport
+        self.parser = FrameParser()
+        self.tags = tags
+        self.upload = upload
+        self.therm = therm
+        self.fd = None
+
+    @property
+    def name(self):
+        return self.transport.device or self.transport.port
+
+    def stats(self):
+        stats = self.transport.stats()
+        stats["frames"] = self.parser.frames
+        stats["decode_failures"] = self.parser.decode_failures
+        return stats
+
+
+def _yes(value):
+    return value.lower() in ("1", "yes", "true", "on")
+
+
+def parse_board_spec(spec, primary):
+    """Build a Board from e.g. "port=/dev/ttyACM1,location=garage,device=enviro+ feather".
+
+    port, vid, pid (hex), serial (USB serial number), baud, upload and therm
+    configure the board, every other key=value becomes an Influx tag. Only the
+    primary (first) board uploads and gets the DS18B20 reading unless upload
+    and therm say otherwise.
+    """
+    options = {}
+    tags = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        if "=" not in item:
+            raise ValueError("board option '{}' is not key=value".format(item))
+        k, v = item.split("=", 1)
+        k = k.strip()
+        if k in BOARD_OPTIONS:
+            options[k] = v.strip()
+        else:
+            tags[k] = v.strip()
+    transport = SerialTransport(
+        options.get("port", "/dev/ttyACM0"),
+        int(options.get("baud", 9600)),
+        vid=int(options["vid"], 16) if "vid" in options else None,
+        pid=int(options["pid"], 16) if "pid" in options else None,
+        serial_number=options.get("serial"))
+    upload = _yes(options["upload"]) if "upload" in options else primary
+    therm = _yes(options["therm"]) if "therm" in options else primary
+    return Board(transport, tags, upload=upload, therm=therm)
+
+
+class BoardMux(object):
+    """Read frames from every board's port through one selector."""
+
+    def __init__(self, boards):
+        self.boards = boards
+        self.selector = selectors.DefaultSelector()
+
+    def _open(self):
+        for board in self.boards:
+            if board.fd is None and board.transport.poll_open():
+                board.parser.reset()
+                board.fd = board.transport.serial.fileno()
+                self.selector.register(board.fd, selectors.EVENT_READ, board)
+
+    def _drop(self, board):
+        try:
+            self.selector.unregister(board.fd)
+        except (KeyError, ValueError):
+            pass
+        board.fd = None
+
+    def poll(self, timeout=1.0):
+        """Wait up to timeout for data and return the completed (board, reading) pairs."""
+        self._open()
+        if not self.selector.get_map():
+            # nothing open, wait for the next reconnect attempt
+            time.sleep(timeout)
+            return []
+        results = []
+        for key, _ in self.selector.select(timeout):
+            board = key.data
+            for reading in board.transport.read_ready(board.parser):
+                results.append((board, reading))
+            if board.transport.serial is None:
+                self._drop(board)
+        return results
+
+    def close(self):
+        for board in self.boards:
+            if board.fd is not None:
+                self._drop(board)
+            board.transport.close()
+        self.selector.close()
+
+    def stats(self):
+        return dict((board.name, board.stats()) for board in self.boards)
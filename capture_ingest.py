@@ -0,0 +1,168 @@
+## Offline ingest of raw serial captures
+# Loads a capture of a board's serial output (serialread.py, `cat
+# /dev/ttyACM0 > capture.txt`, a field logger) into Influx as fast as it can
+# be parsed rather than in real time. The file is memory mapped and fed a
+# chunk at a time to the collector's FrameParser, each reading is encoded to
+# line protocol straight from its field slots, and full batches are written
+# by a background thread so parsing carries on while Influx answers. Memory
+# use is bounded by the chunk size and the batches in flight, however large
+# the capture.
+#
+# Timestamps: a frame carrying time=<epoch seconds>, as field loggers add,
+# keeps it. Other frames are taken to be interval seconds apart, as code.py
+# sends them, from start or, by default, ending at the file's modification
+# time, when its last frame was written.
+#
+# Loading the same capture twice is harmless, Influx keeps one point per
+# series and timestamp.
+#
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+
+from frame_parser import FrameParser, BINARY_SYNC
+
+CHUNK_SIZE = 1 << 20
+
+
+def count_frames(data):
+    """Frames in a mapped capture, from its END lines and binary sync words.
+
+    Exact for text captures; for binary ones an estimate, since a sync word
+    can also turn up inside a frame.
+    """
+    frames = 0
+    for offset in range(0, len(data), CHUNK_SIZE):
+        # overlap the next chunk so a marker across the boundary is seen once
+        frames += data[offset:offset + CHUNK_SIZE + 3].count(b"\nEND")
+        frames += data[offset:offset + CHUNK_SIZE + 1].count(BINARY_SYNC)
+    if data[:3] == b"END":
+        frames += 1
+    return frames
+
+
+class CaptureIngest(object):
+    """Parse a capture file and write its frames to Influx in large batches.
+
+    writer is a BatchWriter, used for its write() and counters; tags are
+    those of the board the capture came from. publish, if given, is called
+    with every reading as a point dict, for sinks other than Influx.
+    derive, if given, is called with every reading's fields and returns
+    fields to add to it, as the collector adds derived.derive() to live ones.
+    """
+
+    def __init__(self, writer, measurement, tags, batch_size=5000, in_flight=4, publish=None,
+                 progress_interval=10, max_backoff=60, derive=None):
+        self.writer = writer
+        self.measurement = measurement
+        self.tags = tags
+        self.batch_size = batch_size
+        self.publish = publish
+        self.derive = derive
+        self.progress_interval = progress_interval
+        self.max_backoff = max_backoff
+        self.batches = queue.Queue(in_flight)
+        self.stopping = False
+        self.frames = 0
+        self.written = 0
+        self.empty = 0
+        self.abandoned = 0
+        self.bytes = 0
+        self.decode_failures = 0
+        self.elapsed = 0
+
+    def _write_batches(self):
+        while True:
+            lines = self.batches.get()
+            if lines is None:
+                return
+            delay = 1
+            # unreachable: keep trying, nothing else would write these lines
+            while self.writer.write(lines) is False:
+                if self.stopping:
+                    self.abandoned += len(lines)
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def run(self, path, start=None, interval=5):
+        """Ingest the capture at path; returns stats(). Ctrl-C stops it early."""
+        writer_thread = threading.Thread(target=self._write_batches, name="capture-writer", daemon=True)
+        writer_thread.start()
+        started = time.monotonic()
+        written = self.writer.written
+        parser = FrameParser(size=CHUNK_SIZE)
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                data = b""
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+            if start is None:
+                start = os.fstat(f.fileno()).st_mtime - max(0, count_frames(data) - 1) * interval
+        logging.info("Ingesting %s (%s bytes) from %s", path, len(data), time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(start)))
+
+        encode = self.writer.encoder.encode_reading
+        derive = self.derive
+        prefix = self.writer.encoder.prefix(self.measurement, self.tags)
+        view = memoryview(data)
+        lines = []
+        progress_time = time.monotonic()
+        try:
+            for offset in range(0, len(data), CHUNK_SIZE):
+                for reading in parser.feed(view[offset:offset + CHUNK_SIZE]):
+                    timestamp = reading.extra.pop("time", None) if reading.extra else None
+                    if timestamp is None:
+                        timestamp = start + self.frames * interval
+                    self.frames += 1
+                    if derive is not None:
+                        for name, value in derive(reading.fields()).items():
+                            reading.set(name, value)
+                    line = encode(prefix, reading, timestamp)
+                    if line is None:
+                        self.empty += 1
+                        continue
+                    lines.append(line)
+                    if len(lines) >= self.batch_size:
+                        self.batches.put(lines)
+                        lines = []
+                    if self.publish is not None:
+                        self.publish({"measurement": self.measurement, "tags": self.tags,
+                                      "time": int(timestamp), "fields": reading.fields()})
+                self.bytes = min(len(data), offset + CHUNK_SIZE)
+                if time.monotonic() > progress_time + self.progress_interval:
+                    progress_time = time.monotonic()
+                    logging.info("Ingested %s frames, %.0f%% of %s", self.frames, 100.0 * self.bytes / len(data), path)
+            if lines:
+                self.batches.put(lines)
+        except KeyboardInterrupt:
+            logging.info("Interrupted after %s frames of %s", self.frames, path)
+            self.stopping = True
+        finally:
+            self.batches.put(None)
+            writer_thread.join()
+            view.release()
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.written = self.writer.written - written
+        self.decode_failures = parser.decode_failures
+        self.elapsed = time.monotonic() - started
+        logging.info("Ingest of %s finished: %s", path, self.stats())
+        return self.stats()
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "written": self.written,
+            "empty": self.empty,
+            "abandoned": self.abandoned,
+            "decode_failures": self.decode_failures,
+            "bytes": self.bytes,
+            "seconds": round(self.elapsed, 1),
+            "frames_per_second": round(self.frames / self.elapsed) if self.elapsed else 0,
+        }
@@ -1,5 +1,11 @@
 ## A consolidated sensor reading script
-# each loop will read all the sensors and send K=V data over USB
+# Reads all the sensors and sends K=V data over USB every interval seconds.
+# Each sensor is read by its own asyncio task at its own cadence, so a slow
+# read never stops the microphone being sampled: that is done at a fixed
+# rate into a ring buffer, from which each frame reports the RMS sound level
+# over the last mic_window seconds, and how late the sampling ran
+# (loop_jitter_ms, the worst lateness of the scheduler since the last frame).
+# Needs the asyncio and adafruit_ticks libraries from the CircuitPython bundle.
 # Based upon adafruit and pimoroni examples
 #
 
@@ -11,6 +17,10 @@ Refer to the BME280 datasheet to understand what these parameters do
 import time
 import math
 import gc
+import struct
+from array import array
+
+import asyncio
 
 import board
 import busio
@@ -22,17 +32,76 @@ import terminalio
 import microcontroller
 
 from adafruit_display_text import label
+from adafruit_ticks import ticks_add, ticks_diff, ticks_ms
 
 import pimoroni_physical_feather_pins
 from pimoroni_circuitpython_adapter import not_SMBus
 from pimoroni_envirowing import gas, screen
 
 from pimoroni_ltr559 import LTR559
-from pimoroni_pms5003 import PMS5003
+
+try:
+    import usb_cdc
+except ImportError:
+    usb_cdc = None
 
 # settings
 interval = 5 # seconds delay between readings
 sea_level_pressure = 1013.25
+binary_frames = False # send compact binary frames with a CRC instead of key=value text
+mic_rate = 500 # microphone samples per second, a divisor of 1000
+mic_window = 5 # seconds of samples the sound level is computed over
+bme280_interval = 1 # seconds between reads of each sensor
+gas_interval = 1
+ltr559_interval = 1
+pms5003_poll = 0.1 # seconds between checks for a complete particulate frame
+
+MIC_FULL_SCALE = 32768
+MIC_CHUNK = 250 # samples squared between yields to the other tasks
+PMS5003_FRAME_SIZE = 32
+PMS5003_STALE_MS = 10000 # particulate readings are dropped from frames when none arrive for this long
+PM_FIELDS = ("pm1", "pm2", "pm10", "pm1_atmos", "pm2_atmos", "pm10_atmos")
+
+# binary frame layout, see frame_parser.py on the pi. The order and struct
+# formats of these fields have to match FIELDS and BINARY_FORMATS there.
+BINARY_FIELDS = (
+    ("lux", "f"), ("ucontroller_cpu_temp", "f"), ("temperature", "f"), ("pressure", "f"),
+    ("humidity", "f"), ("OX", "f"), ("RED", "f"), ("NH3", "f"),
+    ("OX_raw", "H"), ("RED_raw", "H"), ("NH3_raw", "H"),
+    ("sound_level", "f"), ("num_loops", "I"), ("num_idle_loops", "I"),
+    ("pm1", "H"), ("pm2", "H"), ("pm10", "H"), ("pm1_atmos", "H"), ("pm2_atmos", "H"), ("pm10_atmos", "H"),
+    ("real_temp", "f"), # added on the pi, never sent
+    ("sound_db", "f"), ("loop_jitter_ms", "H"),
+)
+BINARY_SYNC = b"\xa5\x5a"
+BINARY_VERSION = 1
+
+def crc16(data, crc=0xFFFF):
+    # CRC-16/CCITT, the same as binascii.crc_hqx on the pi
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+def encode_frame(readings):
+    # sync, version, length, field bitmap, packed values, crc
+    bitmap = 0
+    fmt = "<I"
+    values = [0]
+    for i, (name, field_fmt) in enumerate(BINARY_FIELDS):
+        if name in readings:
+            bitmap |= 1 << i
+            fmt += field_fmt
+            values.append(readings[name])
+    values[0] = bitmap
+    body = struct.pack(fmt, *values)
+    header = bytes((BINARY_VERSION, len(body)))
+    crc = crc16(header + body)
+    return BINARY_SYNC + header + body + bytes((crc >> 8, crc & 0xFF))
 
 def initialise_bme280(i2c):
     # Change this to match the location's pressure (hPa) at sea level
@@ -46,17 +115,48 @@ def initialise_bme280(i2c):
     bme280.overscan_temperature = adafruit_bme280.OVERSCAN_X2
     return bme280
 
-def initialise_pms5003():
-    # set up the pms5003
-    pms5003 = PMS5003()
-    try:
-        pms5003.read()
-        is_pms5003 = True
-    except Exception as e:
-        print(e)
-        print("Particualte sensor not found.")
-        return None
-    return pms5003
+class PMS5003Reader(object):
+    """Frames from the PMS5003 on uart, taken from whatever has arrived so a read never waits."""
+
+    def __init__(self, uart):
+        self.uart = uart
+        self.buf = b""
+
+    def poll(self):
+        # the data words of the newest whole frame received since the last poll, or None
+        waiting = self.uart.in_waiting
+        if waiting:
+            self.buf += self.uart.read(waiting)
+        data = None
+        while True:
+            start = self.buf.find(b"BM")
+            if start < 0:
+                # keep a last "B", it may start the next frame
+                self.buf = self.buf[-1:]
+                return data
+            if len(self.buf) - start < PMS5003_FRAME_SIZE:
+                self.buf = self.buf[start:]
+                return data
+            frame = self.buf[start:start + PMS5003_FRAME_SIZE]
+            length = (frame[2] << 8) | frame[3]
+            checksum = (frame[30] << 8) | frame[31]
+            if length == PMS5003_FRAME_SIZE - 4 and sum(frame[:30]) & 0xFFFF == checksum:
+                data = struct.unpack(">13H", frame[4:30])
+                self.buf = self.buf[start + PMS5003_FRAME_SIZE:]
+            else:
+                # corrupt, or "BM" inside a frame: look for the next header
+                self.buf = self.buf[start + 2:]
+
+def initialise_pms5003(uart):
+    # set up the pms5003, which sends a frame about every second in its default active mode
+    pms5003 = PMS5003Reader(uart)
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        if pms5003.poll() is not None:
+            return pms5003
+        time.sleep(0.1)
+    print("Particualte sensor not found.")
+    return None
 
 def initialise_ltr559():
     # set up connection with the ltr559
@@ -89,6 +189,152 @@ def initialise_screen():
     splash.append(inner_sprite)
     return splash
 
+class MicSampler(object):
+    """Sample the microphone every 1/rate seconds into a ring buffer holding the last window seconds."""
+
+    def __init__(self, mic, rate, window):
+        self.mic = mic
+        self.period_ms = 1000 // rate
+        self.ring = array("H", [MIC_FULL_SCALE] * (rate * window))
+        self.head = 0
+        self.filled = 0
+        # since the last frame
+        self.taken = 0
+        self.jitter_ms = 0
+        self.since = ticks_ms()
+
+    async def run(self):
+        ring = self.ring
+        deadline = ticks_ms()
+        while True:
+            late = ticks_diff(ticks_ms(), deadline)
+            if late > self.jitter_ms:
+                self.jitter_ms = late
+            ring[self.head] = self.mic.value
+            self.head = (self.head + 1) % len(ring)
+            if self.filled < len(ring):
+                self.filled += 1
+            self.taken += 1
+            deadline = ticks_add(deadline, self.period_ms)
+            wait = ticks_diff(deadline, ticks_ms())
+            if wait < 0:
+                # more than a period behind: skip the samples missed rather than bunch them up
+                deadline = ticks_ms()
+                wait = 0
+            await asyncio.sleep_ms(wait)
+
+    async def rms(self):
+        """RMS about its mean of the samples in the ring, in ADC counts, squared a chunk at a time."""
+        n = self.filled
+        if not n:
+            return None
+        # the ring keeps filling while this runs
+        samples = array("H", self.ring)
+        mean = sum(memoryview(samples)[:n]) / n
+        total = 0.0
+        for start in range(0, n, MIC_CHUNK):
+            for i in range(start, min(n, start + MIC_CHUNK)):
+                d = samples[i] - mean
+                total += d * d
+            await asyncio.sleep(0)
+        return math.sqrt(total / n)
+
+    def restart(self):
+        """Counts for a frame: samples due and taken and the worst lateness since the last call."""
+        now = ticks_ms()
+        # the lateness is sent as an unsigned short, a longer stall reads as 65535
+        counts = (ticks_diff(now, self.since) // self.period_ms, self.taken, min(self.jitter_ms, 65535))
+        self.since = now
+        self.taken = 0
+        self.jitter_ms = 0
+        return counts
+
+def read_bme280(latest):
+    latest["ucontroller_cpu_temp"] = microcontroller.cpu.temperature
+    latest["temperature"] = bme280.temperature
+    latest["pressure"] = bme280.pressure
+    latest["humidity"] = bme280.humidity
+    #latest["altitude"] = bme280.altitude # uncomment for altitude estimation
+
+def read_gas(latest):
+    gas_reading = gas.read_all()
+    latest["OX"] = gas_reading._OX.value * (gas_reading._OX.reference_voltage/65535)
+    latest["RED"] = gas_reading._RED.value * (gas_reading._RED.reference_voltage/65535)
+    latest["NH3"] = gas_reading._NH3.value * (gas_reading._NH3.reference_voltage/65535)
+    latest["OX_raw"] = gas_reading._OX.value
+    latest["RED_raw"] = gas_reading._RED.value
+    latest["NH3_raw"] = gas_reading._NH3.value
+
+def read_ltr559(latest):
+    latest["lux"] = ltr559.get_lux()
+
+async def every(seconds, read, latest):
+    # read a sensor into latest at its own cadence
+    while True:
+        read(latest)
+        await asyncio.sleep(seconds)
+
+async def read_pms5003(latest):
+    last = ticks_ms()
+    while True:
+        data = pms5003.poll()
+        if data is None:
+            if ticks_diff(ticks_ms(), last) > PMS5003_STALE_MS:
+                for k in PM_FIELDS:
+                    latest.pop(k, None)
+        else:
+            last = ticks_ms()
+            latest["pm1"] = data[0]
+            latest["pm2"] = data[1]
+            latest["pm10"] = data[2]
+            latest["pm1_atmos"] = data[0]
+            latest["pm2_atmos"] = data[1]
+            latest["pm10_atmos"] = data[2]
+        await asyncio.sleep(pms5003_poll)
+
+async def report(latest):
+    next_frame = ticks_add(ticks_ms(), interval * 1000)
+    while True:
+        await asyncio.sleep_ms(max(0, ticks_diff(next_frame, ticks_ms())))
+        next_frame = ticks_add(next_frame, interval * 1000)
+        readings = dict(latest)
+        rms = await sampler.rms()
+        if rms is not None:
+            # dB relative to full scale, the mic is not calibrated for SPL
+            readings["sound_level"] = rms
+            readings["sound_db"] = 20 * math.log10(max(rms, 1) / MIC_FULL_SCALE)
+        # as with the old busy loop, num_idle_loops of num_loops went to sampling the mic
+        readings["num_loops"], readings["num_idle_loops"], readings["loop_jitter_ms"] = sampler.restart()
+
+        if binary_frames and usb_cdc is not None and usb_cdc.console is not None:
+            usb_cdc.console.write(encode_frame(readings))
+        else:
+            print("BEGIN")
+            for k in readings.keys():
+                print("{}={}".format(k, readings[k]))
+            print("END")
+        # record the time that this reading was taken
+        last_reading = time.monotonic()
+        # Draw a label
+        text = "upd:{}".format(last_reading)
+        text_area = label.Label(terminalio.FONT, text=text, color=0xFFFF00, x=30, y=64)
+        splash[-1] = text_area
+        # collect now rather than have an automatic collection stall the sampling mid-frame
+        gc.collect()
+
+async def main():
+    latest = {}
+    tasks = [
+        asyncio.create_task(sampler.run()),
+        asyncio.create_task(every(bme280_interval, read_bme280, latest)),
+        asyncio.create_task(every(gas_interval, read_gas, latest)),
+        asyncio.create_task(every(ltr559_interval, read_ltr559, latest)),
+        asyncio.create_task(report(latest)),
+    ]
+    if pms5003 is not None:
+        tasks.append(asyncio.create_task(read_pms5003(latest)))
+    await asyncio.gather(*tasks)
+
 splash = initialise_screen()
 # Create library object using our Bus I2C port
 i2c = busio.I2C(board.SCL, board.SDA)
@@ -96,7 +342,8 @@ i2c = busio.I2C(board.SCL, board.SDA)
 # pressure, humidity, temp
 bme280 = initialise_bme280(i2c)
 # particulates
-pms5003 = initialise_pms5003()
+pms5003_uart = busio.UART(board.TX, board.RX, baudrate=9600, receiver_buffer_size=128)
+pms5003 = initialise_pms5003(pms5003_uart)
 # gas needs no initialisation
 # proximity and light 
 ltr559 = initialise_ltr559()
@@ -104,69 +351,9 @@ ltr559 = initialise_ltr559()
 # microphone
 # set up mic input
 mic = analogio.AnalogIn(pimoroni_physical_feather_pins.pin8())
+sampler = MicSampler(mic, mic_rate, mic_window)
 
 # The sensor will need a moment to gather initial readings
 time.sleep(1)
 
-# record the time that the sampling starts
-last_reading = time.monotonic()
-last_sec = time.monotonic()
-num_idle_loops=0
-num_loops=0
-cum_noise=0
-while True:
-    num_loops+=1
-    # if 1 second has passed
-    # if interval time has passed since last reading
-    if last_reading + interval < time.monotonic():
-        # take readings
-        # take the light reading
-        readings={}
-        readings["lux"] = ltr559.get_lux()
-        # temp etc
-        readings["ucontroller_cpu_temp"] = microcontroller.cpu.temperature
-        readings["temperature"] = bme280.temperature
-        readings["pressure"] = bme280.pressure
-        readings["humidity"] = bme280.humidity
-        #altitude = bme280.altitude # uncomment for altitude estimation
-        # gases
-        gas_reading = gas.read_all()
-        readings["OX"]=gas_reading._OX.value * (gas_reading._OX.reference_voltage/65535)
-        readings["RED"]=gas_reading._RED.value * (gas_reading._RED.reference_voltage/65535)
-        readings["NH3"]=gas_reading._NH3.value * (gas_reading._NH3.reference_voltage/65535)
-        readings["OX_raw"]=gas_reading._OX.value
-        readings["RED_raw"]=gas_reading._RED.value
-        readings["NH3_raw"]=gas_reading._NH3.value
-
-        # get the sound readings (number of samples over the threshold / total number of samples taken) and apply a logarithm function to them to represent human hearing
-        readings["sound_level"] = cum_noise/num_idle_loops
-        readings["num_loops"] = num_loops
-        readings["num_idle_loops"] = num_idle_loops
-
-        if pms5003 is not None:
-            # take readings
-            pms_reading = pms5003.read()
-            readings["pm1"] = pms_reading.data[0]
-            readings["pm2"] = pms_reading.data[1]
-            readings["pm10"] = pms_reading.data[2]
-            readings["pm1_atmos"] = pms_reading.data[0]
-            readings["pm2_atmos"] = pms_reading.data[1]
-            readings["pm10_atmos"] = pms_reading.data[2]
-        print("BEGIN")
-        for k in readings.keys():
-            print("{}={}".format(k, readings[k]))
-        print("END")
-        # record the time that this reading was taken
-        last_reading = time.monotonic()
-        # Draw a label
-        text = "upd:{}".format(last_reading)
-        text_area = label.Label(terminalio.FONT, text=text, color=0xFFFF00, x=30, y=64)
-        splash[-1] = text_area
-        num_idle_loops=0
-        num_loops=0
-        cum_noise=0
-    else:
-        cum_noise += abs(mic.value-32768)
-        num_idle_loops+=1
-    # update the last_sec time
-
+asyncio.run(main())
@@ -0,0 +1,245 @@
+## Derived metrics from calibration tables
+# Turns what the board sends into the values we actually want: temperature
+# compensated for the heat of the Feather, dew point, humidity at the true
+# air temperature, and NO2/CO/NH3 in ppm from the MICS6814 voltages. Each
+# formula is written once against a math-like namespace, so the collector
+# applies it per frame with math and the bulk commands apply it with NumPy to
+# whole columns of history, giving identical values.
+#
+# Calibration lives in a JSON file keyed by board location, each entry
+# overriding the built-in defaults (r0 and curves one gas at a time):
+#
+#   {"default": {"temp_factor": 2.25},
+#    "driveway": {"r0": {"OX": 23400, "RED": 180000, "NH3": 81000}}}
+#
+# After a recalibration, rewrite the derived fields of past data in influx
+# (points keep their time and tags, so only the derived fields change), or
+# add them to an archive.py export:
+#
+# python3 derived.py influx --start 2022-06-01 --end 2022-09-01 --calibration calibration.json
+# python3 derived.py archive --out archive --start 2022-06-01 --end 2022-09-01 --location driveway
+#
+import argparse
+import copy
+import json
+import logging
+import math
+import os
+import time
+
+# fields the formulas read, and the ones they produce
+INPUTS = ("temperature", "humidity", "ucontroller_cpu_temp", "real_temp", "OX", "RED", "NH3")
+DERIVED = ("temperature_compensated", "dew_point", "humidity_compensated", "no2_ppm", "co_ppm", "nh3_ppm")
+GASES = (("OX", "no2_ppm"), ("RED", "co_ppm"), ("NH3", "nh3_ppm"))
+
+DEFAULTS = {
+    # compensated = temperature - (cpu temperature - temperature) / temp_factor - temp_offset,
+    # the correction Pimoroni suggest for a sensor next to a warm board; 0 to skip it
+    "temp_factor": 2.25,
+    "temp_offset": 0.0,
+    # MICS6814 in a divider with load_ohms from vref: Rs = V * load / (vref - V)
+    "vref": 3.3,
+    "load_ohms": 56000.0,
+    # sensor resistance in clean air, to be measured per board
+    "r0": {"OX": 20000.0, "RED": 200000.0, "NH3": 75000.0},
+    # ppm = a * (Rs / R0) ** b, fitted to the MICS6814 datasheet curves
+    "curves": {"OX": [0.1516, 0.9979], "RED": [4.4638, -1.177], "NH3": [0.6151, -1.903]},
+}
+
+# Magnus formula coefficients (Sonntag 1990), good from -45 to 60 C
+MAGNUS_B = 17.62
+MAGNUS_C = 243.12
+
+
+def compensated_temperature(temp, cpu, cal):
+    if cal["temp_factor"]:
+        temp = temp - (cpu - temp) / cal["temp_factor"]
+    return temp - cal["temp_offset"]
+
+
+def dew_point(temp, rh, xp=math):
+    g = xp.log(rh / 100.0) + MAGNUS_B * temp / (MAGNUS_C + temp)
+    return MAGNUS_C * g / (MAGNUS_B - g)
+
+
+def relative_humidity(temp, dew, xp=math):
+    """Relative humidity at temp of air with the given dew point."""
+    return 100.0 * xp.exp(MAGNUS_B * dew / (MAGNUS_C + dew) - MAGNUS_B * temp / (MAGNUS_C + temp))
+
+
+def gas_ppm(volts, gas, cal):
+    rs = volts * cal["load_ohms"] / (cal["vref"] - volts)
+    a, b = cal["curves"][gas]
+    return a * (rs / cal["r0"][gas]) ** b
+
+
+class Calibration(object):
+    """Calibration tables by board location, with the defaults filling the gaps."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tables = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                self.tables = json.load(f)
+        elif path:
+            logging.info("No calibration file %s, using the default calibration", path)
+        self.cache = {}
+
+    def for_location(self, location):
+        cal = self.cache.get(location)
+        if cal is None:
+            cal = copy.deepcopy(DEFAULTS)
+            for name in ("default", location):
+                for key, value in self.tables.get(name, {}).items():
+                    if isinstance(value, dict):
+                        cal[key].update(value)
+                    else:
+                        cal[key] = value
+            self.cache[location] = cal
+        return cal
+
+    def for_tags(self, tags):
+        return self.for_location(tags.get("location", "default"))
+
+
+def derive(fields, cal):
+    """Derived fields for one frame, those its fields have the inputs for."""
+    derived = {}
+    temp = fields.get("temperature")
+    rh = fields.get("humidity")
+    cpu = fields.get("ucontroller_cpu_temp")
+    if temp is not None and cpu is not None:
+        derived["temperature_compensated"] = compensated_temperature(temp, cpu, cal)
+    if temp is not None and rh is not None and 0 < rh <= 100:
+        # the dew point is the same at the sensor and in the air around it
+        dew = dew_point(temp, rh)
+        derived["dew_point"] = dew
+        air = fields.get("real_temp", derived.get("temperature_compensated"))
+        if air is not None:
+            derived["humidity_compensated"] = min(100.0, relative_humidity(air, dew))
+    for gas, name in GASES:
+        volts = fields.get(gas)
+        if volts is not None and 0 < volts < cal["vref"]:
+            derived[name] = gas_ppm(volts, gas, cal)
+    return derived
+
+
+def derive_columns(columns, cal):
+    """derive() for whole columns: NumPy arrays by field name, NaN where a reading lacked it."""
+    import numpy as np
+    nan = np.full(len(next(iter(columns.values()))), np.nan)
+    temp, rh, cpu, real_temp = (columns.get(f, nan) for f in ("temperature", "humidity",
+                                                              "ucontroller_cpu_temp", "real_temp"))
+    derived = {}
+    with np.errstate(all="ignore"):
+        compensated = compensated_temperature(temp, cpu, cal)
+        derived["temperature_compensated"] = compensated
+        dew = dew_point(temp, np.where((rh > 0) & (rh <= 100), rh, np.nan), np)
+        derived["dew_point"] = dew
+        air = np.where(np.isnan(real_temp), compensated, real_temp)
+        derived["humidity_compensated"] = np.minimum(100.0, relative_humidity(air, dew, np))
+        for gas, name in GASES:
+            volts = columns.get(gas, nan)
+            derived[name] = gas_ppm(np.where((volts > 0) & (volts < cal["vref"]), volts, np.nan), gas, cal)
+    return derived
+
+
+def apply_influx(client, writer, calibration, measurement, start, end, page_size=5000, location=None):
+    """Rewrite the derived fields of every point from start to end (ns); returns the points written."""
+    import numpy as np
+    from influx_history import pages
+    tag_keys = [row["tagKey"] for row in client.query('show tag keys from "{}"'.format(measurement)).get_points()]
+    written = 0
+    for page in pages(client, measurement, start, end, page_size, location, INPUTS + tuple(tag_keys)):
+        series = {}
+        for row in page:
+            series.setdefault(tuple(row.get(k) for k in tag_keys), []).append(row)
+        lines = []
+        for values, rows in series.items():
+            tags = dict((k, v) for k, v in zip(tag_keys, values) if v is not None)
+            columns = dict((f, np.array([row.get(f) for row in rows], dtype=np.float64)) for f in INPUTS)
+            derived = derive_columns(columns, calibration.for_tags(tags))
+            prefix = writer.encoder.prefix(measurement, tags)
+            names = list(derived)
+            for row, result in zip(rows, np.column_stack([derived[n] for n in names]).tolist()):
+                parts = ["{}={!r}".format(n, v) for n, v in zip(names, result) if v == v]
+                if parts:
+                    lines.append("{} {} {}".format(prefix, ",".join(parts), row["time"] // 1000000000))
+        if lines and not writer.write(lines):
+            raise RuntimeError("influx write failed after {} points, run again to carry on".format(written))
+        written += len(lines)
+        print("{:>9} points rewritten, up to {}".format(written, time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime(page[-1]["time"] // 1000000000))))
+    return written
+
+
+def apply_archive(archive, cal, start=None, end=None):
+    """Add the derived fields to each archived day as <field>.npy; returns the days updated."""
+    import numpy as np
+    from archive import day_name
+    days = archive.days(start, end)
+    for day in days:
+        columns = dict((f, archive.day(day, f)[1]) for f in INPUTS)
+        directory = os.path.join(archive.path, day_name(day))
+        for name, values in derive_columns(columns, cal).items():
+            if np.isnan(values).all():
+                # as archive.py does for fields never sent that day
+                continue
+            tmp = os.path.join(directory, name + ".tmp.npy")
+            np.save(tmp, values)
+            os.replace(tmp, os.path.join(directory, name + ".npy"))
+    return len(days)
+
+
+def main():
+    from influx_history import parse_time
+    parser = argparse.ArgumentParser(description='Reapply the calibration to historical data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    influx_parser = commands.add_parser("influx", help="rewrite the derived fields stored in influx")
+    influx_parser.add_argument('--dbhost', dest='dbhost', required=False, default="babbage.local",
+                               help="The IP or resolvable hostname of the influx data base")
+    influx_parser.add_argument('--dbport', dest='port', required=False, default=8086, type=int,
+                               help="The port number for the influx data base")
+    influx_parser.add_argument("--user", dest='user', required=False, default="enviropi")
+    influx_parser.add_argument("--password", dest='password', required=False, default="enviropi")
+    influx_parser.add_argument("--dbname", dest='dbname', required=False, default="enviro_sensor_data")
+    influx_parser.add_argument("--measurement", dest='measurement', required=False, default="environmental")
+    influx_parser.add_argument("--location", dest='location', required=False, default=None,
+                               help="only rewrite points with this location tag, e.g. driveway")
+    influx_parser.add_argument("--page-size", dest='page_size', required=False, type=int, default=5000,
+                               help="points read and written per request")
+
+    archive_parser = commands.add_parser("archive", help="add the derived fields to an archive.py export")
+    archive_parser.add_argument("--out", dest='out', required=False, default="archive",
+                                help="archive directory")
+    archive_parser.add_argument("--location", dest='location', required=False, default="default",
+                                help="location whose calibration applies to the archive")
+
+    for sub in (influx_parser, archive_parser):
+        sub.add_argument("--calibration", dest='calibration', required=False, default="calibration.json",
+                         help="calibration tables, see the top of derived.py")
+        sub.add_argument("--start", dest='start', required=True, type=parse_time,
+                         help="epoch seconds or YYYY-MM-DD[THH:MM:SSZ]")
+        sub.add_argument("--end", dest='end', required=True, type=parse_time)
+    args = parser.parse_args()
+    calibration = Calibration(args.calibration)
+    started = time.monotonic()
+
+    if args.command == "influx":
+        from influxdb import InfluxDBClient
+        from influx_batch import BatchWriter
+        client = InfluxDBClient(args.dbhost, args.port, args.user, args.password, args.dbname)
+        written = apply_influx(client, BatchWriter(client), calibration, args.measurement,
+                               args.start, args.end, args.page_size, args.location)
+        print("Rewrote derived fields of {} points in {:.1f}s".format(written, time.monotonic() - started))
+    else:
+        from archive import Archive
+        days = apply_archive(Archive(args.out), calibration.for_location(args.location),
+                             args.start // 1000000000, args.end // 1000000000)
+        print("Derived fields added to {} days in {:.1f}s".format(days, time.monotonic() - started))
+
+
+if __name__ == "__main__":
+    main()
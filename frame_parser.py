@@ -0,0 +1,313 @@
+## Serial frame parser
+# Parses the BEGIN / key=value / END frames printed by code.py from a
+# preallocated receive buffer, filled with readinto() rather than one
+# readline() allocation per line, into Reading records with a fixed slot per
+# known field.
+#
+# code.py can instead send binary frames (binary_frames = True), which are
+# detected by their sync word and may be mixed with text on the same port:
+#
+#   sync    2 bytes  0xA5 0x5A
+#   version 1 byte   BINARY_VERSION
+#   length  1 byte   bytes of bitmap + values
+#   bitmap  4 bytes  little endian, bit i set if FIELDS[i] is present
+#   values           little endian, BINARY_FORMATS[i] for each present field
+#   crc     2 bytes  big endian CRC-16/CCITT (init 0xFFFF) of version..values
+#
+import binascii
+import logging
+import struct
+from array import array
+
+# the fields code.py prints, plus the DS18B20 reading added on the Pi; new
+# fields go at the end so older boards' binary frames still decode
+FIELDS = (
+    "lux", "ucontroller_cpu_temp", "temperature", "pressure", "humidity",
+    "OX", "RED", "NH3", "OX_raw", "RED_raw", "NH3_raw",
+    "sound_level", "num_loops", "num_idle_loops",
+    "pm1", "pm2", "pm10", "pm1_atmos", "pm2_atmos", "pm10_atmos",
+    "real_temp",
+    "sound_db", "loop_jitter_ms",
+)
+FIELD_INDEX = dict((name, i) for i, name in enumerate(FIELDS))
+
+# struct format of each field in binary frames, in FIELDS order; this has to
+# match BINARY_FORMATS in code.py
+BINARY_FORMATS = "ffffffffHHHfIIHHHHHHffH"
+BINARY_SYNC = b"\xa5\x5a"
+BINARY_VERSION = 1
+_ZEROS = array('d', [0.0] * len(FIELDS))
+
+
+class Reading(object):
+    """One frame of sensor values.
+
+    Known fields live in a fixed array of doubles with bitmasks recording
+    which are present and which were sent as integers; anything else goes to
+    the extra dict.
+    """
+
+    __slots__ = ("values", "present", "ints", "extra", "time")
+
+    def __init__(self):
+        self.values = array('d', _ZEROS)
+        self.present = 0
+        self.ints = 0
+        self.extra = None
+        self.time = None
+
+    def set(self, name, value):
+        i = FIELD_INDEX.get(name)
+        if i is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+            return
+        self._set(i, value)
+
+    def _set(self, i, value):
+        bit = 1 << i
+        self.values[i] = value
+        self.present |= bit
+        if isinstance(value, int):
+            self.ints |= bit
+        else:
+            self.ints &= ~bit
+
+    def get(self, name, default=None):
+        i = FIELD_INDEX.get(name)
+        if i is None:
+            return self.extra.get(name, default) if self.extra else default
+        bit = 1 << i
+        if not self.present & bit:
+            return default
+        if self.ints & bit:
+            return int(self.values[i])
+        return self.values[i]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def fields(self):
+        """The reading as a fields dict, as the sinks expect it."""
+        result = {}
+        present = self.present
+        values = self.values
+        for i, name in enumerate(FIELDS):
+            bit = 1 << i
+            if present & bit:
+                result[name] = int(values[i]) if self.ints & bit else values[i]
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+
+class FrameParser(object):
+    """Incremental text and binary frame parser working on a reusable bytearray."""
+
+    def __init__(self, size=4096, max_line=512):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.max_line = max_line
+        self.reading = None
+        self.frames = 0
+        self.binary_frames = 0
+        self.crc_failures = 0
+        self.decode_failures = 0
+        self.stray_lines = 0
+        self.layouts = {}
+
+    def read_from(self, port):
+        """Read what the port has waiting (at least one byte) and parse it.
+
+        Returns the list of readings completed by the new data.
+        """
+        if self.end == len(self.buf):
+            self._compact()
+        want = min(max(1, port.in_waiting), len(self.buf) - self.end)
+        n = port.readinto(self.view[self.end:self.end + want])
+        if n:
+            self.end += n
+        return self._parse()
+
+    def feed(self, data):
+        """Parse bytes that were read elsewhere."""
+        readings = []
+        data = memoryview(data)
+        while len(data):
+            if self.end == len(self.buf):
+                self._compact()
+            n = min(len(data), len(self.buf) - self.end)
+            self.buf[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            readings.extend(self._parse())
+        return readings
+
+    def reset(self):
+        """Forget buffered bytes and any partial frame, e.g. after a reconnect."""
+        self.start = self.end = 0
+        self.reading = None
+
+    def _compact(self):
+        pending = self.end - self.start
+        if pending >= self.max_line or pending == len(self.buf):
+            # no newline in sight, the line is garbage
+            self._failed(str(self.view[self.start:self.end], "utf-8", "replace"))
+            self.start = self.end = 0
+            return
+        self.buf[0:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def _parse(self):
+        readings = []
+        buf = self.buf
+        while self.start < self.end:
+            sync = buf.find(BINARY_SYNC, self.start, self.end)
+            if sync < 0:
+                last = buf.rfind(b"\n", self.start, self.end)
+                if last >= 0:
+                    self._parse_text(self.start, last, readings)
+                    self.start = last + 1
+                break
+            if sync > self.start:
+                # text up to the binary frame, an unterminated tail is garbage
+                self._parse_text(self.start, sync, readings)
+                self.start = sync
+            size = self._parse_binary(sync, readings)
+            if size == 0:
+                break
+            self.start = sync + size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return readings
+
+    def _layout(self, bitmap):
+        layout = self.layouts.get(bitmap)
+        if layout is None:
+            indices = [i for i in range(32) if bitmap & (1 << i)]
+            if indices and indices[-1] >= len(BINARY_FORMATS):
+                return None
+            formats = "".join(BINARY_FORMATS[i] for i in indices)
+            ints = 0
+            for i in indices:
+                if BINARY_FORMATS[i] != "f":
+                    ints |= 1 << i
+            layout = (struct.Struct("<" + formats), indices, ints)
+            self.layouts[bitmap] = layout
+        return layout
+
+    def _parse_binary(self, p, readings):
+        """Decode the binary frame at p, returning the bytes used or 0 if it is incomplete."""
+        buf = self.buf
+        if self.end - p < 4:
+            return 0
+        version = buf[p + 2]
+        length = buf[p + 3]
+        total = 4 + length + 2
+        if self.end - p < total:
+            return 0
+        if version != BINARY_VERSION or length < 4:
+            self._binary_failed("unsupported version {} length {}".format(version, length))
+            return 2
+        crc = (buf[p + 4 + length] << 8) | buf[p + 5 + length]
+        if binascii.crc_hqx(self.view[p + 2:p + 4 + length], 0xFFFF) != crc:
+            self.crc_failures += 1
+            self._binary_failed("CRC mismatch")
+            return 2
+        bitmap = int.from_bytes(buf[p + 4:p + 8], "little")
+        layout = self._layout(bitmap)
+        if layout is None or layout[0].size != length - 4:
+            self._binary_failed("bad field bitmap {:#010x}".format(bitmap))
+            return 2
+        unpacker, indices, ints = layout
+        reading = Reading()
+        values = reading.values
+        for i, value in zip(indices, unpacker.unpack_from(buf, p + 8)):
+            if not ints & (1 << i):
+                # drop the float32 noise, e.g. 18.200000762939453
+                value = float("%.7g" % value)
+            values[i] = value
+        reading.present = bitmap
+        reading.ints = ints
+        readings.append(reading)
+        self.frames += 1
+        self.binary_frames += 1
+        return total
+
+    def _binary_failed(self, reason):
+        self.decode_failures += 1
+        logging.warning("binary frame dropped: %s", reason)
+
+    def _parse_text(self, start, last, readings):
+        # decode all the lines in one go; per-line work on str is cheaper in
+        # CPython than on bytes (float(bytes) decodes internally)
+        lines = str(self.view[start:last], "utf-8", "replace").split("\n")
+        reading = self.reading
+        key_index = FIELD_INDEX
+        if reading is not None:
+            values, present, ints = reading.values, reading.present, reading.ints
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if reading is None:
+                if line == "BEGIN":
+                    reading = Reading()
+                    values, present, ints = reading.values, 0, 0
+                else:
+                    self.stray_lines += 1
+                    logging.debug("data outside of BEGIN/END: %s", line)
+                continue
+            key, _, value = line.partition("=")
+            if not value:
+                if line == "END":
+                    reading.present = present
+                    reading.ints = ints
+                    readings.append(reading)
+                    self.frames += 1
+                    reading = None
+                elif line == "BEGIN":
+                    logging.warning("BEGIN inside a frame, discarding the partial frame")
+                    self.decode_failures += 1
+                    reading = Reading()
+                    values, present, ints = reading.values, 0, 0
+                else:
+                    self._failed(line)
+                continue
+            if not key or "=" in value:
+                self._failed(line)
+                continue
+            try:
+                if "." in value:
+                    value = float(value)
+                    is_int = False
+                else:
+                    value = int(value)
+                    is_int = True
+            except ValueError as e:
+                self._failed(line, e)
+                continue
+            i = key_index.get(key)
+            if i is None:
+                reading.set(key, value)
+                continue
+            bit = 1 << i
+            values[i] = value
+            present |= bit
+            if is_int:
+                ints |= bit
+            else:
+                ints &= ~bit
+        if reading is not None:
+            # a frame split across reads carries on next time
+            reading.present = present
+            reading.ints = ints
+        self.reading = reading
+
+    def _failed(self, line, e=None):
+        self.decode_failures += 1
+        logging.warning("decode failed: [%s] exception [%s]", line, e)
@@ -0,0 +1,141 @@
+## Liveness, readiness and the systemd watchdog
+# The collector is live while its main loop keeps turning, frames keep
+# arriving and no sink worker is stuck inside a single send or tick. Under
+# systemd (Type=notify, WatchdogSec=) a thread pings the watchdog only while
+# that holds, so a hung or spinning collector is killed and restarted by
+# systemd rather than surviving until someone notices. The same checks are
+# served at /healthz and /readyz next to /metrics.
+#
+# sd_notify is spoken directly over $NOTIFY_SOCKET, no python-systemd needed.
+#
+import logging
+import os
+import socket
+import threading
+import time
+
+
+def sd_notify(state):
+    """Send a state such as "READY=1" to systemd; False when not started by systemd."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address[0] == "@":
+        # abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode("utf-8"))
+    except OSError as e:
+        logging.warning("sd_notify %s failed: %s", state, e)
+        return False
+    return True
+
+
+def watchdog_interval():
+    """Seconds between watchdog pings, half of WatchdogSec, or None if the watchdog is off."""
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 2e6
+
+
+class Health(object):
+    """What the collector has to keep doing to count as live.
+
+    frame_timeout: seconds without a frame from any board (from startup
+    until the first one), 0 to not check
+    sink_timeout: seconds a sink worker may spend in one send or tick
+    loop_timeout: seconds the main loop may go without calling beat()
+    """
+
+    def __init__(self, pipeline, frame_timeout=60, sink_timeout=600, loop_timeout=30):
+        self.pipeline = pipeline
+        self.frame_timeout = frame_timeout
+        self.sink_timeout = sink_timeout
+        self.loop_timeout = loop_timeout
+        self.started = time.monotonic()
+        self.loop_beat = self.started
+        self.last_frame = None
+        self.frames = 0
+        self.ready = False
+
+    def beat(self):
+        """Called by the main loop on every pass."""
+        self.loop_beat = time.monotonic()
+
+    def frame(self):
+        self.last_frame = time.monotonic()
+        self.frames += 1
+
+    def problems(self):
+        """Reasons the collector is not live, empty if it is."""
+        now = time.monotonic()
+        problems = []
+        if now - self.loop_beat > self.loop_timeout:
+            problems.append("main loop stalled for {:.0f}s".format(now - self.loop_beat))
+        if self.frame_timeout:
+            since = now - (self.last_frame or self.started)
+            if since > self.frame_timeout:
+                problems.append("no frames for {:.0f}s".format(since))
+        for worker in self.pipeline.workers:
+            if not worker.is_alive():
+                if worker.ident is not None:
+                    problems.append("{} sink worker exited".format(worker.sink))
+                continue
+            busy_since = worker.busy_since
+            if busy_since is not None and now - busy_since > self.sink_timeout:
+                problems.append("{} sink stuck for {:.0f}s".format(worker.sink, now - busy_since))
+        return problems
+
+    def is_ready(self):
+        """Live, set up and with every sink opened, i.e. frames are being delivered."""
+        return self.ready and all(worker.opened for worker in self.pipeline.workers) and not self.problems()
+
+    def status(self):
+        problems = self.problems()
+        return {
+            "live": not problems,
+            "ready": self.is_ready(),
+            "problems": problems,
+            "frames": self.frames,
+            "last_frame_age": None if self.last_frame is None else round(time.monotonic() - self.last_frame, 1),
+            "uptime": round(time.monotonic() - self.started, 1),
+        }
+
+
+class Watchdog(threading.Thread):
+    """Ping the systemd watchdog every interval seconds while health reports live."""
+
+    def __init__(self, health, interval):
+        threading.Thread.__init__(self, name="watchdog", daemon=True)
+        self.health = health
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.pings = 0
+        self.withheld = 0
+
+    def run(self):
+        reported = []
+        while not self.stopping.wait(self.interval):
+            problems = self.health.problems()
+            if problems:
+                # systemd restarts us once WatchdogSec passes without a ping
+                self.withheld += 1
+                if not reported:
+                    logging.error("Unhealthy, withholding watchdog ping: %s", "; ".join(problems))
+                sd_notify("STATUS=Unhealthy: {}".format("; ".join(problems)))
+            else:
+                if reported:
+                    logging.info("Healthy again, resuming watchdog pings")
+                sd_notify("WATCHDOG=1\nSTATUS={} frames".format(self.health.frames))
+                self.pings += 1
+            reported = problems
+
+    def stop(self):
+        self.stopping.set()
+
+    def stats(self):
+        return {"pings": self.pings, "withheld": self.withheld}
@@ -0,0 +1,117 @@
+## Shared keep-alive HTTP sessions for the upload sinks
+# One requests.Session per host so TCP/TLS connections are reused between
+# uploads, a timeout on every request so a dead uplink cannot hang a sink
+# worker, and retries with jittered exponential backoff. requests is only
+# imported when the first session is made, keeping it off the collector's
+# startup path.
+#
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+def _not_connected(e):
+    """Whether a requests ConnectionError happened before any connection was made."""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class HttpPool(object):
+    """Per-host keep-alive sessions with timeouts and retry.
+
+    Failures to connect are retried for every method, since nothing reached
+    the server. Other connection errors (the connection reset or aborted
+    once the request may have been sent), read timeouts and 502/503/504
+    responses are only retried for idempotent methods, so a POST is never
+    submitted twice by a retry.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=20, retries=2, backoff=0.5, max_backoff=10, pool_size=2):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.retried = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        parts = urlsplit(url)
+        host = "{}://{}".format(parts.scheme, parts.netloc)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(host, adapter)
+                self.sessions[host] = session
+                self.retried[host] = 0
+        return host, session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        host, session = self.session(url)
+        import requests
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if (not idempotent and not _not_connected(e)) or attempt >= self.retries:
+                    raise
+                logging.debug("%s %s connection failed, retrying: %s", method, url, e)
+            except requests.exceptions.Timeout as e:
+                if not idempotent or attempt >= self.retries:
+                    raise
+                logging.debug("%s %s timed out, retrying: %s", method, url, e)
+            else:
+                if not idempotent or response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                logging.debug("%s %s returned %s, retrying", method, url, response.status_code)
+                response.close()
+            attempt += 1
+            self.retried[host] += 1
+            # full jitter keeps several sinks from retrying in lockstep
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def stats(self):
+        """Requests made and connections opened per host, from the urllib3 pools."""
+        result = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            adapter = session.get_adapter(host)
+            requests_made = 0
+            connections = 0
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    requests_made += pool.num_requests
+                    connections += pool.num_connections
+            result[host] = {
+                "requests": requests_made,
+                "connections": connections,
+                "reused": requests_made - connections,
+                "retries": self.retried[host],
+            }
+        return result
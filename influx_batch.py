@@ -0,0 +1,213 @@
+## Batched InfluxDB writer
+# Buffers points and writes them as one line-protocol body when either the
+# batch size or the age of the oldest buffered point reaches its threshold.
+# Compression is left to InfluxDBClient(gzip=True). requests and influxdb are
+# imported on the first write, keeping them off the collector's startup path.
+# NaN and infinite floats have no line protocol form and are left out, since
+# one of them would get the whole batch rejected.
+#
+import logging
+import math
+import time
+
+from frame_parser import FIELDS
+
+
+def _escape_key(key):
+    return str(key).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=")
+
+
+def _finite(value):
+    return not isinstance(value, float) or math.isfinite(value)
+
+
+def _escape_field(value):
+    # match influxdb.line_protocol so the field types in the database do not change
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+
+# per-field "key=" prefixes for encoding Reading slots directly
+_INT_FIELDS = tuple(_escape_key(name) + "=%di" for name in FIELDS)
+_FLOAT_FIELDS = tuple(_escape_key(name) + "=" for name in FIELDS)
+_BITS = tuple(1 << i for i in range(len(FIELDS)))
+
+
+class LineEncoder(object):
+    """Encode point dicts (as used by write_points) to line protocol strings.
+
+    The escaped measurement and tag prefix is cached, since every frame from a
+    board carries the same ones.
+    """
+
+    def __init__(self):
+        self._prefixes = {}
+
+    def prefix(self, measurement, tags):
+        key = (measurement, tuple(sorted(tags.items())))
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = _escape_key(measurement)
+            for k, v in key[1]:
+                if v is None or v == "":
+                    continue
+                prefix += ",{}={}".format(_escape_key(k), _escape_key(v))
+            self._prefixes[key] = prefix
+        return prefix
+
+    def encode(self, point):
+        """The point's line, or None if it has no fields to write."""
+        fields = ",".join("{}={}".format(_escape_key(k), _escape_field(v))
+                          for k, v in point["fields"].items() if v is not None and _finite(v))
+        if not fields:
+            return None
+        line = "{} {}".format(self.prefix(point["measurement"], point.get("tags") or {}), fields)
+        if point.get("time") is not None:
+            line += " {}".format(int(point["time"]))
+        return line
+
+    def encode_reading(self, prefix, reading, timestamp):
+        """Encode a frame_parser Reading straight from its slots, skipping the fields dict.
+
+        prefix comes from prefix(); returns None if the reading has no fields.
+        """
+        present = reading.present
+        ints = reading.ints
+        values = reading.values
+        parts = []
+        for i, bit in enumerate(_BITS):
+            if present & bit:
+                if ints & bit:
+                    parts.append(_INT_FIELDS[i] % values[i])
+                elif math.isfinite(values[i]):
+                    parts.append(_FLOAT_FIELDS[i] + repr(values[i]))
+        if reading.extra:
+            parts.extend("{}={}".format(_escape_key(k), _escape_field(v))
+                         for k, v in reading.extra.items() if v is not None and _finite(v))
+        if not parts:
+            return None
+        return "%s %s %d" % (prefix, ",".join(parts), timestamp)
+
+
+class BatchWriter(object):
+    """Buffer points for an InfluxDBClient and write them in batches.
+
+    Timestamps are expected in whole seconds, as produced by the collector.
+    Batches that fail because Influx is unreachable stay buffered and are
+    retried max_age later, up to max_buffer lines after which the oldest are
+    discarded, or handed to spill(lines) if given. Batches the server rejects
+    outright are discarded.
+
+    observe_latency, if given, is called for every point written with the
+    seconds since the point's "received" time.monotonic() stamp. client may
+    be set after construction, as long as it is before the first write.
+    """
+
+    def __init__(self, client, batch_size=60, max_age=60, max_buffer=5000, spill=None, observe_latency=None):
+        self.client = client
+        self.spill = spill
+        self.observe_latency = observe_latency
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.encoder = LineEncoder()
+        self.lines = []
+        self.received = []
+        self.oldest = None
+        self.retry_at = 0
+        self.written = 0
+        self.batches = 0
+        self.discarded = 0
+
+    def add(self, point):
+        line = self.encoder.encode(point)
+        if line is None:
+            return self.flush_if_due()
+        self.lines.append(line)
+        self.received.append(point.get("received"))
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(self.lines) > self.max_buffer:
+            overflow = len(self.lines) - self.max_buffer
+            del self.lines[:overflow]
+            del self.received[:overflow]
+            self.discarded += overflow
+            logging.warning("Influx buffer full, discarded %s points", overflow)
+        return self.flush_if_due()
+
+    def due(self):
+        if not self.lines or time.monotonic() < self.retry_at:
+            return False
+        return len(self.lines) >= self.batch_size or time.monotonic() - self.oldest >= self.max_age
+
+    def flush_if_due(self):
+        if self.due():
+            return self.flush()
+        return True
+
+    def write(self, lines):
+        """Write lines in one request, returning True, False to retry or None if rejected."""
+        import requests
+        from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+        try:
+            self.client.write_points(lines, time_precision='s', protocol='line')
+        except (ConnectionError, requests.exceptions.RequestException) as e:
+            logging.warning("Failed to connect to Influx with %s points - %s", len(lines), e)
+        except InfluxDBClientError as e:
+            if e.code == 404:
+                logging.error("Influx database not found, keeping %s points", len(lines))
+            else:
+                # the server rejected the data itself, resending it will not help
+                logging.error("Influx rejected batch of %s points - %s", len(lines), e)
+                self.discarded += len(lines)
+                return None
+        except InfluxDBServerError as e:
+            logging.error("Influx batch write of %s points failed - %s", len(lines), e)
+        else:
+            self.written += len(lines)
+            self.batches += 1
+            logging.debug("Wrote batch of %s points to Influx", len(lines))
+            return True
+        return False
+
+    def flush(self):
+        if not self.lines:
+            return True
+        lines = self.lines
+        result = self.write(lines)
+        if result and self.observe_latency is not None:
+            now = time.monotonic()
+            for received in self.received:
+                if received is not None:
+                    self.observe_latency(now - received)
+        if result is not False:
+            self._reset()
+            return bool(result)
+        if self.spill is not None:
+            self.spill(lines)
+            self._reset()
+        else:
+            # back off for max_age rather than retrying on every new point
+            self.retry_at = time.monotonic() + self.max_age
+        return False
+
+    def replay(self, lines):
+        """Resend spooled lines, returning how many no longer need sending."""
+        if self.write(lines) is False:
+            return 0
+        return len(lines)
+
+    def _reset(self):
+        self.lines = []
+        self.received = []
+        self.oldest = None
+        self.retry_at = 0
+
+    def close(self):
+        if not self.flush() and self.lines:
+            logging.error("Influx unreachable at shutdown, %s points not written", len(self.lines))
@@ -0,0 +1,66 @@
+## Reading history back out of Influx
+# Shared by the tools that work on the stored history (the luftdaten
+# backfill, the archive export, derived.py): time arguments and keyset
+# pagination of a measurement, so memory stays flat whatever the range.
+# Nothing here imports the influx client, callers pass their own.
+#
+import argparse
+import calendar
+import collections
+import time
+
+
+def parse_time(value):
+    """Nanoseconds since the epoch from epoch seconds, YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS[Z]."""
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt)) * 1000000000
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("cannot parse time '{}'".format(value))
+
+
+def _row_key(row):
+    return tuple(sorted(row.items()))
+
+
+def pages(client, measurement, start, end, page_size, location=None, fields=None, inclusive=False):
+    """Yield lists of up to page_size points with start < time < end, oldest first.
+
+    fields are the fields and tags to select, all of them by default. With
+    inclusive, points at start are yielded too. Several series can have
+    points at the same time, so each page is fetched from the time of the
+    last point yielded, skipping those rows already yielded at that time,
+    rather than from just after it.
+    """
+    columns = "*" if fields is None else ", ".join('"{}"'.format(f) for f in fields)
+    where = "" if location is None else " and \"location\" = '{}'".format(location.replace("'", "\\'"))
+    cursor = start
+    op = ">=" if inclusive else ">"
+    seen = collections.Counter()  # rows at the cursor time already yielded
+    while True:
+        skip = sum(seen.values())
+        query = 'select {} from {} where time {} {} and time < {}{} order by time asc limit {}'.format(
+            columns, measurement, op, cursor, end, where, page_size + skip)
+        rows = list(client.query(query, epoch='ns').get_points())
+        unseen = seen.copy()
+        page = []
+        for row in rows:
+            if row["time"] == cursor and unseen[_row_key(row)] > 0:
+                unseen[_row_key(row)] -= 1
+                continue
+            page.append(row)
+        if not page:
+            return
+        yield page
+        if page[-1]["time"] != cursor:
+            cursor = page[-1]["time"]
+            seen = collections.Counter()
+        seen.update(_row_key(row) for row in page if row["time"] == cursor)
+        op = ">="
+        if len(rows) < page_size + skip:
+            return
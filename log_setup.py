@@ -0,0 +1,163 @@
+## Asynchronous, rotating, coalescing logging
+# Log calls only put the record on a queue; a background thread formats it
+# and writes it to a file rotated by size (or time) whose old generations are
+# gzipped, so the serial loop never waits on the SD card and the log cannot
+# fill it. Use %-style arguments, logging.debug("frame %s", point), so that
+# nothing is formatted for records below the level, and the rest are
+# formatted by the writer thread. Arguments are formatted after the call
+# returns, so pass values that are not changed afterwards.
+#
+# A message repeated at WARNING or above (same logger, level and format
+# string, whatever its arguments) is written once, and the repeats within
+# the coalesce interval are summarised in one line when it ends, so a storm
+# of serial errors costs a couple of lines a minute rather than thousands.
+#
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+FORMAT = '%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s'
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+_STOP = object()
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def rotating_handler(path, max_bytes=5000000, backups=5, when=None):
+    """A file handler keeping backups gzipped generations, rotated at max_bytes or, if given, when."""
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups)
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+class _QueueHandler(logging.Handler):
+    # unlike logging.handlers.QueueHandler, leaves formatting to the writer
+    def __init__(self, log):
+        logging.Handler.__init__(self)
+        self.log = log
+
+    def emit(self, record):
+        self.log.enqueue(record)
+
+
+class AsyncLog(threading.Thread):
+    """Write records queued by the logging calls to handler, coalescing repeats.
+
+    Records are dropped, and counted, rather than blocking the caller if the
+    writer falls more than maxsize records behind.
+    """
+
+    def __init__(self, handler, coalesce_interval=60, coalesce_level=logging.WARNING, maxsize=10000):
+        threading.Thread.__init__(self, name="log-writer", daemon=True)
+        self.handler = handler
+        self.coalesce_interval = coalesce_interval
+        self.coalesce_level = coalesce_level
+        self.queue = queue.Queue(maxsize)
+        self.repeats = {}
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except queue.Empty:
+                record = None
+            if record is _STOP:
+                break
+            if record is not None:
+                self._handle(record)
+            self._summarise(time.monotonic())
+        self._summarise(None)
+        self.handler.close()
+
+    def _write(self, record):
+        try:
+            self.handler.handle(record)
+            self.written += 1
+        except Exception:
+            self.handler.handleError(record)
+
+    def _handle(self, record):
+        if not self.coalesce_interval or record.levelno < self.coalesce_level:
+            self._write(record)
+            return
+        key = (record.name, record.levelno, record.msg)
+        repeat = self.repeats.get(key)
+        if repeat is None:
+            self._write(record)
+            self.repeats[key] = [time.monotonic(), 0, None]
+            return
+        # [window start, repeats in the window, last repeat]
+        repeat[1] += 1
+        repeat[2] = record
+        self.coalesced += 1
+
+    def _summarise(self, now):
+        """Write a summary for every window that has ended, or all of them if now is None."""
+        for key, (start, count, last) in list(self.repeats.items()):
+            if now is not None and now - start < self.coalesce_interval:
+                continue
+            if not count:
+                del self.repeats[key]
+                continue
+            elapsed = (now or time.monotonic()) - start
+            summary = logging.makeLogRecord(dict(last.__dict__, exc_info=None, exc_text=None, args=None,
+                                                 msg="{} [repeated {} times in {:.0f}s]".format(
+                                                     last.getMessage(), count, elapsed)))
+            self._write(summary)
+            self.repeats[key] = [now or time.monotonic(), 0, None]
+
+    def stop(self):
+        """Write what is queued, summarise pending repeats and close the file."""
+        if self.is_alive():
+            self.queue.put(_STOP)
+            self.join(10)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=5000000, backups=5, when=None, coalesce_interval=60):
+    """Send the root logger's records through an AsyncLog to a rotating file; returns the AsyncLog.
+
+    The writer is flushed and stopped at interpreter exit.
+    """
+    handler = rotating_handler(path, max_bytes, backups, when)
+    handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    log = AsyncLog(handler, coalesce_interval)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(_QueueHandler(log))
+    root.setLevel(level)
+    log.start()
+    atexit.register(log.stop)
+    return log
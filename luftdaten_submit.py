@@ -0,0 +1,223 @@
+## Concurrent luftdaten submission for backfills
+# A reading goes to Sensor.Community as two requests, PM on X-PIN 1 and
+# temperature/humidity/pressure on X-PIN 11. Submitting them one after the
+# other is two round trips per reading; here a bounded pool of workers sends
+# them concurrently over keep-alive connections, paced by a token bucket so
+# the API sees a steady, limited request rate.
+#
+import datetime
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+LUFTDATEN_URL = "https://api.luftdaten.info/v1/push-sensor-data/"
+
+LUFT_MAP = {
+    "pm1":"P0",
+    "pm2":"P2",
+    "pm10":"P1",
+    "real_temp":"temperature",
+    "humidity":"humidity",
+    "pressure":"pressure"}
+
+# X-PIN and the fields sent with it
+PINS = (("1", ("pm1", "pm2", "pm10")), ("11", ("humidity", "pressure", "real_temp")))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def requests_for(values):
+    """The (pin, sensordatavalues) requests for one reading, as the collector and backfill send them."""
+    result = []
+    for pin, fields in PINS:
+        data = [{"value_type": LUFT_MAP[k], "value": values[k]}
+                for k in fields if values.get(k) is not None]
+        if data:
+            result.append((pin, data))
+    return result
+
+
+def push_body(data, when):
+    """The push-sensor-data body for sensordatavalues read at epoch second when."""
+    return {
+        "timestamp": datetime.datetime.fromtimestamp(when, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "software_version": "nhorlock/enviropi",
+        "sensordatavalues": data,
+    }
+
+
+class TokenBucket(object):
+    """Allow rate requests per second on average, with bursts of up to burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every worker back, e.g. for a 429's Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class LatencyRecorder(object):
+    """Request latencies, kept as a fixed-size uniform sample for percentiles."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            if len(self.samples) < self.size:
+                self.samples.append(seconds)
+            else:
+                i = random.randrange(self.count)
+                if i < self.size:
+                    self.samples[i] = seconds
+
+    def percentiles(self, which=(50, 90, 99)):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return dict(("p{}_ms".format(p), None) for p in which)
+        return dict(("p{}_ms".format(p), round(samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] * 1000, 1))
+                    for p in which)
+
+
+class Submitter(object):
+    """Send readings to luftdaten from a pool of workers under a rate limit.
+
+    Each of a reading's requests is retried on its own with the same
+    timestamp, so a retry resends the same data and the half that was
+    accepted is never sent again. 429 responses pause all workers for the
+    Retry-After the server asks for.
+
+    With an AckIndex, requests it has already seen accepted (within seconds
+    of the timestamp) are skipped and accepted ones are recorded in it.
+    """
+
+    def __init__(self, http_pool, sensor, url=LUFTDATEN_URL, workers=4, rate=5, burst=10,
+                 retries=3, backoff=1, max_backoff=60, index=None, within=0):
+        self.http_pool = http_pool
+        self.sensor = sensor
+        self.index = index
+        self.within = within
+        self.url = url
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency = LatencyRecorder()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="luftdaten")
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.skipped = 0
+
+    def post(self, pin, values, when):
+        """One push-sensor-data request for epoch second when, with retries; True once it is accepted."""
+        body = push_body(values, when)
+        timestamp = body["timestamp"]
+        headers = {
+            "X-PIN": pin,
+            "X-Sensor": self.sensor,
+            "Content-Type": "application/json",
+            "cache-control": "no-cache",
+        }
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            start = time.monotonic()
+            paused = False
+            try:
+                resp = self.http_pool.post(self.url, json=body, headers=headers)
+            except requests.exceptions.RequestException as e:
+                logging.debug("luftdaten %s %s failed: %s", pin, timestamp, e)
+                status = None
+            else:
+                self.latency.add(time.monotonic() - start)
+                status = resp.status_code
+                if resp.ok:
+                    with self.lock:
+                        self.sent += 1
+                    if self.index is not None:
+                        self.index.add(self.sensor, pin, when)
+                    return True
+                if status == 429:
+                    with self.lock:
+                        self.throttled += 1
+                    try:
+                        delay = float(resp.headers.get("Retry-After", ""))
+                    except ValueError:
+                        delay = None
+                    self.bucket.pause(delay if delay is not None else self.backoff * 2 ** attempt)
+                    paused = True
+                elif status not in RETRY_STATUSES:
+                    logging.warning("luftdaten rejected %s pin %s: %s %s", timestamp, pin, status, resp.text)
+                    break
+            if attempt >= self.retries:
+                break
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+            if not paused:
+                # a throttled request already waits out the pause in acquire()
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+        with self.lock:
+            self.failed += 1
+        logging.warning("luftdaten gave up on %s pin %s (last status %s)", timestamp, pin, status)
+        return False
+
+    def submit_many(self, readings):
+        """Submit (values, epoch seconds) pairs concurrently; returns a success flag per reading."""
+        futures = []
+        for values, when in readings:
+            parts = []
+            for pin, data in requests_for(values):
+                if self.index is not None and self.index.contains(self.sensor, pin, when, self.within):
+                    self.skipped += 1
+                    continue
+                parts.append(self.executor.submit(self.post, pin, data, when))
+            futures.append(parts)
+        return [all(f.result() for f in parts) for parts in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        stats = {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "skipped": self.skipped,
+        }
+        stats.update(self.latency.percentiles())
+        return stats
@@ -0,0 +1,259 @@
+## Collector instrumentation
+# Counters, gauges and fixed-bucket histograms cheap enough for the frame
+# loop and sink workers: an observation is a bisect and two additions, with
+# no locking (a rare lost increment under contention is acceptable here).
+# Values other components already count in their stats() are copied in by
+# collect callbacks when the metrics are read, so they cost nothing between
+# reads. Everything is served in the Prometheus text format and can be
+# turned into Influx points for the enviropi_internal measurement.
+#
+import json
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a fast local call to a slow upload
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+class _Value(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets(object):
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # bucket i counts values <= bounds[i], the last one the rest
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, an estimate."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class Metric(object):
+    """A named metric with a child per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        if not self.label_names:
+            self.children[()] = self._child()
+
+    def labels(self, *values):
+        """The child for these label values; keep it to skip the lookup on hot paths."""
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        return _Value()
+
+    # unlabelled metrics act as their only child
+    def inc(self, n=1):
+        self.children[()].inc(n)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            lines.append("{}{} {}".format(self.name, _labels(self.label_names, values), child.value))
+        return lines
+
+    def fields(self):
+        """(label values, {field: value}) pairs for Influx.
+
+        Always floats: a value that starts as an int and later becomes a
+        float would otherwise change the Influx field type and every later
+        write of the point would be rejected.
+        """
+        for values, child in self.children.items():
+            yield values, {self.name: float(child.value)}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, help, labels)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for values, child in sorted(self.children.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(self.label_names, values, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.label_names, values), child.sum))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.label_names, values), child.count))
+        return lines
+
+    def fields(self):
+        for values, child in self.children.items():
+            fields = {self.name + "_count": child.count, self.name + "_sum": child.sum}
+            if child.count:
+                for q in (0.5, 0.95, 0.99):
+                    # influx cannot store inf, past the last bucket reads as the last bound
+                    fields["{}_p{}".format(self.name, int(q * 100))] = float(min(child.quantile(q), self.buckets[-1]))
+            yield values, fields
+
+
+class Registry(object):
+    """The collector's metrics, plus callbacks that refresh them before every read."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def on_collect(self, callback):
+        self.collectors.append(callback)
+
+    def collect(self):
+        with self.lock:
+            for callback in self.collectors:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.warning("metrics collector failed: %s", e)
+
+    def expose(self):
+        """All metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def points(self, measurement, timestamp):
+        """The metrics as Influx points, one per label set, tagged with the labels."""
+        self.collect()
+        points = {}
+        for metric in self.metrics:
+            for values, fields in metric.fields():
+                tags = tuple(zip(metric.label_names, values))
+                point = points.get(tags)
+                if point is None:
+                    point = points[tags] = {"measurement": measurement, "tags": dict(tags),
+                                            "time": timestamp, "fields": {}}
+                point["fields"].update(fields)
+        return list(points.values())
+
+
+class MetricsServer(object):
+    """Serve a registry at /metrics for Prometheus on a background thread.
+
+    With a health.Health, /healthz and /readyz answer 200 or 503 with its
+    status as JSON, for liveness and readiness probes.
+    """
+
+    def __init__(self, registry, address="127.0.0.1", port=9108, health=None):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    self.reply(200, registry.expose(), "text/plain; version=0.0.4; charset=utf-8")
+                elif path in ("/healthz", "/readyz") and health is not None:
+                    status = health.status()
+                    ok = status["live"] if path == "/healthz" else status["ready"]
+                    self.reply(200 if ok else 503, json.dumps(status), "application/json")
+                else:
+                    self.send_error(404)
+
+            def reply(self, code, text, content_type):
+                body = text.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logging.info("Metrics at http://%s:%s/metrics", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
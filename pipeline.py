@@ -0,0 +1,185 @@
+## Fan-out pipeline between the serial reader and the upload sinks
+# The reader only parses frames and publishes them; each sink runs in its own
+# worker thread behind a bounded queue so a slow endpoint can never stall
+# ser.readline() or hold up the other sinks.
+#
+import logging
+import queue
+import threading
+import time
+
+# backpressure policies applied when a sink's queue is full
+DROP_OLDEST = "drop_oldest"   # discard the oldest queued frame, keep the newest
+DROP_NEWEST = "drop_newest"   # discard the frame being published
+BLOCK = "block"               # wait up to block_timeout, then drop the new frame
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+_STOP = object()
+
+
+class SinkWorker(threading.Thread):
+    """Deliver published frames to a single sink from a bounded queue.
+
+    open, if given, is called in the worker thread before anything is
+    delivered, so a sink's slow imports and connections never hold up the
+    publisher. tick, if given, is called every tick_interval seconds while
+    the queue is idle (e.g. to flush time-based batches) and close once the
+    queue has been drained at shutdown. observe_queue and observe_send, if
+    given, are called with the seconds each item waited in the queue and
+    spent in send.
+
+    busy_since is the time.monotonic() at which the current send or tick
+    began, None while the worker waits, so a hung sink can be spotted.
+    """
+
+    def __init__(self, name, send, maxsize=100, policy=DROP_OLDEST, block_timeout=1.0,
+                 open=None, tick=None, tick_interval=1.0, close=None, observe_queue=None, observe_send=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown backpressure policy '{}'".format(policy))
+        threading.Thread.__init__(self, name="sink-" + name, daemon=True)
+        self.sink = name
+        self.send = send
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.open = open
+        self.tick = tick
+        self.tick_interval = tick_interval
+        self.close = close
+        self.observe_queue = observe_queue
+        self.observe_send = observe_send
+        self.queue = queue.Queue(maxsize)
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.opened = False
+        self.busy_since = None
+
+    def offer(self, item):
+        """Queue an item without ever blocking the caller for longer than block_timeout."""
+        item = (item, time.monotonic())
+        try:
+            if self.policy == BLOCK:
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                pass
+        self.dropped += 1
+        logging.warning("%s queue full, dropped frame (%s dropped so far)", self.sink, self.dropped)
+        return False
+
+    def _call(self, hook):
+        try:
+            hook()
+        except Exception as e:
+            logging.error("%s sink raised: %s", self.sink, e)
+
+    def run(self):
+        timeout = self.tick_interval if self.tick is not None else None
+        if self.open is not None:
+            self._call(self.open)
+        self.opened = True
+        while True:
+            try:
+                item, queued = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.busy_since = time.monotonic()
+                self._call(self.tick)
+                self.busy_since = None
+                continue
+            try:
+                if item is _STOP:
+                    if self.close is not None:
+                        self._call(self.close)
+                    return
+                start = self.busy_since = time.monotonic()
+                if self.observe_queue is not None:
+                    self.observe_queue(start - queued)
+                result = self.send(item)
+                if self.observe_send is not None:
+                    self.observe_send(time.monotonic() - start)
+                if result is False:
+                    self.failed += 1
+                else:
+                    self.delivered += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error("%s sink raised: %s", self.sink, e)
+            finally:
+                self.busy_since = None
+                self.queue.task_done()
+
+    def request_stop(self, timeout=None):
+        """Ask the worker to exit once it has drained its queue; False if the queue stayed full."""
+        try:
+            self.queue.put((_STOP, None), timeout=timeout)
+        except queue.Full:
+            logging.warning("%s queue still full at shutdown, abandoning %s frames", self.sink, self.queue.qsize())
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        """Let the worker drain what is already queued, then exit."""
+        if self.request_stop(timeout):
+            self.join(timeout)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+class Pipeline(object):
+    """Fan each published frame out to every registered sink worker."""
+
+    def __init__(self):
+        self.workers = []
+
+    def add_sink(self, name, send, **kwargs):
+        worker = SinkWorker(name, send, **kwargs)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def publish(self, item, sinks=None):
+        """Offer item to every sink, or only to the named ones."""
+        for worker in self.workers:
+            if sinks is None or worker.sink in sinks:
+                worker.offer(item)
+
+    def stop(self, timeout=20):
+        """Drain every worker at once, giving up on them after timeout seconds in all.
+
+        Keep timeout below the service's TimeoutStopSec so the drain is not
+        cut short by SIGKILL.
+        """
+        deadline = time.monotonic() + timeout
+        stopping = [worker for worker in self.workers
+                    if worker.request_stop(max(0, deadline - time.monotonic()))]
+        for worker in stopping:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logging.warning("%s sink still busy at shutdown, abandoning %s frames",
+                                worker.sink, worker.queue.qsize())
+
+    def stats(self):
+        return dict((worker.sink, worker.stats()) for worker in self.workers)
@@ -0,0 +1,427 @@
+## Local time-series ring store
+# Keeps recent history on the Pi itself so it survives babbage.local being
+# down: a fixed-size memory-mapped ring file of raw readings, plus 1-minute
+# and 1-hour rollup rings (mean/min/max/count per field) maintained as the
+# readings arrive. Each ring is preallocated, so disk use is fixed by the
+# capacities. New records are buffered and written to the ring in one
+# sequential run every flush interval, then the header is updated, so the SD
+# card sees one small burst of writes per interval rather than one per
+# reading. A crash loses at most the unflushed interval and the open buckets;
+# a clean shutdown writes the open buckets too, and a restart within them
+# carries on filling them. Readings older than the newest one stored are
+# skipped, history belongs in Influx.
+#
+# python3 ring_store.py --path enviropi-ring/driveway --field pm2 --hours 6
+#
+import argparse
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+from bisect import bisect_left
+
+from frame_parser import FIELDS
+
+MAGIC = b"ENVRING1"
+HEADER = struct.Struct("<8sIIQQQ")  # magic, record size, fields, capacity, head, count
+HEADER_SIZE = mmap.PAGESIZE
+
+RAW = struct.Struct("<dI" + "d" * len(FIELDS))  # time, present bitmap, values
+ROLLUP = struct.Struct("<dI" + "fffH" * len(FIELDS))  # bucket start, present bitmap, mean/min/max/count per field
+
+MINUTE = 60
+HOUR = 3600
+TIERS = ("raw", "1m", "1h")
+
+
+class Ring(object):
+    """Fixed-size records in a preallocated, memory-mapped circular file.
+
+    A readonly ring takes its capacity from the file and follows the
+    writer's progress through refresh().
+    """
+
+    def __init__(self, path, record, capacity, readonly=False):
+        self.path = path
+        self.record = record
+        self.head = 0
+        self.count = 0
+        if readonly:
+            self.fd = os.open(path, os.O_RDONLY)
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            magic, record_size, fields, self.capacity, _, _ = HEADER.unpack_from(self.map, 0)
+            if (magic, record_size, fields) != (MAGIC, record.size, len(FIELDS)):
+                raise ValueError("{} is not a ring of this layout".format(path))
+            self.refresh()
+            return
+        self.capacity = capacity
+        size = HEADER_SIZE + record.size * capacity
+        exists = os.path.exists(path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = os.pread(self.fd, HEADER.size, 0) if exists else b""
+        if len(header) == HEADER.size:
+            magic, record_size, fields, saved_capacity, head, count = HEADER.unpack(header)
+            if (magic, record_size, fields, saved_capacity) == (MAGIC, record.size, len(FIELDS), capacity):
+                self.head = head
+                self.count = count
+            else:
+                logging.warning("Ring %s has another layout or capacity, starting it afresh", path)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self._write_header()
+
+    def refresh(self):
+        self.head, self.count = HEADER.unpack_from(self.map, 0)[4:6]
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.record.size, len(FIELDS), self.capacity, self.head, self.count)
+        self.map.flush(0, HEADER_SIZE)
+
+    def _sync(self, start, end):
+        # msync wants a page aligned start
+        start -= start % mmap.PAGESIZE
+        self.map.flush(start, end - start)
+
+    def append_many(self, records):
+        """Write packed records after the newest, wrapping over the oldest."""
+        if not records:
+            return
+        records = records[-self.capacity:]
+        size = self.record.size
+        data = b"".join(records)
+        n = len(records)
+        first = min(n, self.capacity - self.head)
+        # at most two sequential runs: up to the end of the file, then from the start
+        offset = HEADER_SIZE + self.head * size
+        self.map[offset:offset + first * size] = data[:first * size]
+        self._sync(offset, offset + first * size)
+        if first < n:
+            rest = (n - first) * size
+            self.map[HEADER_SIZE:HEADER_SIZE + rest] = data[first * size:]
+            self._sync(HEADER_SIZE, HEADER_SIZE + rest)
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.capacity, self.count + n)
+        self._write_header()
+
+    def drop_last(self):
+        """Forget the newest record, for it to be written again."""
+        self.head = (self.head - 1) % self.capacity
+        self.count -= 1
+        self._write_header()
+
+    def __len__(self):
+        return self.count
+
+    def _offset(self, i):
+        return HEADER_SIZE + ((self.head - self.count + i) % self.capacity) * self.record.size
+
+    def time_at(self, i):
+        """Time of the i-th oldest record."""
+        return struct.unpack_from("<d", self.map, self._offset(i))[0]
+
+    def read(self, i):
+        return self.record.unpack_from(self.map, self._offset(i))
+
+    def find(self, t):
+        """Index of the oldest record at or after t."""
+        return bisect_left(_Times(self), t)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class _Times(object):
+    # lets bisect search the ring's time column in place
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.ring)
+
+    def __getitem__(self, i):
+        return self.ring.time_at(i)
+
+
+class Bucket(object):
+    """Running mean/min/max/count per field for one rollup interval."""
+
+    def __init__(self, start):
+        self.start = start
+        self.sum = [0.0] * len(FIELDS)
+        self.min = [math.inf] * len(FIELDS)
+        self.max = [-math.inf] * len(FIELDS)
+        self.count = [0] * len(FIELDS)
+        self.present = 0
+
+    @classmethod
+    def unpack(cls, record):
+        """A bucket carrying on from a ROLLUP record."""
+        bucket = cls(record[0])
+        for i in range(len(FIELDS)):
+            mean, low, high, count = record[2 + 4 * i:6 + 4 * i]
+            if count:
+                bucket.add(i, mean * count, low, high, count)
+        return bucket
+
+    def remove(self, other):
+        """Take other's totals back out, before it is added again; min and max are unaffected."""
+        for i in range(len(FIELDS)):
+            self.sum[i] -= other.sum[i]
+            self.count[i] -= other.count[i]
+
+    def add(self, i, total, low, high, count):
+        self.sum[i] += total
+        if low < self.min[i]:
+            self.min[i] = low
+        if high > self.max[i]:
+            self.max[i] = high
+        self.count[i] += count
+        self.present |= 1 << i
+
+    def pack(self):
+        values = []
+        for i in range(len(FIELDS)):
+            count = self.count[i]
+            if count:
+                values.extend((self.sum[i] / count, self.min[i], self.max[i], min(count, 65535)))
+            else:
+                values.extend((0.0, 0.0, 0.0, 0))
+        return ROLLUP.pack(self.start, self.present, *values)
+
+
+class RingStore(object):
+    """Raw readings plus 1-minute and 1-hour rollups in three rings under path.
+
+    Capacities are in records; the defaults hold a week of 5 s readings,
+    30 days of minutes and two years of hours, about 40 MB in all. Records
+    are written every flush_interval seconds, or sooner once max_pending
+    readings are waiting.
+    """
+
+    def __init__(self, path, raw_capacity=7 * 17280, minute_capacity=30 * 1440, hour_capacity=730 * 24,
+                 flush_interval=60, max_pending=1000, readonly=False):
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.readonly = readonly
+        self.rings = {
+            "raw": Ring(os.path.join(path, "raw.ring"), RAW, raw_capacity, readonly),
+            "1m": Ring(os.path.join(path, "1m.ring"), ROLLUP, minute_capacity, readonly),
+            "1h": Ring(os.path.join(path, "1h.ring"), ROLLUP, hour_capacity, readonly),
+        }
+        self.pending = dict((tier, []) for tier in TIERS)
+        self.minute = None
+        self.hour = None
+        self.resumed = readonly
+        raw = self.rings["raw"]
+        # the rings are searched by bisection and the buckets only roll
+        # forward, so readings older than the newest one are skipped
+        self.newest = raw.time_at(len(raw) - 1) if len(raw) else None
+        self.skipped = 0
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.last_flush = time.monotonic()
+        self.records = 0
+        self.flushes = 0
+
+    def add(self, point):
+        """Store a point as sent to the sinks; returns True as a pipeline send."""
+        t = point["time"]
+        if self.newest is not None and t < self.newest:
+            self.skipped += 1
+            return True
+        self.newest = t
+        fields = point["fields"]
+        values = [0.0] * len(FIELDS)
+        present = 0
+        for i, name in enumerate(FIELDS):
+            value = fields.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[i] = value
+                present |= 1 << i
+        self.pending["raw"].append(RAW.pack(t, present, *values))
+        self.records += 1
+        if len(self.pending["raw"]) >= self.max_pending:
+            # tick() only runs while the sink is idle, which a replay never is
+            self.flush()
+
+        start = t - t % MINUTE
+        if not self.resumed:
+            self._resume(start)
+        if self.minute is not None and self.minute.start != start:
+            self._close_minute()
+        if self.minute is None:
+            self.minute = Bucket(start)
+        for i in range(len(FIELDS)):
+            if present & (1 << i):
+                self.minute.add(i, values[i], values[i], values[i], 1)
+        return True
+
+    def _last_bucket(self, tier, start):
+        # the newest bucket of tier, taken off the ring, if it is the one starting at start
+        ring = self.rings[tier]
+        if not len(ring) or ring.time_at(len(ring) - 1) != start:
+            return None
+        bucket = Bucket.unpack(ring.read(len(ring) - 1))
+        ring.drop_last()
+        return bucket
+
+    def _resume(self, start):
+        """Carry on with the buckets close() wrote if the first reading falls in them."""
+        self.resumed = True
+        self.minute = self._last_bucket("1m", start)
+        self.hour = self._last_bucket("1h", start - start % HOUR)
+        if self.minute is not None and self.hour is not None:
+            # the hour already holds the minute so far, which is added again when it closes
+            self.hour.remove(self.minute)
+
+    def _close_minute(self):
+        minute = self.minute
+        self.pending["1m"].append(minute.pack())
+        start = minute.start - minute.start % HOUR
+        if self.hour is not None and self.hour.start != start:
+            self.pending["1h"].append(self.hour.pack())
+            self.hour = None
+        if self.hour is None:
+            self.hour = Bucket(start)
+        for i in range(len(FIELDS)):
+            if minute.count[i]:
+                self.hour.add(i, minute.sum[i], minute.min[i], minute.max[i], minute.count[i])
+        self.minute = None
+
+    def flush(self):
+        for tier in TIERS:
+            if self.pending[tier]:
+                self.rings[tier].append_many(self.pending[tier])
+                self.pending[tier] = []
+        self.last_flush = time.monotonic()
+        self.flushes += 1
+
+    def tick(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def close(self):
+        if not self.readonly:
+            # write the open buckets rather than leave a gap until the next ones
+            if self.minute is not None:
+                self._close_minute()
+            if self.hour is not None:
+                self.pending["1h"].append(self.hour.pack())
+                self.hour = None
+            self.flush()
+        for ring in self.rings.values():
+            ring.close()
+
+    def oldest(self, tier):
+        ring = self.rings[tier]
+        return ring.time_at(0) if len(ring) else None
+
+    def choose_tier(self, start, span):
+        """The finest tier that both reaches back to start and keeps the result small."""
+        for tier, max_span in (("raw", 2 * HOUR), ("1m", 7 * 24 * HOUR), ("1h", None)):
+            oldest = self.oldest(tier)
+            if (max_span is None or span <= max_span) and oldest is not None and oldest <= start:
+                return tier
+        for tier in ("1h", "1m", "raw"):
+            if len(self.rings[tier]):
+                return tier
+        return "raw"
+
+    def query(self, field, seconds, tier=None, now=None):
+        """The last seconds of field, from the given tier or the cheapest one that covers it.
+
+        Returns (tier, rows): rows are (time, value) for raw and
+        (bucket start, mean, min, max, count) for the rollup tiers, oldest
+        first. Only records already flushed are included.
+        """
+        i = FIELDS.index(field)
+        if self.readonly:
+            for ring in self.rings.values():
+                ring.refresh()
+        now = time.time() if now is None else now
+        start = now - seconds
+        if tier is None:
+            tier = self.choose_tier(start, seconds)
+        ring = self.rings[tier]
+        bit = 1 << i
+        rows = []
+        for n in range(ring.find(start), len(ring)):
+            record = ring.read(n)
+            if not record[1] & bit:
+                continue
+            if tier == "raw":
+                rows.append((record[0], record[2 + i]))
+            else:
+                rows.append((record[0],) + record[2 + 4 * i:6 + 4 * i])
+        return tier, rows
+
+    def stats(self):
+        return {
+            "records": self.records,
+            "skipped": self.skipped,
+            "flushes": self.flushes,
+            "raw": len(self.rings["raw"]),
+            "1m": len(self.rings["1m"]),
+            "1h": len(self.rings["1h"]),
+        }
+
+
+class RingSink(object):
+    """A pipeline sink keeping one RingStore per board location under path."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.stores = {}
+
+    def store_for(self, point):
+        location = point.get("tags", {}).get("location", "default")
+        store = self.stores.get(location)
+        if store is None:
+            store = RingStore(os.path.join(self.path, re.sub(r"[^\w.-]", "_", location)), **self.kwargs)
+            self.stores[location] = store
+        return store
+
+    def send(self, point):
+        return self.store_for(point).add(point)
+
+    def tick(self):
+        for store in self.stores.values():
+            store.tick()
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+    def stats(self):
+        return dict((location, store.stats()) for location, store in self.stores.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the local ring store')
+    parser.add_argument("--path", dest='path', required=False, default="enviropi-ring/driveway",
+                        help="ring store directory of one board")
+    parser.add_argument("--field", dest='field', required=False, default="pm2", choices=FIELDS)
+    parser.add_argument("--hours", dest='hours', required=False, type=float, default=1)
+    parser.add_argument("--tier", dest='tier', required=False, default=None, choices=TIERS,
+                        help="read this tier instead of choosing one from --hours")
+    args = parser.parse_args()
+
+    store = RingStore(args.path, readonly=True)
+    started = time.perf_counter()
+    tier, rows = store.query(args.field, args.hours * HOUR, args.tier)
+    elapsed = time.perf_counter() - started
+    for row in rows:
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])),
+              " ".join("{:g}".format(v) for v in row[1:]))
+    print("{} {} rows from the {} tier in {:.1f} ms".format(len(rows), args.field, tier, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+## Per-sink send cadence and circuit breaking
+# Each upload sink declares how often it wants a reading. The most recent
+# reading is held until the sink is due, and a circuit breaker stops calls to
+# an endpoint after repeated failures, backing off exponentially and letting a
+# single half-open probe through before resuming.
+#
+import logging
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Open after failure_threshold consecutive failures.
+
+    The circuit stays open for reset_timeout seconds, doubling on every
+    failed probe up to max_reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30, max_reset_timeout=900):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.open_until = 0
+        self.trips = 0
+
+    def allow(self):
+        if self.state == OPEN:
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = HALF_OPEN
+            logging.info("%s circuit half open, probing", self.name)
+        return True
+
+    def record(self, ok):
+        if ok:
+            if self.state != CLOSED:
+                logging.info("%s circuit closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.timeout = self.reset_timeout
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.timeout = min(self.timeout * 2, self.max_reset_timeout)
+            self._open()
+        elif self.state == CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.trips += 1
+        self.open_until = time.monotonic() + self.timeout
+        logging.warning("%s circuit open for %ss after %s failures", self.name, self.timeout, self.failures)
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+class SinkSchedule(object):
+    """Send to a sink at most once every cadence seconds.
+
+    offer() is called for every reading and tick() while idle; both send once
+    the sink is due. Without a window the latest reading is sent, with an
+    aggregate.Window the window's result over every reading since the last
+    send. When the breaker refuses the call the reading is passed to
+    on_reject instead, if given (e.g. to spool it).
+    """
+
+    def __init__(self, name, cadence, send, breaker=None, on_reject=None, window=None):
+        self.name = name
+        self.cadence = cadence
+        self.send = send
+        self.breaker = breaker
+        self.on_reject = on_reject
+        self.window = window
+        self.pending = None
+        self.next_send = 0
+        self.skipped = 0
+
+    def offer(self, item):
+        if self.window is not None:
+            self.window.add(item)
+        else:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = item
+        return self.run_if_due()
+
+    def tick(self):
+        self.run_if_due()
+
+    def run_if_due(self):
+        now = time.monotonic()
+        if now < self.next_send:
+            return None
+        item = self._take()
+        if item is None:
+            return None
+        self.next_send = now + self.cadence
+        if self.breaker is None:
+            return self.send(item)
+        if not self.breaker.allow():
+            if self.on_reject is not None:
+                self.on_reject(item)
+            return False
+        ok = self.send(item)
+        self.breaker.record(ok is not False)
+        return ok
+
+    def _take(self):
+        if self.window is not None:
+            if self.window.count == 0:
+                return None
+            item = self.window.result()
+            self.window.reset()
+            return item
+        item = self.pending
+        self.pending = None
+        return item
+
+    def stats(self):
+        stats = self.breaker.stats() if self.breaker is not None else {}
+        stats["skipped"] = self.skipped
+        return stats
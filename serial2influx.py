@@ -1,18 +1,30 @@
 #!/usr/bin/python3
 import argparse
-import serial
 import time
 import os
+import signal
 from pathlib import Path
 import sys
-import datetime
-import json
-import requests # for luftdaten submission
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
-from w1thermsensor import W1ThermSensor
 import logging
 
+from pipeline import Pipeline, POLICIES, DROP_OLDEST, BLOCK
+from influx_batch import BatchWriter
+from capture_ingest import CaptureIngest
+from spool import Spool, SpooledSink
+from http_pool import HttpPool
+from scheduler import CircuitBreaker, SinkSchedule
+from therm_sampler import TemperatureSampler
+from token_manager import TokenManager
+from ack_index import AckIndex
+from ring_store import RingSink
+from metrics import Registry, MetricsServer
+from health import Health, Watchdog, sd_notify, watchdog_interval
+from log_setup import setup_logging
+from serial_port import SerialTransport
+from boards import Board, BoardMux, parse_board_spec
+from aggregate import Window, SummaryWindow, REDUCERS, MEAN, pm_reducers
+from derived import Calibration, derive
+
 # global
 
 dbhost = ""
@@ -21,21 +33,37 @@ user   = ""
 pw     = ""
 dbname = ""
 
+# seconds between uploads, enforced by each sink's schedule
 luftdaten_update_frequency = 60
 packets_global_update_frequency = 10
 local_update_frequency = 5
-luftdaten_send_time = 0
-packets_global_send_time = 0
 
-last_renewal = 0
-token = None
+ack_index = None # AckIndex of what luftdaten accepted, shared with batch_update_luftdaten.py
+tokens = None # TokenManager, renews the iot.packets.global token in the background
+
+http_pool = HttpPool() # keep-alive sessions shared by the upload sinks
 
-ser = serial.Serial('/dev/ttyACM0',9600)
+iot_url = "https://iot.packets.global:443/api/1.0/"
+luftdaten_url = "https://api.luftdaten.info/v1/push-sensor-data/"
 
 
+def process_age():
+    """Seconds since this process started, from /proc; None without it."""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - started / os.sysconf("SC_CLK_TCK")
+
+def epoch_seconds(value):
+    from influx_history import parse_time
+    return parse_time(value) // 1000000000
 
 def get_iot_url():
-    return "https://iot.packets.global:443"+ "/api/1.0/"
+    return iot_url
 
 def get_serial_string(full=False):
     with open('/proc/cpuinfo', 'r') as f:
@@ -52,25 +80,11 @@ def get_token_file():
     token_file = iot_dir + "/token"
     return token_file
 
-def read_token():
-    global token
-    logging.debug("Reading token")
-    token_file = get_token_file()
-    file = open(token_file, "r")
-    token = json.load(file)
-
-def write_token(token_data):
-    global token
-    token_file = get_token_file()
-    if os.path.exists(token_file):
-        os.remove(token_file)
-        f = open(token_file, "x")
-        f.write(token_data)
-        f.close()
-        logging.debug("Token written to " + token_file)
-    token = json.loads(token_data)
-def token_request(iot_user, iot_pw, iot_serial_number):
-    logging.debug("token_request({},{},{})".format(iot_user, iot_pw, iot_serial_number))
+def token_request():
+    iot_user = "pete@packets.global"
+    iot_pw = "foo123"
+    iot_serial_number = get_serial_string(full=True)
+    logging.debug("token_request(%s,%s,%s)", iot_user, iot_pw, iot_serial_number)
     headers = {'content-type': 'application/json'}
     data = dict()
     data['username'] = iot_user
@@ -78,165 +92,92 @@ def token_request(iot_user, iot_pw, iot_serial_number):
     data['serialNumber'] = iot_serial_number
 
     token_api = get_iot_url() + 'token/request'
-    request = requests.post(token_api, json=data, headers=headers, verify=False,
+    request = http_pool.post(token_api, json=data, headers=headers, verify=False,
                           allow_redirects=False)
     response = request.text
-    if len(response) > 0:
-        text = json.dumps(json.loads(response), sort_keys=True, indent=4)
-    else:
-        text = "Empty response"
-    logging.debug("IOT Token Req: {url} {req}->{resp}".format(url=token_api, req=data, resp=text))
-
+    logging.debug("IOT Token Req: %s %s->%s", token_api, data, response or "Empty response")
 
     if request.status_code == 200:
-        logging.debug("iot token request succeeded with {}".format(response))    
-        write_token(response)
-    else:
-        logging.warning("iot token request failed with {}".format(response))    
-        return False
-    return True
+        logging.debug("iot token request succeeded with %s", response)    
+        return response
+    logging.warning("iot token request failed with %s", response)    
+    return None
 
-def token_renew():
-    global token
+def token_renew(token):
     headers = {'content-type': 'application/json'}
     data = dict()
     data['token'] = token
     renew_api = get_iot_url() + 'token/renew'
-    request = requests.put(
+    request = http_pool.put(
                 renew_api, 
                 json=data,
                 headers=headers, verify=False,
                 allow_redirects=False)
     response = request.text
-    if len(response) > 0:
-        text = json.dumps(json.loads(response), sort_keys=True, indent=4)
-    else:
-        text = "Empty response"
-
-    logging.debug("IOT Token Renew: {url} {req}->{resp}".format(url=renew_api, req=data, resp=text))
+    logging.debug("IOT Token Renew: %s %s->%s", renew_api, data, response or "Empty response")
 
     if request.status_code == 200:
-        logging.debug("IOT token renew: OK - {}")
-    else:
-        logging.warning("IOT token renew: {}".format(response))
-
-
-def check_token_and_renew(force_renew=False):
-    global last_renewal
-    global token
-    logging.debug("check_token_and_renew(force_renew={})".format(force_renew))
-    renewal_period = 25
-    try:
-        if force_renew:
-            logging.debug("Ignoring token on disk. requesting new token")
-            if token_request("pete@packets.global", "foo123", get_serial_string(full=True)):
-                last_renewal = time.monotonic()
-            else:
-                logging.error("Failed to get new token")
-                return
-    except json.JSONDecodeError:
-        logging.error("Token read failed")
-
-    if time.monotonic() > last_renewal + renewal_period :
-        logging.debug("Need to renew token")
-        token_renew()
-        last_renewal = time.monotonic()
-    else:
-        logging.debug("Token still valid {}".format(token))
-
-
-def send_to_luftdaten(values, id):
-    luft_map = { 
-        "pm1":"P0", 
-        "pm2":"P2", 
-        "pm10":"P1",
-        "real_temp":"temperature",
-        "humidity":"humidity",
-        "pressure":"pressure"}
-
-    global luftdaten_send_time
-
-    now = time.monotonic()
-
-    if now < luftdaten_send_time + luftdaten_update_frequency:
-        return
-    
-    luftdaten_send_time = now
-
-    pm_values = dict(i for i in values.items() if i[0] in ["pm1","pm2", "pm10"])
-    temp_values = dict(i for i in values.items() if i[0] in ["humidity", "pressure", "real_temp"])
-
-    pm_values_json = [{"value_type": luft_map[key], "value": val}
-                      for key, val in pm_values.items()]
-    temp_values_json = [{"value_type": luft_map[key], "value": val}
-                        for key, val in temp_values.items()]
-
-    logging.debug("Sending AQ data to {}".format("luftdaten"))
-    try:   
-        resp_1 = requests.post(
-            "https://api.luftdaten.info/v1/push-sensor-data/",
-            json={
-                "software_version": "nhorlock/enviropi",
-                "sensordatavalues": pm_values_json
-            },
-            headers={
-                "X-PIN": "1",
-                "X-Sensor": id,
-                "Content-Type": "application/json",
-                "cache-control": "no-cache"
-            }
-        )
-    except requests.exceptions.ConnectionError as e:
-        logging.warning('Sensor.Community (Luftdaten) PM Connection Error: {}'.format(e))
-    except requests.exceptions.Timeout as e:
-        logging.warning('Sensor.Community (Luftdaten) PM Timeout Error: {}'.format(e))
-    except requests.exceptions.RequestException as e:
-        logging.warning('Sensor.Community (Luftdaten) PM Request Error: {}'.format(e))
-    except Exception as e:
-        logging.warning('Sensor.Community (Luftdaten) Unexpected Request Error: {}'.format(e))
-
-    try:
-        resp_2 = requests.post(
-            "https://api.luftdaten.info/v1/push-sensor-data/",
-            json={
-                "software_version": "nhorlock/enviropi",
-                "sensordatavalues": temp_values_json
-            },
-            headers={
-                "X-PIN": "11",
-                "X-Sensor": id,
-                "Content-Type": "application/json",
-                "cache-control": "no-cache"
-            }
-        )
-    except requests.exceptions.ConnectionError as e:
-        logging.warning('Sensor.Community (Luftdaten) TMP Connection Error: {}'.format(e))
-    except requests.exceptions.Timeout as e:
-        logging.warning('Sensor.Community (Luftdaten) TMP Timeout Error: {}'.format(e))
-    except requests.exceptions.RequestException as e:
-        logging.warning('Sensor.Community (Luftdaten) TMP Request Error: {}'.format(e))
-    except Exception as e:
-        logging.warning('Sensor.Community (Luftdaten) Unexpected Request Error: {}'.format(e))
-
-    if resp_1.ok and resp_2.ok:
-        return True
-    else:
-        return False    
+        logging.debug("IOT token renew: OK")
+        return response
+    logging.warning("IOT token renew: %s", response)
+    return None
+
+
+def replay_to_luftdaten(points, id):
+    done = 0
+    for point in points:
+        if not send_to_luftdaten(point["fields"], id, point["time"]):
+            break
+        done += 1
+    return done
+
+def send_to_luftdaten(values, id, when):
+    import requests # imported on first upload, off the startup path
+    # the same requests as batch_update_luftdaten.py sends, so the payloads cannot drift apart
+    from luftdaten_submit import push_body, requests_for
+    ok = True
+    logging.debug("Sending AQ data to %s", "luftdaten")
+    for pin, values_json in requests_for(values):
+        if ack_index is not None and ack_index.contains(id, pin, when):
+            # accepted before, e.g. by a backfill or before a partial failure
+            continue
+        body = push_body(values_json, when)
+        resp = None
+        try:   
+            resp = http_pool.post(
+                luftdaten_url,
+                json=body,
+                headers={
+                    "X-PIN": pin,
+                    "X-Sensor": id,
+                    "Content-Type": "application/json",
+                    "cache-control": "no-cache"
+                }
+            )
+        except requests.exceptions.ConnectionError as e:
+            logging.warning("Sensor.Community (Luftdaten) pin %s Connection Error: %s", pin, e)
+        except requests.exceptions.Timeout as e:
+            logging.warning("Sensor.Community (Luftdaten) pin %s Timeout Error: %s", pin, e)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Sensor.Community (Luftdaten) pin %s Request Error: %s", pin, e)
+        except Exception as e:
+            logging.warning("Sensor.Community (Luftdaten) Unexpected Request Error: %s", e)
+
+        if resp is not None and resp.ok:
+            if ack_index is not None:
+                ack_index.add(id, pin, when)
+        else:
+            ok = False
+    return ok
 
 def send_to_iotpackets(values):
-    global token
-    global packets_global_send_time
-
-    now = time.monotonic()
-
-    if now < packets_global_send_time + packets_global_update_frequency:
-        return
-    
-    packets_global_send_time = now
-
+    import requests # imported on first upload, off the startup path
     url =  get_iot_url() + "collector/environment"
-    logging.debug("Sending AQ data to {}".format(url))
-    check_token_and_renew()
+    logging.debug("Sending AQ data to %s", url)
+    token = tokens.get()
+    if token is None:
+        logging.warning("iot.packets.global: no valid token yet, not sending")
+        return False
     headers = {'content-type': 'application/json'}
     location = { 'latitude': 51.15795109905, 'longitude': 0.88059872389}
 
@@ -264,9 +205,10 @@ def send_to_iotpackets(values):
     data['environment_data'] = iot_data
 
 
-    logging.debug("IOT: sending to {} with {}".format(url,data))
+    logging.debug("IOT: sending to %s with %s", url, data)
+    resp = None
     try:   
-        resp = requests.post(
+        resp = http_pool.post(
             url,
             json=data,
             headers=headers,
@@ -274,128 +216,497 @@ def send_to_iotpackets(values):
             allow_redirects=False
         )
     except requests.exceptions.ConnectionError as e:
-        logging.warning('iot.packets.global Connection Error: {}'.format(e))
+        logging.warning("iot.packets.global Connection Error: %s", e)
     except requests.exceptions.Timeout as e:
-        logging.warning('iot.packets.global Timeout Error: {}'.format(e))
+        logging.warning("iot.packets.global Timeout Error: %s", e)
     except requests.exceptions.RequestException as e:
-        logging.warning('iot.packets.global Request Error: {}'.format(e))
+        logging.warning("iot.packets.global Request Error: %s", e)
     except Exception as e:
-        logging.error('iot.packets.global Unexpected Error: {}'.format(e))
+        logging.error("iot.packets.global Unexpected Error: %s", e)
 
+    if resp is None:
+        return False
     if resp.ok:
-        logging.debug("Resp OK from {} : {}".format(url,json.dumps(json.loads(resp.text), sort_keys=True, indent=4)))
+        logging.debug("Resp OK from %s : %s", url, resp.text)
         return True
     else:
         if resp.status_code == 401:
-            check_token_and_renew(force_renew=True)
-        if len(resp.text) > 0:
-            text = json.dumps(json.loads(resp.text), sort_keys=True, indent=4)
-        else:
-            text = "Empty response"
-        logging.warning("Response NOTOK from {} : {}".format(url,text))
+            tokens.invalidate()
+        logging.warning("Response NOTOK from %s : %s %s", url, resp.status_code, resp.text or "Empty response")
         return False    
 
-def send_data_to_influx(store, row):
-    try:
-        store.write_points(row, time_precision='s')
-    except ConnectionError as e:
-        logging.warning("Failed to connect to Influx host {}:{} - {}".format(dbhost, port, e))
-    except InfluxDBClientError as e:
-        if e.code == 404:
-            logging.error("Database '{}' not found.".format(dbname))
-        else:
-            logging.error("Write InfluxDB client failed {}@{}:{} - {}".format(dbname,dbhost, port, e))
-    except InfluxDBServerError as e:
-            logging.error("Write InfluxDB server failed {}@{}:{} - {}".format(dbname,dbhost, port, e))
-
-# Allow setting of basic config at command line.
-
-logging.basicConfig(
-    filename="enviropi.log",
-    format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
-    level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S')
-    
-parser = argparse.ArgumentParser(description='Read data from arduino and send to store')
-parser.add_argument('--dbhost', dest='dbhost', required=False, default="babbage.local",
-                    help="The IP or resolvable hostname of the influx data base")
-parser.add_argument('--dbport', dest='port', required=False, default=8086, 
-                    help="The port number for the influx data base")
-parser.add_argument("--user", dest='user', required=False, default="enviropi",
-                    help="the influx username")
-parser.add_argument("--pass", dest='pw', required=False, default="enviropi",
-                    help="the influx password")
-parser.add_argument("--dbname", dest='dbname', required=False, default="enviro_sensor_data",
-                    help="the influx database that will be used.")
-args = parser.parse_args()
-
-dbhost = args.dbhost
-port   = args.port
-user   = args.user
-pw     = args.pw
-dbname = args.dbname
-
-# Create the InfluxDB client object
-store = InfluxDBClient(dbhost, port, user, pw, dbname)
-therm = W1ThermSensor()
-
-location = "driveway"
-device = "enviro+ arduino"
-measurement = "environmental"
-s = [0]
-collecting = False
-luft_device = "raspi-" + get_serial_string()
-readings={}
-
-# Log Raspberry Pi serial and Wi-Fi status
-logging.info("Luftdaten Logging as : {}".format(luft_device))
-logging.info("Influx as : {}:{} {}/{}".format(dbhost, port, user, pw))
-
-
-logging.info("""serial2influx.py - Reads multiple sensors from enviro feather board, combines with independent temperature and sends to
+def build_parser():
+    parser = argparse.ArgumentParser(description='Read data from arduino and send to store')
+    parser.add_argument('--dbhost', dest='dbhost', required=False, default="babbage.local",
+                        help="The IP or resolvable hostname of the influx data base")
+    parser.add_argument('--dbport', dest='port', required=False, default=8086, 
+                        help="The port number for the influx data base")
+    parser.add_argument("--user", dest='user', required=False, default="enviropi",
+                        help="the influx username")
+    parser.add_argument("--pass", dest='pw', required=False, default="enviropi",
+                        help="the influx password")
+    parser.add_argument("--dbname", dest='dbname', required=False, default="enviro_sensor_data",
+                        help="the influx database that will be used.")
+    parser.add_argument("--batch-size", dest='batch_size', required=False, type=int, default=12,
+                        help="points buffered before they are written to influx in one request")
+    parser.add_argument("--batch-age", dest='batch_age', required=False, type=float, default=60,
+                        help="maximum seconds a point is buffered before the batch is written")
+    parser.add_argument("--gzip", dest='gzip', required=False, action='store_true',
+                        help="gzip compress influx write requests")
+    parser.add_argument("--influx-timeout", dest='influx_timeout', required=False, type=float, default=30,
+                        help="seconds to wait for influx to answer a request")
+    parser.add_argument("--queue-size", dest='queue_size', required=False, type=int, default=100,
+                        help="frames each sink may buffer before the backpressure policy applies")
+    parser.add_argument("--queue-policy", dest='queue_policy', required=False, default=DROP_OLDEST,
+                        choices=POLICIES, help="what to do when a sink queue is full")
+    parser.add_argument("--spool", dest='spool', required=False, default="enviropi-spool.db",
+                        help="sqlite file holding readings that could not be delivered, empty to disable")
+    parser.add_argument("--ring-store", dest='ring_store', required=False, default="enviropi-ring",
+                        help="directory of the local ring store of recent readings, empty to disable")
+    parser.add_argument("--ring-flush-interval", dest='ring_flush_interval', required=False, type=float, default=60,
+                        help="seconds between batched writes to the ring store")
+    parser.add_argument("--ack-index", dest='ack_index', required=False, default="luftdaten-acks",
+                        help="directory recording what luftdaten accepted, shared with batch_update_luftdaten.py; "
+                             "empty to disable")
+    parser.add_argument("--spool-max-entries", dest='spool_max_entries', required=False, type=int, default=200000,
+                        help="oldest spooled readings are discarded beyond this many")
+    parser.add_argument("--replay-batch", dest='replay_batch', required=False, type=int, default=5,
+                        help="spooled readings resent per sink every few seconds once it recovers")
+    parser.add_argument("--connect-timeout", dest='connect_timeout', required=False, type=float, default=5,
+                        help="seconds to wait for an upload endpoint to accept a connection")
+    parser.add_argument("--read-timeout", dest='read_timeout', required=False, type=float, default=20,
+                        help="seconds to wait for an upload endpoint to respond")
+    parser.add_argument("--http-retries", dest='http_retries', required=False, type=int, default=2,
+                        help="retries, with jittered backoff, for failed upload requests")
+    parser.add_argument("--luftdaten-pm", dest='luftdaten_pm', required=False, default=MEAN, choices=REDUCERS,
+                        help="how PM readings are combined over each luftdaten upload interval")
+    parser.add_argument("--iotpackets-pm", dest='iotpackets_pm', required=False, default=MEAN, choices=REDUCERS,
+                        help="how PM readings are combined over each iot.packets.global upload interval")
+    parser.add_argument("--downsample", dest='downsample', required=False, type=float, default=0,
+                        help="also write min/max/mean over this many seconds to <measurement>_summary, 0 to disable")
+    parser.add_argument("--calibration", dest='calibration', required=False, default="calibration.json",
+                        help="per-board calibration tables for the derived fields, see derived.py")
+    parser.add_argument("--no-derived", dest='no_derived', action='store_true',
+                        help="do not add compensated temperature/humidity, dew point and gas ppm to readings")
+    parser.add_argument("--no-therm", dest='no_therm', action='store_true',
+                        help="run without the DS18B20, e.g. away from the Pi")
+    parser.add_argument("--therm-interval", dest='therm_interval', required=False, type=float, default=5,
+                        help="seconds between DS18B20 temperature readings")
+    parser.add_argument("--therm-max-age", dest='therm_max_age', required=False, type=float, default=30,
+                        help="DS18B20 readings older than this are reported as stale")
+    parser.add_argument("--therm-resolution", dest='therm_resolution', required=False, type=int, default=None,
+                        choices=[9, 10, 11, 12], help="DS18B20 resolution in bits, default leaves it unchanged")
+    parser.add_argument("--serial-port", dest='serial_port', required=False, default="/dev/ttyACM0",
+                        help="serial device of the sensor board")
+    parser.add_argument("--serial-vid", dest='serial_vid', required=False, type=lambda v: int(v, 16), default=None,
+                        help="find the sensor board by USB vendor id (hex) instead of --serial-port")
+    parser.add_argument("--serial-pid", dest='serial_pid', required=False, type=lambda v: int(v, 16), default=None,
+                        help="find the sensor board by USB product id (hex) instead of --serial-port")
+    parser.add_argument("--board", dest='boards', required=False, action='append', default=[],
+                        help="a sensor board to read, e.g. 'port=/dev/ttyACM1,location=garage,device=enviro+ feather'; "
+                             "repeat for several boards, the first one uploads to luftdaten/iot.packets.global")
+    parser.add_argument("--token-lifetime", dest='token_lifetime', required=False, type=float, default=30,
+                        help="seconds an iot.packets.global token is assumed valid when the server does not say")
+    parser.add_argument("--token-margin", dest='token_margin', required=False, type=float, default=5,
+                        help="renew the iot.packets.global token this many seconds before it expires")
+    parser.add_argument("--luftdaten-url", dest='luftdaten_url', required=False, default=luftdaten_url,
+                        help="luftdaten push-sensor-data endpoint")
+    parser.add_argument("--iot-url", dest='iot_url', required=False, default=iot_url,
+                        help="iot.packets.global API base URL")
+    parser.add_argument("--metrics-port", dest='metrics_port', required=False, type=int, default=9108,
+                        help="port serving Prometheus metrics at /metrics, 0 to disable")
+    parser.add_argument("--metrics-address", dest='metrics_address', required=False, default="127.0.0.1",
+                        help="address the metrics endpoint listens on, e.g. 0.0.0.0 to let another host scrape it")
+    parser.add_argument("--metrics-interval", dest='metrics_interval', required=False, type=float, default=60,
+                        help="seconds between writing metrics to influx as enviropi_internal, 0 to disable")
+    parser.add_argument("--replay", dest='replay', required=False, default=None,
+                        help="load a raw serial capture into influx as fast as it parses, then exit; "
+                             "readings get the tags of the first board")
+    parser.add_argument("--replay-start", dest='replay_start', required=False, default=None,
+                        type=epoch_seconds,
+                        help="time of the capture's first frame, epoch seconds or YYYY-MM-DD[THH:MM:SSZ]; "
+                             "by default its last frame is taken to be from the file's modification time")
+    parser.add_argument("--replay-interval", dest='replay_interval', required=False, type=float, default=5,
+                        help="seconds between frames of a capture, for frames without a time=<epoch> field")
+    parser.add_argument("--replay-lines", dest='replay_lines', required=False, type=int, default=5000,
+                        help="points per influx write when loading a capture")
+    parser.add_argument("--replay-sinks", dest='replay_sinks', required=False, default="",
+                        help="comma separated local sinks to feed a capture to as well as influx, e.g. ring; "
+                             "upload history to luftdaten with batch_update_luftdaten.py afterwards")
+    parser.add_argument("--replay-ring-store", dest='replay_ring_store', required=False, default="enviropi-replay-ring",
+                        help="ring store directory a capture is fed to with --replay-sinks ring, kept apart from "
+                             "the live --ring-store")
+    parser.add_argument("--frame-timeout", dest='frame_timeout', required=False, type=float, default=60,
+                        help="seconds without a frame before the collector reports itself unhealthy, 0 to not check")
+    parser.add_argument("--sink-timeout", dest='sink_timeout', required=False, type=float, default=600,
+                        help="seconds a sink may spend on one frame or tick before the collector is unhealthy")
+    parser.add_argument("--log-file", dest='log_file', required=False, default="enviropi.log",
+                        help="log file, rotated with the older generations gzipped")
+    parser.add_argument("--log-level", dest='log_level', required=False, default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-max-bytes", dest='log_max_bytes', required=False, type=int, default=5000000,
+                        help="rotate the log once it reaches this size")
+    parser.add_argument("--log-rotate-when", dest='log_rotate_when', required=False, default=None,
+                        help="rotate the log by time instead, e.g. midnight or h (see TimedRotatingFileHandler)")
+    parser.add_argument("--log-backups", dest='log_backups', required=False, type=int, default=5,
+                        help="rotated log files kept")
+    parser.add_argument("--log-coalesce", dest='log_coalesce', required=False, type=float, default=60,
+                        help="seconds over which a repeated warning or error is summarised in one line, 0 to disable")
+    parser.add_argument("--stats-interval", dest='stats_interval', required=False, type=float, default=3600,
+                        help="seconds between logging queue and connection statistics")
+    return parser
+
+
+def main(argv=None):
+    global dbhost, port, user, pw, dbname, luftdaten_url, iot_url, tokens, ack_index
+    started = time.monotonic()
+    startup = process_age() # interpreter start and imports, before main()
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # records are written by a background thread, see log_setup.py
+    log = setup_logging(args.log_file, getattr(logging, args.log_level), max_bytes=args.log_max_bytes,
+                        backups=args.log_backups, when=args.log_rotate_when, coalesce_interval=args.log_coalesce)
+
+    dbhost = args.dbhost
+    port   = args.port
+    user   = args.user
+    pw     = args.pw
+    dbname = args.dbname
+
+    luftdaten_url = args.luftdaten_url
+    iot_url = args.iot_url
+    http_pool.connect_timeout = args.connect_timeout
+    http_pool.read_timeout = args.read_timeout
+    http_pool.retries = args.http_retries
+
+    # Instrumentation; histograms are observed as things happen, the rest is
+    # copied from the components' own stats() whenever the metrics are read
+    metrics = Registry()
+    frame_seconds = metrics.histogram("enviropi_frame_seconds",
+                                      "Time from a frame being parsed to it being published to the sinks")
+    frame_to_influx_seconds = metrics.histogram("enviropi_frame_to_influx_seconds",
+                                                "Time from a frame being parsed to influx acknowledging it")
+    sink_queue_seconds = metrics.histogram("enviropi_sink_queue_seconds",
+                                           "Time frames wait in a sink's queue", ["sink"])
+    sink_send_seconds = metrics.histogram("enviropi_sink_send_seconds",
+                                          "Time a sink takes to handle a frame", ["sink"])
+    therm_read_seconds = metrics.histogram("enviropi_therm_read_seconds",
+                                           "Time get_temperature() takes on the DS18B20")
+    startup_seconds = metrics.gauge("enviropi_startup_seconds",
+                                    "Time from the process starting to main() (imports) and to the first frame",
+                                    ["stage"])
+
+    def sink_metrics(name):
+        return {"observe_queue": sink_queue_seconds.labels(name).observe,
+                "observe_send": sink_send_seconds.labels(name).observe}
+
+    # the InfluxDB client is created by the influx sink worker, so importing
+    # influxdb and requests does not hold up the first frames
+    influx_writer = BatchWriter(None, batch_size=args.batch_size, max_age=args.batch_age,
+                                observe_latency=frame_to_influx_seconds.observe)
+
+    def connect_influx():
+        from influxdb import InfluxDBClient
+        influx_writer.client = InfluxDBClient(dbhost, port, user, pw, dbname, gzip=args.gzip,
+                                              timeout=args.influx_timeout)
+    therm = None
+    if not args.no_therm and not args.replay:
+        from w1thermsensor import W1ThermSensor
+        therm = TemperatureSampler(W1ThermSensor(), interval=args.therm_interval,
+                                   max_age=args.therm_max_age, resolution=args.therm_resolution,
+                                   observe=therm_read_seconds.observe)
+        therm.start()
+
+    location = "driveway"
+    device = "enviro+ arduino"
+    measurement = "environmental"
+    if args.boards:
+        boards = [parse_board_spec(spec, i == 0) for i, spec in enumerate(args.boards)]
+    else:
+        boards = [Board(SerialTransport(args.serial_port, 9600, vid=args.serial_vid, pid=args.serial_pid),
+                        {"location":location, "device":device})]
+    mux = BoardMux(boards)
+    # compensated temperature and humidity, dew point and gas ppm for every frame
+    calibration = None if args.no_derived else Calibration(args.calibration)
+    luft_device = "raspi-" + (get_serial_string() or "unknown") # no Serial line away from the Pi
+
+    # Log Raspberry Pi serial and Wi-Fi status
+    logging.info("Luftdaten Logging as : %s", luft_device)
+    logging.info("Influx as : %s:%s %s/%s", dbhost, port, user, pw)
+
+
+    logging.info("""serial2influx.py - Reads multiple sensors from enviro feather board, combines with independent temperature and sends to
 influx for storage. Also sends data to the luftdaten API endpoints.
 """)
 
-logging.debug("checking token at startup")
-check_token_and_renew(force_renew=True) # if we have a token file renew that else request one
+    # renews the token on disk if it is still valid, else requests one
+    tokens = TokenManager(get_token_file(), token_request, token_renew,
+                          lifetime=args.token_lifetime, margin=args.token_margin)
+    if not args.replay:
+        tokens.start()
+
+    # each sink gets its own worker and queue so the serial loop below never waits on HTTP
+    pipeline = Pipeline()
+    schedules = []
+    spool = Spool(args.spool, max_entries=args.spool_max_entries) if args.spool else None
+    ack_index = AckIndex(args.ack_index) if args.ack_index else None
+
+    def add_upload_sink(name, cadence, deliver, replay, pm_reducer):
+        breaker = CircuitBreaker(name)
+        # every reading in the upload interval contributes, not just the last one
+        window = Window(pm_reducers(pm_reducer))
+        if spool is not None and replay is not None:
+            # failed deliveries, and readings due while the circuit is open, are
+            # kept on disk and replayed once the sink is back
+            spooled = SpooledSink(spool, name, deliver, replay,
+                                  replay_batch=args.replay_batch, breaker=breaker)
+            schedule = SinkSchedule(name, cadence, spooled.send, breaker=breaker, on_reject=spooled.store,
+                                    window=window)
+
+            def tick():
+                schedule.tick()
+                spooled.tick()
+        else:
+            schedule = SinkSchedule(name, cadence, deliver, breaker=breaker, window=window)
+            tick = schedule.tick
+        schedules.append(schedule)
+        pipeline.add_sink(name, schedule.offer,
+                          maxsize=args.queue_size, policy=args.queue_policy, tick=tick, **sink_metrics(name))
 
-while True:
-    try:
-        read_serial=ser.readline().decode("utf-8").strip()
-    except serial.serialutil.SerialException as e:
-        logging.warning("Warning: Exception caught on serial read [{}]".format(e))
+    if spool is not None:
+        influx_spooled = SpooledSink(spool, "influx", None, influx_writer.replay,
+                                     encode=str, decode=str, replay_batch=500)
+
+        def spill_to_spool(lines):
+            for line in lines:
+                influx_spooled.store(line)
+
+        def influx_tick():
+            influx_writer.flush_if_due()
+            influx_spooled.tick()
+
+        influx_writer.spill = spill_to_spool
     else:
-        # logging.debug("read: {}".format(read_serial))
-        if collecting:
-            if read_serial == "END":
-                real_temp = therm.get_temperature()
-                collecting = False
-                readings["real_temp"]=real_temp
-                row = [ { "measurement":measurement,
-                            "tags": { 
-                                "location":location,
-                                "device":device,
-                            },
-                            "time": int(time.time()),
-                            "fields":readings
-                        }
-                    ]
-                logging.debug("Data received: {}".format(json.dumps(row)))
-                send_data_to_influx(store, row)
-                send_to_iotpackets(readings)
-                send_to_luftdaten(readings, luft_device)
-            else:
-                try:
-                    k, v = read_serial.split("=")
-                    if '.' in v:
-                        readings[k]=float(v)
-                    else:
-                        readings[k]=int(v)
-                except Exception as e:
-                    logging.warning("decode failed: [{}] exception [{}]".format(read_serial, e))
+        influx_tick = influx_writer.flush_if_due
+    influx_send = influx_writer.add
+    if args.downsample > 0:
+        # one window per board, keyed by its tags, so boards are summarised apart
+        downsamples = {}
+
+        def influx_send(point):
+            if point["measurement"] != measurement:
+                return influx_writer.add(point)
+            key = tuple(sorted(point["tags"].items()))
+            downsample = downsamples.get(key)
+            if downsample is None:
+                downsample = SinkSchedule("downsample", args.downsample, influx_writer.add,
+                                          window=SummaryWindow(measurement + "_summary"))
+                # first window ends downsample seconds after the first reading
+                downsample.next_send = time.monotonic() + args.downsample
+                downsamples[key] = downsample
+            downsample.offer(point)
+            return influx_writer.add(point)
+
+    pipeline.add_sink("influx", influx_send,
+                      maxsize=args.queue_size, policy=args.queue_policy,
+                      open=connect_influx, tick=influx_tick, close=influx_writer.close, **sink_metrics("influx"))
+    # sinks every board feeds, the upload sinks only get boards with upload set
+    local_sinks = ["influx"]
+    ring_path = args.ring_store
+    if args.replay:
+        # never the live ring: a capture is older than what it holds, and the
+        # running collector has its files mapped
+        ring_path = args.replay_ring_store
+        if ring_path and os.path.abspath(ring_path) == os.path.abspath(args.ring_store or ""):
+            parser.error("--replay-ring-store must not be the live --ring-store")
+    if ring_path:
+        # recent history on the Pi, readable with ring_store.py when babbage is down
+        ring = RingSink(ring_path, flush_interval=args.ring_flush_interval)
+        pipeline.add_sink("ring", ring.send, maxsize=args.queue_size, policy=args.queue_policy,
+                          tick=ring.tick, close=ring.close, **sink_metrics("ring"))
+        local_sinks.append("ring")
+    # not spooled: the collector API has no timestamp field, so replayed
+    # readings would arrive as current ones
+    add_upload_sink("iotpackets", packets_global_update_frequency,
+                    lambda point: send_to_iotpackets(point["fields"]),
+                    None, args.iotpackets_pm)
+    add_upload_sink("luftdaten", luftdaten_update_frequency,
+                    lambda point: send_to_luftdaten(point["fields"], luft_device, point["time"]),
+                    lambda points: replay_to_luftdaten(points, luft_device), args.luftdaten_pm)
+
+    sink_queued = metrics.gauge("enviropi_sink_queued", "Frames waiting in a sink's queue", ["sink"])
+    sink_delivered = metrics.counter("enviropi_sink_delivered_total", "Frames a sink handled", ["sink"])
+    sink_failed = metrics.counter("enviropi_sink_failed_total", "Frames a sink failed to deliver", ["sink"])
+    sink_dropped = metrics.counter("enviropi_sink_dropped_total", "Frames dropped from a full sink queue", ["sink"])
+    serial_frames = metrics.counter("enviropi_serial_frames_total", "Frames parsed from a board", ["board"])
+    serial_decode_failures = metrics.counter("enviropi_serial_decode_failures_total",
+                                             "Lines or binary frames from a board that could not be decoded", ["board"])
+    serial_reconnects = metrics.counter("enviropi_serial_reconnects_total", "Times a board's port was reopened", ["board"])
+    serial_downtime = metrics.counter("enviropi_serial_downtime_seconds_total",
+                                      "Time a board's port was unavailable", ["board"])
+    therm_failures = metrics.counter("enviropi_therm_failures_total", "DS18B20 reads that failed")
+    influx_written = metrics.counter("enviropi_influx_written_total", "Points written to influx")
+    influx_discarded = metrics.counter("enviropi_influx_discarded_total", "Points influx rejected or that overflowed the buffer")
+    influx_buffered = metrics.gauge("enviropi_influx_buffered", "Points waiting for the next influx batch")
+    http_retries = metrics.counter("enviropi_http_retries_total", "Upload requests retried", ["host"])
+    log_coalesced = metrics.counter("enviropi_log_coalesced_total", "Repeated log records summarised instead of written")
+    log_dropped = metrics.counter("enviropi_log_dropped_total", "Log records dropped with the log writer behind")
+
+    def collect_metrics():
+        for worker in pipeline.workers:
+            sink_queued.labels(worker.sink).set(worker.queue.qsize())
+            sink_delivered.labels(worker.sink).set(worker.delivered)
+            sink_failed.labels(worker.sink).set(worker.failed)
+            sink_dropped.labels(worker.sink).set(worker.dropped)
+        for board in boards:
+            serial_frames.labels(board.tags.get("location", board.name)).set(board.parser.frames)
+            serial_decode_failures.labels(board.tags.get("location", board.name)).set(board.parser.decode_failures)
+            serial_reconnects.labels(board.tags.get("location", board.name)).set(board.transport.reconnects)
+            serial_downtime.labels(board.tags.get("location", board.name)).set(board.transport.total_downtime)
+        if therm is not None:
+            therm_failures.set(therm.failures)
+        influx_written.set(influx_writer.written)
+        influx_discarded.set(influx_writer.discarded)
+        influx_buffered.set(len(influx_writer.lines))
+        for host, stats in http_pool.stats().items():
+            http_retries.labels(host).set(stats["retries"])
+        log_coalesced.set(log.coalesced)
+        log_dropped.set(log.dropped)
+
+    metrics.on_collect(collect_metrics)
+
+    if args.replay:
+        # offline load of a capture: influx is written directly in large batches,
+        # the live schedules and downsampling do not apply to historical frames
+        replay_sinks = [name for name in args.replay_sinks.split(",") if name]
+        for name in replay_sinks:
+            if name not in local_sinks or name == "influx":
+                parser.error("--replay-sinks: '{}' is not one of {}".format(name, ", ".join(local_sinks[1:])))
+        replay_workers = [worker for worker in pipeline.workers if worker.sink in replay_sinks]
+        for worker in replay_workers:
+            # wait for the sink rather than dropping frames, there is no hurry
+            worker.policy = BLOCK
+            worker.block_timeout = None
+            worker.start()
+        connect_influx()
+        replay_derive = None
+        if calibration is not None:
+            # the same derived fields as live frames get
+            replay_cal = calibration.for_tags(boards[0].tags)
+            replay_derive = lambda fields: derive(fields, replay_cal)
+        ingest = CaptureIngest(influx_writer, measurement, boards[0].tags, batch_size=args.replay_lines,
+                               publish=(lambda point: pipeline.publish(point, replay_sinks)) if replay_sinks else None,
+                               derive=replay_derive)
+        result = ingest.run(args.replay, args.replay_start, args.replay_interval)
+        for worker in replay_workers:
+            worker.stop()
+        if spool is not None:
+            spool.close()
+        if ack_index is not None:
+            ack_index.close()
+        print("{replay}: {frames} frames, {written} written to influx, {decode_failures} decode failures "
+              "in {seconds}s ({frames_per_second} frames/s)".format(replay=args.replay, **result))
+        return 0 if not result["abandoned"] else 1
+
+    # liveness for the systemd watchdog and the /healthz, /readyz probes
+    health = Health(pipeline, frame_timeout=args.frame_timeout, sink_timeout=args.sink_timeout)
+    metrics_server = None
+    if args.metrics_port:
+        try:
+            metrics_server = MetricsServer(metrics, args.metrics_address, args.metrics_port, health=health)
+        except OSError as e:
+            # e.g. the port is taken, collecting matters more than the metrics
+            logging.error("Cannot serve metrics on %s:%s, carrying on without them: %s",
+                          args.metrics_address, args.metrics_port, e)
         else:
-            if read_serial == "BEGIN":
-                collecting = True
-                readings = {}
-            else:
-                logging.debug("data outside of BEGIN/END: " + read_serial)
+            metrics_server.start()
+
+    pipeline.start()
+    stats_time = time.monotonic()
+    metrics_time = time.monotonic()
+    first_frame = None
+    if startup is not None:
+        startup_seconds.labels("main").set(startup)
+        logging.info("Started: %.2fs to main(), %.2fs of setup", startup, time.monotonic() - started)
+    health.ready = True
+    sd_notify("READY=1")
+    watchdog = None
+    if watchdog_interval():
+        watchdog = Watchdog(health, watchdog_interval())
+        watchdog.start()
+        logging.info("Pinging the systemd watchdog every %.1fs while healthy", watchdog.interval)
+
+    def terminate(signum, frame):
+        # plain systemctl stop sends SIGTERM, drain the same way as on Ctrl-C
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            health.beat()
+            if args.metrics_interval and time.monotonic() > metrics_time + args.metrics_interval:
+                metrics_time = time.monotonic()
+                for point in metrics.points("enviropi_internal", int(time.time())):
+                    pipeline.publish(point, ("influx",))
+            if time.monotonic() > stats_time + args.stats_interval:
+                stats_time = time.monotonic()
+                logging.info("Sink queues: %s", pipeline.stats())
+                logging.info("HTTP connections: %s", http_pool.stats())
+                logging.info("Sink schedules: %s", dict((sch.name, sch.stats()) for sch in schedules))
+                logging.info("Serial: %s", mux.stats())
+                logging.info("Token: %s", tokens.stats())
+                logging.info("Log: %s", log.stats())
+            frames = mux.poll()
+            for board, reading in frames:
+                received = time.monotonic()
+                health.frame()
+                if first_frame is None:
+                    first_frame = (startup or 0) + received - started
+                    startup_seconds.labels("first_frame").set(first_frame)
+                    logging.info("First frame %.2fs after the process started", first_frame)
+                reading.time = int(time.time())
+                if board.therm and therm is not None:
+                    real_temp = therm.latest()
+                    if real_temp is not None:
+                        reading.set("real_temp", real_temp)
+                    else:
+                        reading.set("real_temp_stale", True)
+                fields = reading.fields()
+                if calibration is not None:
+                    fields.update(derive(fields, calibration.for_tags(board.tags)))
+                point = { "measurement":measurement,
+                            "tags":board.tags,
+                            "time": reading.time,
+                            "fields":fields,
+                            "received": received
+                        }
+                logging.debug("Data received: %s", point)
+                pipeline.publish(point, None if board.upload else local_sinks)
+                frame_seconds.observe(time.monotonic() - received)
+    except KeyboardInterrupt:
+        logging.info("Interrupted")
+    finally:
+        # a second SIGTERM must not cut the drain short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        logging.info("Stopping, draining sink queues %s", pipeline.stats())
+        logging.info("HTTP connections: %s", http_pool.stats())
+        logging.info("Sink schedules: %s", dict((sch.name, sch.stats()) for sch in schedules))
+        logging.info("Serial: %s", mux.stats())
+        logging.info("Token: %s", tokens.stats())
+        sd_notify("STOPPING=1")
+        if watchdog is not None:
+            watchdog.stop()
+        mux.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if therm is not None:
+            therm.stop()
+        tokens.stop()
+        pipeline.stop()
+        if spool is not None:
+            spool.close()
+        if ack_index is not None:
+            ack_index.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
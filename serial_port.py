@@ -0,0 +1,125 @@
+## Self-healing serial transport
+# Opens the Feather's port, by path or by USB VID/PID, and when it goes away
+# (unplugged, reset, re-enumerated as another ttyACM) closes it and reopens it
+# with exponential backoff instead of spinning on SerialException.
+#
+import logging
+import time
+
+import serial
+from serial.tools import list_ports
+
+
+class SerialTransport(object):
+    """A serial port that reconnects itself and keeps outage statistics."""
+
+    def __init__(self, port='/dev/ttyACM0', baudrate=9600, vid=None, pid=None, serial_number=None,
+                 min_backoff=0.5, max_backoff=30):
+        self.port = port
+        self.baudrate = baudrate
+        self.vid = vid
+        self.pid = pid
+        self.serial_number = serial_number
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.serial = None
+        self.device = None
+        self.down_since = None
+        self.backoff = min_backoff
+        self.retry_at = 0
+        self.reconnects = 0
+        self.last_gap = None
+        self.longest_gap = 0.0
+        self.total_downtime = 0.0
+
+    def locate(self):
+        """The device to open, looked up by USB VID/PID/serial number when any are configured."""
+        if self.vid is None and self.pid is None and self.serial_number is None:
+            return self.port
+        for info in list_ports.comports():
+            if ((self.vid is None or info.vid == self.vid) and (self.pid is None or info.pid == self.pid) and
+                    (self.serial_number is None or info.serial_number == self.serial_number)):
+                return info.device
+        return None
+
+    def _attempt(self):
+        device = self.locate()
+        if device is None:
+            logging.debug("No serial device with VID:PID %s:%s serial %s", self.vid, self.pid, self.serial_number)
+            return False
+        try:
+            self.serial = serial.serial_for_url(device, self.baudrate)
+        except (serial.SerialException, OSError) as e:
+            logging.debug("Opening %s failed: %s", device, e)
+            return False
+        self.device = device
+        # the backoff is only reset once the port delivers frames, a port that
+        # opens but fails every read must not be reopened in a tight loop
+        self.retry_at = 0
+        if self.down_since is not None:
+            gap = time.monotonic() - self.down_since
+            self.down_since = None
+            self.reconnects += 1
+            self.last_gap = gap
+            self.longest_gap = max(self.longest_gap, gap)
+            self.total_downtime += gap
+            logging.info("Serial port %s reopened after %.1fs", device, gap)
+        else:
+            logging.info("Serial port %s opened", device)
+        return True
+
+    def _failed_attempt(self):
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+        if self.backoff == self.min_backoff or self.backoff >= self.max_backoff:
+            logging.warning("Serial port %s not available, retrying in %.1fs", self.device or self.port, self.backoff)
+        delay = self.backoff
+        self.retry_at = time.monotonic() + delay
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+        return delay
+
+    def poll_open(self):
+        """Make one attempt to open the port if its backoff has expired; never blocks."""
+        if self.serial is not None:
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        if self._attempt():
+            return True
+        self._failed_attempt()
+        return False
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.serial = None
+
+    def read_ready(self, parser):
+        """Feed whatever the open port has to parser, returning the readings it completed.
+
+        A failed port is closed and left for poll_open() to reopen after
+        the backoff.
+        """
+        try:
+            readings = parser.read_from(self.serial)
+        except (serial.SerialException, OSError) as e:
+            logging.warning("Serial read failed on %s, reconnecting: %s", self.device, e)
+            self.close()
+            parser.reset()
+            self._failed_attempt()
+            return []
+        if readings:
+            self.backoff = self.min_backoff
+        return readings
+
+    def stats(self):
+        return {
+            "device": self.device,
+            "reconnects": self.reconnects,
+            "last_gap": self.last_gap,
+            "longest_gap": self.longest_gap,
+            "total_downtime": self.total_downtime,
+        }
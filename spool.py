@@ -0,0 +1,182 @@
+## Store-and-forward spool for readings a sink failed to deliver
+# One append-only SQLite table (WAL mode) shared by all sinks. Each sink has
+# its own cursor recording the last entry it has delivered, and acknowledged
+# entries are only deleted in bulk every compact_interval seconds. Appends and
+# cursor moves are committed in batches, so an outage costs a handful of
+# sequential WAL writes per minute rather than one fsync per reading.
+#
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class Spool(object):
+    """Durable per-sink backlog with bounded size."""
+
+    def __init__(self, path, max_entries=200000, commit_interval=10, compact_interval=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.compact_interval = compact_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # AUTOINCREMENT so an id is never handed out again once the table has
+        # been compacted empty, which would put new entries behind the cursors
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, sink TEXT NOT NULL, payload TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cursors (sink TEXT PRIMARY KEY, position INTEGER NOT NULL)")
+        self._upgrade()
+        self.db.execute("CREATE INDEX IF NOT EXISTS spool_sink ON spool (sink, id)")
+        self.db.commit()
+        self.cursors = dict(self.db.execute("SELECT sink, position FROM cursors"))
+        self.entries = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        self.dirty = False
+        self.last_commit = time.monotonic()
+        self.last_compact = time.monotonic()
+        self.trimmed = 0
+
+    def _upgrade(self):
+        # spools written before AUTOINCREMENT reuse ids after a full drain;
+        # copy them into a new table and start its sequence past every cursor
+        sql = self.db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'spool'").fetchone()[0]
+        if "AUTOINCREMENT" in sql.upper():
+            return
+        self.db.execute("DROP INDEX IF EXISTS spool_sink")
+        self.db.execute("ALTER TABLE spool RENAME TO spool_old")
+        self.db.execute("CREATE TABLE spool (id INTEGER PRIMARY KEY AUTOINCREMENT, sink TEXT NOT NULL, payload TEXT NOT NULL)")
+        self.db.execute("INSERT INTO spool (id, sink, payload) SELECT id, sink, payload FROM spool_old")
+        self.db.execute("DROP TABLE spool_old")
+        high = self.db.execute("SELECT MAX(high) FROM (SELECT MAX(id) AS high FROM spool"
+                               " UNION ALL SELECT MAX(position) FROM cursors)").fetchone()[0] or 0
+        self.db.execute("DELETE FROM sqlite_sequence WHERE name = 'spool'")
+        self.db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('spool', ?)", (high,))
+        logging.info("Upgraded spool %s to never reuse entry ids", self.path)
+
+    def append(self, sink, payload):
+        with self.lock:
+            self.db.execute("INSERT INTO spool (sink, payload) VALUES (?, ?)", (sink, payload))
+            self.entries += 1
+            if self.entries > self.max_entries:
+                self._trim()
+            self.dirty = True
+            self._commit_if_due()
+
+    def _trim(self):
+        # drop the oldest tenth in one go rather than one row per append
+        excess = self.entries - self.max_entries + self.max_entries // 10
+        cur = self.db.execute("DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)", (excess,))
+        self.entries -= cur.rowcount
+        self.trimmed += cur.rowcount
+        logging.warning("Spool full, discarded %s oldest entries", cur.rowcount)
+
+    def peek(self, sink, limit):
+        """Return up to limit undelivered (id, payload) entries for sink, oldest first."""
+        with self.lock:
+            return self.db.execute("SELECT id, payload FROM spool WHERE sink = ? AND id > ? ORDER BY id LIMIT ?",
+                                   (sink, self.cursors.get(sink, 0), limit)).fetchall()
+
+    def ack(self, sink, position):
+        with self.lock:
+            self.cursors[sink] = position
+            self.db.execute("INSERT OR REPLACE INTO cursors (sink, position) VALUES (?, ?)", (sink, position))
+            self.dirty = True
+            self._commit_if_due()
+
+    def _commit_if_due(self):
+        now = time.monotonic()
+        if now - self.last_compact >= self.compact_interval:
+            self._compact()
+            self.last_compact = now
+        if self.dirty and now - self.last_commit >= self.commit_interval:
+            self.db.commit()
+            self.dirty = False
+            self.last_commit = now
+
+    def _compact(self):
+        for sink, position in self.cursors.items():
+            cur = self.db.execute("DELETE FROM spool WHERE sink = ? AND id <= ?", (sink, position))
+            if cur.rowcount > 0:
+                self.entries -= cur.rowcount
+                self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            self._commit_if_due()
+
+    def close(self):
+        with self.lock:
+            self._compact()
+            self.db.commit()
+            self.db.close()
+
+
+class SpooledSink(object):
+    """Wrap a sink so failed deliveries go to the spool and are replayed later.
+
+    deliver(item) is the live path and returns False on failure; it may be
+    None for sinks that call store() themselves. replay(items)
+    resends a list of spooled items, oldest first, and returns how many of
+    them were accepted. Replay is attempted every replay_interval seconds, at
+    most replay_batch items at a time, and backs off after a failed attempt.
+    If a circuit breaker is given, replay waits until it allows calls and
+    reports the outcome to it.
+    """
+
+    def __init__(self, spool, name, deliver, replay, encode=json.dumps, decode=json.loads,
+                 replay_batch=10, replay_interval=5, max_backoff=300, breaker=None):
+        self.spool = spool
+        self.name = name
+        self.deliver = deliver
+        self.replay = replay
+        self.encode = encode
+        self.decode = decode
+        self.replay_batch = replay_batch
+        self.replay_interval = replay_interval
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.backoff = replay_interval
+        self.next_replay = 0
+        self.spooled = 0
+        self.replayed = 0
+
+    def send(self, item):
+        ok = self.deliver(item)
+        if ok is False:
+            self.store(item)
+        return ok
+
+    def store(self, item):
+        self.spool.append(self.name, self.encode(item))
+        self.spooled += 1
+
+    def tick(self):
+        self.spool.flush()
+        now = time.monotonic()
+        if now < self.next_replay:
+            return
+        entries = self.spool.peek(self.name, self.replay_batch)
+        if not entries:
+            self.next_replay = now + self.replay_interval
+            return
+        if self.breaker is not None and not self.breaker.allow():
+            return
+        try:
+            done = self.replay([self.decode(payload) for (_, payload) in entries])
+        except Exception as e:
+            logging.warning("%s replay raised: %s", self.name, e)
+            done = 0
+        if self.breaker is not None:
+            self.breaker.record(done > 0)
+        if done > 0:
+            self.spool.ack(self.name, entries[done - 1][0])
+            self.replayed += done
+        if done < len(entries):
+            self.next_replay = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        else:
+            self.next_replay = now + self.replay_interval
+            self.backoff = self.replay_interval
+        logging.debug("%s replayed %s of %s spooled entries", self.name, done, len(entries))
@@ -1,9 +1,15 @@
 import time
 from w1thermsensor import  W1ThermSensor
-sensor = W1ThermSensor()
+from therm_sampler import TemperatureSampler
+
+sampler = TemperatureSampler(W1ThermSensor(), interval=1)
+sampler.start()
 
 while True:
-	temperature = sensor.get_temperature()
-	print ("The temperature is %s C" % temperature)
 	time.sleep(1);
+	temperature = sampler.latest()
+	if temperature is None:
+		print ("No recent temperature reading")
+	else:
+		print ("The temperature is %s C (conversion took %.3fs)" % (temperature, sampler.conversion_time))
  
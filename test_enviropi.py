@@ -0,0 +1,757 @@
+## Unit tests
+# python3 -m pytest -q test_enviropi.py
+#
+import ast
+import json
+import logging
+import math
+import os
+import random
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import serial_port
+from ack_index import AckIndex
+from aggregate import P2Median
+from boards import Board, BoardMux
+from capture_ingest import CaptureIngest
+from derived import Calibration, derive, derive_columns, dew_point, gas_ppm, relative_humidity
+from frame_parser import FIELDS, FrameParser, Reading
+from http_pool import HttpPool
+from influx_batch import LineEncoder
+from influx_history import pages
+from log_setup import AsyncLog, _QueueHandler
+from luftdaten_submit import Submitter, push_body, requests_for
+from metrics import Registry
+from pipeline import Pipeline
+from ring_store import HOUR, RingStore
+from scheduler import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from spool import Spool, SpooledSink
+from token_manager import TokenManager, expiry_of
+
+
+class FakeInflux(object):
+    """Answers the paging queries of pages() from a list of rows.
+
+    Rows at the same time come back in a different order on every query, as
+    Influx makes no promise about their order.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def query(self, query, epoch=None):
+        self.queries += 1
+        op, start, end, limit = re.search(r"where time (>=?) (\d+) and time < (\d+).* limit (\d+)", query).groups()
+        start, end = int(start), int(end)
+        rows = [row for row in self.rows
+                if (row["time"] >= start if op == ">=" else row["time"] > start) and row["time"] < end]
+        random.shuffle(rows)
+        rows.sort(key=lambda row: row["time"])
+        return FakeResult([dict(row) for row in rows[:int(limit)]])
+
+
+class FakeResult(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_points(self):
+        return iter(self.rows)
+
+
+def all_pages(client, start=0, end=10 ** 12, page_size=3, **kwargs):
+    return [row for page in pages(client, "environmental", start, end, page_size, **kwargs) for row in page]
+
+
+def test_pages_keeps_points_tied_at_a_page_boundary():
+    # three boards writing the same seconds, so most pages end inside a tie
+    rows = [{"time": t, "pm2": board} for t in range(1, 8) for board in range(3)]
+    for page_size in (1, 2, 3, 4, 5):
+        got = all_pages(FakeInflux(rows), page_size=page_size)
+        assert sorted((r["time"], r["pm2"]) for r in got) == sorted((r["time"], r["pm2"]) for r in rows)
+
+
+def test_pages_identical_rows_at_the_same_time_are_all_yielded():
+    rows = [{"time": 5, "pm2": 1}] * 4 + [{"time": 6, "pm2": 1}]
+    assert len(all_pages(FakeInflux(rows), page_size=2)) == 5
+
+
+def test_pages_more_tied_points_than_a_page():
+    rows = [{"time": 5, "pm2": i} for i in range(10)] + [{"time": 9, "pm2": 0}]
+    got = all_pages(FakeInflux(rows), page_size=3)
+    assert sorted(r["pm2"] for r in got if r["time"] == 5) == list(range(10))
+    assert len(got) == 11
+
+
+def test_pages_bounds():
+    rows = [{"time": t, "pm2": 0} for t in range(1, 6)]
+    assert [r["time"] for r in all_pages(FakeInflux(rows), start=1, end=5)] == [2, 3, 4]
+    assert [r["time"] for r in all_pages(FakeInflux(rows), start=1, end=5, inclusive=True)] == [1, 2, 3, 4]
+    assert all_pages(FakeInflux([])) == []
+
+
+def test_spool_replays_undelivered_items_in_order(tmp_path):
+    path = str(tmp_path / "spool.db")
+    replayed = []
+    up = [False]
+
+    def replay(items):
+        # accepts at most two per call while up
+        if not up[0]:
+            return 0
+        replayed.extend(items[:2])
+        return len(items[:2])
+
+    spool = Spool(path)
+    sink = SpooledSink(spool, "influx", lambda item: up[0], replay, replay_batch=3, replay_interval=0)
+    for i in range(5):
+        assert sink.send({"n": i}) is False
+    sink.tick()
+    assert replayed == []
+    up[0] = True
+    for _ in range(5):
+        sink.next_replay = 0
+        sink.tick()
+    assert [item["n"] for item in replayed] == [0, 1, 2, 3, 4]
+    assert sink.spooled == 5 and sink.replayed == 5
+    spool.close()
+
+    # the cursor survives a restart, nothing is replayed twice
+    spool = Spool(path)
+    sink = SpooledSink(spool, "influx", lambda item: True, replay, replay_interval=0)
+    sink.tick()
+    assert len(replayed) == 5
+    assert spool.peek("influx", 10) == []
+    spool.close()
+
+
+def test_spool_sinks_have_their_own_cursors(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"))
+    spool.append("a", "1")
+    spool.append("b", "2")
+    spool.append("a", "3")
+    entries = spool.peek("a", 10)
+    assert [payload for _, payload in entries] == ["1", "3"]
+    spool.ack("a", entries[0][0])
+    assert [payload for _, payload in spool.peek("a", 10)] == ["3"]
+    assert [payload for _, payload in spool.peek("b", 10)] == ["2"]
+    spool.close()
+
+
+def test_spool_does_not_reuse_ids_after_a_full_drain(tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = Spool(path)
+    for i in range(5):
+        spool.append("influx", str(i))
+    spool.ack("influx", spool.peek("influx", 10)[-1][0])
+    spool.close()
+
+    spool = Spool(path)
+    assert spool.entries == 0
+    spool.append("influx", "after restart")
+    assert [payload for _, payload in spool.peek("influx", 10)] == ["after restart"]
+    spool._compact()
+    assert [payload for _, payload in spool.peek("influx", 10)] == ["after restart"]
+    spool.close()
+
+
+def test_spool_upgrades_a_table_that_reuses_ids(tmp_path):
+    path = str(tmp_path / "spool.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE spool (id INTEGER PRIMARY KEY, sink TEXT NOT NULL, payload TEXT NOT NULL)")
+    db.execute("CREATE TABLE cursors (sink TEXT PRIMARY KEY, position INTEGER NOT NULL)")
+    db.execute("INSERT INTO cursors VALUES ('influx', 5)")
+    db.commit()
+    db.close()
+    spool = Spool(path)
+    spool.append("influx", "new")
+    assert [payload for _, payload in spool.peek("influx", 10)] == ["new"]
+    spool.close()
+
+
+def test_ring_store_carries_on_the_open_buckets_after_a_restart(tmp_path):
+    path = str(tmp_path / "ring")
+    hour = 1655000000 - 1655000000 % HOUR
+
+    def add(store, t, pm2):
+        store.add({"time": hour + t, "fields": {"pm2": pm2, "real_temp_stale": True}})
+
+    store = RingStore(path, raw_capacity=100, minute_capacity=100, hour_capacity=10)
+    add(store, 0, 2)
+    add(store, 5, 4)
+    add(store, 60, 10)
+    store.close()
+
+    # a restart within the same minute and hour
+    store = RingStore(path, raw_capacity=100, minute_capacity=100, hour_capacity=10)
+    add(store, 65, 20)
+    add(store, 70, 30)
+    add(store, 120, 96)
+    store.close()
+
+    store = RingStore(path, readonly=True)
+    assert store.query("pm2", HOUR, tier="1m", now=hour + 150) == ("1m", [
+        (hour, 3.0, 2.0, 4.0, 2), (hour + 60, 20.0, 10.0, 30.0, 3), (hour + 120, 96.0, 96.0, 96.0, 1)])
+    assert store.query("pm2", HOUR, tier="1h", now=hour + 150) == ("1h", [(hour, 27.0, 2.0, 96.0, 6)])
+    # the raw tier when it reaches back far enough, the coarsest tier holding data when none does
+    tier, rows = store.query("pm2", 150, now=hour + 150)
+    assert tier == "raw" and [value for _, value in rows] == [2, 4, 10, 20, 30, 96]
+    assert store.query("pm2", 3 * HOUR, now=hour + 150)[0] == "1h"
+    store.close()
+
+
+def test_ring_store_skips_readings_older_than_its_newest(tmp_path):
+    path = str(tmp_path / "ring")
+    hour = 1655000000 - 1655000000 % HOUR
+    store = RingStore(path, raw_capacity=100, minute_capacity=100, hour_capacity=10)
+    store.add({"time": hour + 60, "fields": {"pm2": 1}})
+    store.close()
+    store = RingStore(path, raw_capacity=100, minute_capacity=100, hour_capacity=10)
+    # a day old, as from a replayed capture, then live again
+    store.add({"time": hour + 60 - 86400, "fields": {"pm2": 50}})
+    store.add({"time": hour + 65, "fields": {"pm2": 3}})
+    assert store.stats()["skipped"] == 1
+    store.close()
+    store = RingStore(path, readonly=True)
+    assert store.query("pm2", 600, tier="raw", now=hour + 120) == ("raw", [(hour + 60, 1.0), (hour + 65, 3.0)])
+    assert store.query("pm2", 600, tier="1m", now=hour + 120) == ("1m", [(hour + 60, 2.0, 1.0, 3.0, 2)])
+    store.close()
+
+
+def test_ring_store_flushes_when_pending_is_full(tmp_path):
+    store = RingStore(str(tmp_path / "ring"), raw_capacity=100, minute_capacity=100, hour_capacity=10,
+                      flush_interval=3600, max_pending=10)
+    for t in range(25):
+        store.add({"time": 1655000000 + t, "fields": {"pm2": t}})
+    # without a tick(), as while a replay keeps the sink busy
+    assert len(store.rings["raw"]) == 20 and len(store.pending["raw"]) == 5
+    store.close()
+
+
+def test_pipeline_stop_drains_within_one_deadline():
+    delivered = []
+    release = threading.Event()
+    pipeline = Pipeline()
+    pipeline.add_sink("fast", delivered.append)
+    for name in ("slow1", "slow2", "slow3"):
+        pipeline.add_sink(name, lambda item: release.wait(5))
+    pipeline.start()
+    for i in range(3):
+        pipeline.publish(i)
+    started = time.monotonic()
+    pipeline.stop(timeout=0.5)
+    # the stuck sinks share the deadline rather than getting one each
+    assert time.monotonic() - started < 1.0
+    assert delivered == [0, 1, 2]
+    assert not pipeline.workers[0].is_alive() and pipeline.workers[1].is_alive()
+    release.set()
+
+
+def firmware_encoder():
+    """encode_frame() and its constants from code.py, which only imports under CircuitPython."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    wanted = ("BINARY_FIELDS", "BINARY_SYNC", "BINARY_VERSION", "crc16", "encode_frame")
+    body = [node for node in tree.body
+            if getattr(node, "name", None) in wanted or
+            (isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) in wanted)]
+    namespace = {"struct": struct}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+READINGS = {
+    "lux": 12.5, "temperature": 21.25, "humidity": 48.0, "OX": 1.125, "OX_raw": 37210,
+    "sound_level": 812.25, "num_loops": 2500, "num_idle_loops": 2480,
+    "pm1": 3, "pm2": 5, "pm10": 6, "sound_db": -32.5, "loop_jitter_ms": 7,
+}
+
+
+def test_firmware_binary_layout_matches_the_parser():
+    assert [name for name, _ in firmware_encoder()["BINARY_FIELDS"]] == list(FIELDS)
+
+
+def test_binary_frames_round_trip_between_text():
+    encode_frame = firmware_encoder()["encode_frame"]
+    frame = encode_frame(READINGS)
+    stream = b"noise\n" + frame + b"BEGIN\nlux=1.5\nEND\n" + frame
+    parser = FrameParser()
+    # fed a few bytes at a time, frames split anywhere
+    readings = []
+    for i in range(0, len(stream), 7):
+        readings.extend(parser.feed(stream[i:i + 7]))
+    assert [r.fields() for r in readings] == [READINGS, {"lux": 1.5}, READINGS]
+    assert parser.decode_failures == 0
+
+
+def test_binary_frame_with_a_bad_crc_is_dropped():
+    encode_frame = firmware_encoder()["encode_frame"]
+    frame = bytearray(encode_frame(READINGS))
+    frame[10] ^= 0xFF
+    parser = FrameParser()
+    assert parser.feed(bytes(frame) + encode_frame({"lux": 2.0}))[0].fields() == {"lux": 2.0}
+    assert parser.decode_failures == 1
+
+
+def test_circuit_breaker_opens_probes_and_backs_off():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30, max_reset_timeout=100)
+    for _ in range(2):
+        breaker.record(False)
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record(False)
+    assert breaker.state == OPEN and not breaker.allow()
+
+    breaker.open_until = 0  # the reset timeout has passed
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    breaker.record(False)
+    assert breaker.state == OPEN and breaker.timeout == 60
+    breaker.open_until = 0
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.timeout == 100
+
+    breaker.open_until = 0
+    breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CLOSED and breaker.timeout == 30 and breaker.trips == 3
+
+
+def test_p2_median_is_exact_for_five_and_close_after():
+    median = P2Median()
+    for x in (5, 1, 4, 2):
+        median.add(x)
+    assert median.value() == 3
+    median.add(3)
+    assert median.value() == 3
+    rng = random.Random(1)
+    values = [rng.gauss(20, 5) for _ in range(5000)]
+    median = P2Median()
+    for x in values:
+        median.add(x)
+    assert abs(median.value() - sorted(values)[len(values) // 2]) < 0.5
+
+
+def test_ack_index_records_seconds_per_sensor_and_pin(tmp_path):
+    index = AckIndex(str(tmp_path))
+    day = 19000 * 86400
+    index.add("raspi-1", "1", day + 86399)
+    assert index.contains("raspi-1", "1", day + 86399)
+    assert not index.contains("raspi-1", "1", day + 86398)
+    assert not index.contains("raspi-1", "11", day + 86399)
+    assert not index.contains("raspi-2", "1", day + 86399)
+    # within looks either side, across the day boundary
+    assert index.contains("raspi-1", "1", day + 86400 + 2, within=3)
+    assert not index.contains("raspi-1", "1", day + 86400 + 2, within=2)
+    index.close()
+    assert AckIndex(str(tmp_path)).contains("raspi-1", "1", day + 86399)
+
+
+def test_line_encoder_keeps_field_types():
+    point = {"measurement": "environmental", "tags": {}, "time": 1655000000,
+             "fields": {"pm2": 5, "lux": 12.5, "real_temp_stale": True, "ok": False, "note": 'say "hi" \\o/'}}
+    assert LineEncoder().encode(point) == \
+        'environmental pm2=5i,lux=12.5,real_temp_stale=true,ok=false,note="say \\"hi\\" \\\\o/" 1655000000'
+
+
+def test_line_encoder_escapes_measurement_and_tags():
+    point = {"measurement": "env data,v2", "time": 5, "fields": {"a b": 1.0},
+             "tags": {"location": "drive way", "device": "enviro+ arduino,x=1", "empty": "", "none": None}}
+    assert LineEncoder().encode(point) == \
+        "env\\ data\\,v2,device=enviro+\\ arduino\\,x\\=1,location=drive\\ way a\\ b=1.0 5"
+
+
+def test_line_encoder_leaves_out_nan_and_inf():
+    encoder = LineEncoder()
+    fields = {"a": float("nan"), "b": float("inf"), "c": -float("inf"), "d": 2.0, "e": None}
+    assert encoder.encode({"measurement": "m", "fields": fields, "time": 5}) == "m d=2.0 5"
+    assert encoder.encode({"measurement": "m", "fields": {"a": math.nan}, "time": 5}) is None
+    reading = Reading()
+    reading.set("lux", math.nan)
+    assert encoder.encode_reading(encoder.prefix("m", {}), reading, 5) is None
+    reading.set("pm2", 5)
+    assert encoder.encode_reading(encoder.prefix("m", {}), reading, 5) == "m pm2=5i 5"
+
+
+def test_encode_reading_matches_encode():
+    reading = Reading()
+    for name, value in READINGS.items():
+        reading.set(name, value)
+    reading.set("real_temp_stale", True)
+    reading.set("OX_label", "warm up")
+    tags = {"location": "drive way", "device": "enviro+ arduino"}
+    encoder = LineEncoder()
+    expected = encoder.encode({"measurement": "environmental", "tags": tags, "time": 1655000000,
+                               "fields": reading.fields()})
+    assert encoder.encode_reading(encoder.prefix("environmental", tags), reading, 1655000000) == expected
+    assert "num_loops=2500i" in expected and "lux=12.5" in expected and "real_temp_stale=true" in expected
+
+
+def test_metric_fields_keep_one_type_as_values_change():
+    registry = Registry()
+    downtime = registry.counter("enviropi_serial_downtime_seconds_total", "", labels=("board",))
+    child = downtime.labels("lounge")
+    encoder = LineEncoder()
+    lines = []
+    for value in (0, 3.2):
+        child.set(value)
+        lines.extend(encoder.encode(point) for point in registry.points("enviropi_internal", 1))
+    assert lines == ["enviropi_internal,board=lounge enviropi_serial_downtime_seconds_total=0.0 1",
+                     "enviropi_internal,board=lounge enviropi_serial_downtime_seconds_total=3.2 1"]
+
+
+class StubLuftdaten(BaseHTTPRequestHandler):
+    """Answers push-sensor-data with the statuses queued in responses, then 201."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        server = self.server
+        with server.lock:
+            server.seen.append((self.headers["X-PIN"], body["timestamp"]))
+            status, headers = server.responses.pop(0) if server.responses else (201, {})
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_submitter(responses, **kwargs):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLuftdaten)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.seen = []
+    server.responses = list(responses)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1/push-sensor-data/".format(server.server_address[1])
+    kwargs.setdefault("workers", 1)
+    submitter = Submitter(HttpPool(retries=0), "raspi-test", url=url, rate=1000, burst=10, backoff=0.01, **kwargs)
+    pauses = []
+    pause = submitter.bucket.pause
+    submitter.bucket.pause = lambda seconds: (pauses.append(seconds), pause(seconds))
+    return server, submitter, pauses
+
+
+PM = {"pm1": 3, "pm2": 5, "pm10": 6}
+
+
+def test_luftdaten_requests_split_a_reading_by_pin():
+    values = {"pm1": 3, "pm2": 5, "pm10": None, "real_temp": 17.9, "humidity": 61.2, "lux": 12.5}
+    assert requests_for(values) == [
+        ("1", [{"value_type": "P0", "value": 3}, {"value_type": "P2", "value": 5}]),
+        ("11", [{"value_type": "humidity", "value": 61.2}, {"value_type": "temperature", "value": 17.9}]),
+    ]
+    assert requests_for({"lux": 12.5}) == []
+    assert push_body([], 1655000000) == {"timestamp": "2022-06-12T02:13:20Z", "software_version": "nhorlock/enviropi",
+                                         "sensordatavalues": []}
+
+
+def test_submitter_retries_a_503_with_the_same_timestamp():
+    server, submitter, _ = stub_submitter([(503, {})])
+    assert submitter.submit_many([(PM, 1655000000)]) == [True]
+    assert server.seen == [("1", "2022-06-12T02:13:20Z")] * 2
+    assert submitter.stats()["retried"] == 1 and submitter.stats()["sent"] == 1
+    submitter.close()
+    server.shutdown()
+
+
+def test_submitter_pauses_the_bucket_on_a_429():
+    server, submitter, pauses = stub_submitter([(429, {"Retry-After": "0.2"}), (429, {})])
+    assert submitter.submit_many([(PM, 1655000000)]) == [True]
+    # Retry-After when given, the backoff for the attempt otherwise
+    assert pauses == [0.2, 0.02]
+    assert len(server.seen) == 3 and submitter.stats()["throttled"] == 2
+    submitter.close()
+    server.shutdown()
+
+
+def test_submitter_does_not_retry_a_4xx():
+    server, submitter, pauses = stub_submitter([(400, {})])
+    assert submitter.submit_many([(PM, 1655000000)]) == [False]
+    assert len(server.seen) == 1 and pauses == []
+    assert submitter.stats()["failed"] == 1 and submitter.stats()["retried"] == 0
+    submitter.close()
+    server.shutdown()
+
+
+def test_submitter_skips_what_the_ack_index_has_seen(tmp_path):
+    index = AckIndex(str(tmp_path))
+    server, submitter, _ = stub_submitter([], index=index, workers=4)
+    readings = [(dict(PM, humidity=61.2), 1655000000 + 5 * i) for i in range(3)]
+    assert submitter.submit_many(readings) == [True] * 3
+    assert len(server.seen) == 6
+    assert index.contains("raspi-test", "1", 1655000010) and index.contains("raspi-test", "11", 1655000010)
+    assert submitter.submit_many(readings) == [True] * 3
+    assert len(server.seen) == 6 and submitter.stats()["skipped"] == 6
+    submitter.close()
+    server.shutdown()
+    index.close()
+
+
+def test_token_expiry_relative_absolute_and_iso():
+    assert expiry_of({"expires_in": 30}, 1000) == 1030
+    assert expiry_of({"ttl": 2.5}, 1000) == 1002.5
+    assert expiry_of({"exp": 1655000000}, 1000) == 1655000000
+    # milliseconds since the epoch
+    assert expiry_of({"expiresAt": 1655000000500}, 1000) == 1655000000.5
+    assert expiry_of({"expiry": "2022-06-12T02:13:20.000Z"}, 1000) == 1655000000
+    assert expiry_of({"expires": "next tuesday"}, 1000) is None
+    assert expiry_of({"token": "abc"}, 1000) is None
+    assert expiry_of("abc", 1000) is None
+
+
+def test_token_margin_is_kept_below_the_lifetime(tmp_path):
+    path = str(tmp_path / "token.json")
+    assert TokenManager(path, lambda: None, lambda token: None, lifetime=10, margin=10).margin == 5
+    assert TokenManager(path, lambda: None, lambda token: None, lifetime=30, margin=5).margin == 5
+
+
+def test_token_refresh_renews_and_adopts_a_new_token(tmp_path):
+    path = str(tmp_path / "token.json")
+    renewals = ["", json.dumps({"token": "b", "expires_in": 600}), None]
+    requested = []
+
+    def request():
+        requested.append(1)
+        return json.dumps({"token": "c"})
+
+    tokens = TokenManager(path, lambda: json.dumps({"token": "a"}), lambda token: renewals.pop(0), lifetime=30)
+    assert tokens.refresh() and tokens.get() == {"token": "a"}
+    # an empty renewal keeps the token and extends it by the lifetime
+    assert tokens.refresh() and tokens.get() == {"token": "a"}
+    assert 29 < tokens.expires - time.time() <= 30
+    # a renewal carrying another token replaces it, on disk too
+    assert tokens.refresh() and tokens.get() == {"token": "b", "expires_in": 600}
+    assert 599 < tokens.expires - time.time() <= 600
+    with open(path) as f:
+        assert json.load(f) == {"token": "b", "expires_in": 600}
+    # a failed renewal falls back to requesting a new token
+    tokens.request = request
+    assert tokens.refresh() and tokens.get() == {"token": "c"} and requested == [1]
+    assert tokens.stats()["renewals"] == 2 and tokens.stats()["requests"] == 2
+
+
+def test_token_invalidate_wakes_the_renewal_thread(tmp_path):
+    issued = []
+
+    def request():
+        issued.append(1)
+        return json.dumps({"token": str(len(issued)), "expires_in": 3600})
+
+    tokens = TokenManager(str(tmp_path / "token.json"), request, lambda token: None)
+    tokens.start()
+    deadline = time.monotonic() + 5
+    while tokens.get() is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert tokens.get() == {"token": "1", "expires_in": 3600}
+    # without the wakeup the thread would sleep for most of an hour
+    tokens.invalidate()
+    while tokens.get() is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert tokens.get() == {"token": "2", "expires_in": 3600}
+    tokens.stop()
+    tokens.join(1)
+
+
+class FailingPort(object):
+    """Opens fine, says it is readable, then fails every read like an unplugged ttyACM."""
+
+    opened = []
+    in_waiting = 1
+
+    def __init__(self, url, baudrate):
+        FailingPort.opened.append(time.monotonic())
+        self.r, self.w = os.pipe()
+        os.write(self.w, b"x")
+
+    def fileno(self):
+        return self.r
+
+    def readinto(self, buf):
+        raise serial_port.serial.SerialException("device reports readiness to read but returned no data")
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+def test_serial_port_failing_every_read_is_reopened_with_backoff(monkeypatch):
+    monkeypatch.setattr(serial_port.serial, "serial_for_url", FailingPort)
+    FailingPort.opened = []
+    transport = serial_port.SerialTransport("/dev/ttyFAKE", min_backoff=0.05, max_backoff=0.2)
+    mux = BoardMux([Board(transport, {})])
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        mux.poll(timeout=0.01)
+    mux.close()
+    gaps = [b - a for a, b in zip(FailingPort.opened, FailingPort.opened[1:])]
+    # 0.05, 0.1, then 0.2 at most, rather than thousands of reopens
+    assert 3 <= len(FailingPort.opened) <= 6
+    assert all(gap >= 0.045 for gap in gaps) and gaps[1] >= 0.095
+    assert transport.backoff == 0.2
+
+
+class ListWriter(object):
+    """The parts of a BatchWriter CaptureIngest uses, keeping the lines."""
+
+    def __init__(self):
+        self.encoder = LineEncoder()
+        self.lines = []
+        self.written = 0
+
+    def write(self, lines):
+        self.lines.extend(lines)
+        self.written += len(lines)
+        return True
+
+
+def test_capture_ingest_adds_the_derived_fields(tmp_path):
+    path = str(tmp_path / "capture.txt")
+    with open(path, "w") as f:
+        f.write("BEGIN\ntemperature=20.0\nhumidity=50.0\ntime=1655000000\nEND\n")
+    writer = ListWriter()
+    cal = Calibration().for_location("driveway")
+    ingest = CaptureIngest(writer, "environmental", {"location": "driveway"}, derive=lambda fields: derive(fields, cal))
+    assert ingest.run(path)["written"] == 1
+    fields = dict(part.split("=") for part in writer.lines[0].split(" ")[1].split(","))
+    assert fields["temperature"] == "20.0" and abs(float(fields["dew_point"]) - 9.26) < 0.01
+    assert writer.lines[0].endswith(" 1655000000")
+
+
+def test_derived_formulas_at_fixed_values():
+    cal = Calibration().for_location("driveway")
+    assert abs(dew_point(20.0, 50.0) - 9.26) < 0.01
+    assert abs(relative_humidity(20.0, dew_point(20.0, 50.0)) - 50.0) < 1e-9
+    assert abs(gas_ppm(1.1, "OX", cal) - 0.21) < 0.005
+    derived = derive({"temperature": 25.0, "ucontroller_cpu_temp": 34.0, "humidity": 40.0, "OX": 1.1}, cal)
+    assert derived["temperature_compensated"] == 21.0
+    # the same dew point at the sensor and at the cooler air temperature, so a higher humidity there
+    assert abs(relative_humidity(21.0, derived["dew_point"]) - derived["humidity_compensated"]) < 1e-9
+    assert derived["humidity_compensated"] > 40.0
+    assert set(derive({"humidity": 120.0, "temperature": 20.0, "OX": 3.3}, cal)) == set()
+
+
+def test_calibration_merges_default_and_location_tables(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    with open(path, "w") as f:
+        json.dump({"default": {"temp_factor": 3.0}, "driveway": {"r0": {"OX": 23400}, "temp_offset": 0.5}}, f)
+    calibration = Calibration(path)
+    driveway = calibration.for_tags({"location": "driveway"})
+    assert driveway["temp_factor"] == 3.0 and driveway["temp_offset"] == 0.5
+    assert driveway["r0"] == {"OX": 23400, "RED": 200000.0, "NH3": 75000.0}
+    garage = calibration.for_tags({"location": "garage"})
+    assert garage["temp_factor"] == 3.0 and garage["temp_offset"] == 0.0 and garage["r0"]["OX"] == 20000.0
+    assert calibration.for_tags({}) == calibration.for_location("default")
+
+
+def test_derive_columns_matches_derive():
+    np = pytest.importorskip("numpy")
+    cal = Calibration().for_location("driveway")
+    nan = float("nan")
+    rows = [
+        {"temperature": 20.0, "humidity": 50.0, "ucontroller_cpu_temp": 30.0, "OX": 1.1, "RED": 0.8, "NH3": 0.5},
+        {"temperature": 18.0, "humidity": 60.0, "ucontroller_cpu_temp": 25.0, "real_temp": 15.5},
+        {"temperature": 20.0, "humidity": 120.0, "OX": 3.5},
+        {"temperature": 20.0, "humidity": 0.0, "ucontroller_cpu_temp": 30.0, "RED": 0.0},
+        {"humidity": 50.0},
+    ]
+    fields = ("temperature", "humidity", "ucontroller_cpu_temp", "real_temp", "OX", "RED", "NH3")
+    columns = dict((f, np.array([row.get(f, nan) for row in rows])) for f in fields)
+    derived = derive_columns(columns, cal)
+    for i, row in enumerate(rows):
+        expected = derive(row, cal)
+        for name, values in derived.items():
+            if name in expected:
+                assert abs(values[i] - expected[name]) < 1e-9, (i, name)
+            else:
+                assert np.isnan(values[i]), (i, name)
+
+
+def test_http_pool_retries_a_post_that_never_connected():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = "http://127.0.0.1:{}/".format(sock.getsockname()[1])
+    sock.close()
+    http_pool = HttpPool(retries=2, backoff=0.001)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_pool.post(url, json={"n": 1})
+    assert list(http_pool.retried.values()) == [2]
+
+
+def test_http_pool_does_not_retry_a_post_the_server_may_have_seen():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    listener.settimeout(5)
+    accepted = []
+
+    def reset_after_the_body():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            accepted.append(conn)
+            data = b""
+            while b"\r\n\r\n" not in data:
+                data += conn.recv(4096)
+            head, body = data.split(b"\r\n\r\n", 1)
+            length = int(re.search(rb"Content-Length: (\d+)", head, re.I).group(1))
+            while len(body) < length:
+                body += conn.recv(4096)
+            # close with SO_LINGER 0 so the client sees a reset
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            conn.close()
+
+    thread = threading.Thread(target=reset_after_the_body, daemon=True)
+    thread.start()
+    http_pool = HttpPool(retries=2, backoff=0.001)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_pool.post("http://127.0.0.1:{}/".format(listener.getsockname()[1]), json={"n": 1})
+    assert len(accepted) == 1 and list(http_pool.retried.values()) == [0]
+    listener.close()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelname, record.getMessage()))
+
+
+def test_async_log_coalesces_repeated_warnings():
+    handler = ListHandler()
+    log = AsyncLog(handler, coalesce_interval=60)
+    logger = logging.getLogger("test_enviropi.coalesce")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(_QueueHandler(log))
+    log.start()
+    for i in range(5):
+        logger.warning("Serial read failed on %s: %s", "/dev/ttyACM0", i)
+        logger.info("reconnecting %s", i)
+    log.stop()
+    logger.handlers = []
+    warnings = [message for level, message in handler.messages if level == "WARNING"]
+    assert warnings[0] == "Serial read failed on /dev/ttyACM0: 0"
+    assert re.match(r"Serial read failed on /dev/ttyACM0: 4 \[repeated 4 times in \d+s\]$", warnings[1])
+    assert len(warnings) == 2
+    # below the coalesce level every record is written
+    assert len([level for level, _ in handler.messages if level == "INFO"]) == 5
+    assert log.stats()["coalesced"] == 4
@@ -0,0 +1,74 @@
+## Background DS18B20 sampler
+# A 1-Wire conversion takes up to ~750ms at 12-bit resolution, so the sensor
+# is read on its own thread and frames just pick up the latest value.
+#
+import logging
+import threading
+import time
+
+
+class TemperatureSampler(threading.Thread):
+    """Poll a W1ThermSensor every interval seconds and keep the latest reading.
+
+    resolution (9-12 bits) trades accuracy for conversion time; None leaves
+    the sensor as configured. observe, if given, is called with the seconds
+    each successful get_temperature() took.
+    """
+
+    def __init__(self, sensor, interval=5, max_age=30, resolution=None, observe=None):
+        threading.Thread.__init__(self, name="therm-sampler", daemon=True)
+        self.sensor = sensor
+        self.interval = interval
+        self.max_age = max_age
+        self.resolution = resolution
+        self.observe = observe
+        self.value = None
+        self.timestamp = None
+        self.failures = 0
+        self.conversion_time = None
+        self.stopping = threading.Event()
+
+    def run(self):
+        if self.resolution is not None:
+            self.set_resolution(self.resolution)
+        while not self.stopping.is_set():
+            self.sample()
+            self.stopping.wait(self.interval)
+
+    def set_resolution(self, resolution):
+        try:
+            if hasattr(self.sensor, "set_resolution"):
+                self.sensor.set_resolution(resolution)
+            else:
+                self.sensor.set_precision(resolution)
+        except Exception as e:
+            logging.warning("Could not set DS18B20 resolution to %s bits: %s", resolution, e)
+
+    def sample(self):
+        start = time.monotonic()
+        try:
+            value = self.sensor.get_temperature()
+        except Exception as e:
+            self.failures += 1
+            logging.warning("DS18B20 read failed: %s", e)
+            return
+        self.conversion_time = time.monotonic() - start
+        if self.observe is not None:
+            self.observe(self.conversion_time)
+        self.value = value
+        self.timestamp = time.monotonic()
+
+    def age(self):
+        if self.timestamp is None:
+            return None
+        return time.monotonic() - self.timestamp
+
+    def latest(self):
+        """The last temperature, or None if there is none younger than max_age."""
+        age = self.age()
+        if age is None or age > self.max_age:
+            return None
+        return self.value
+
+    def stop(self):
+        self.stopping.set()
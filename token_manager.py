@@ -0,0 +1,195 @@
+## iot.packets.global token cache
+# Keeps the current token in memory for the send path and renews it on a
+# background thread shortly before it expires, so a sensor upload never waits
+# on a token request or renewal. The token file is replaced atomically so a
+# power cut mid-write cannot leave a truncated token behind.
+#
+import calendar
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+# keys the server may use to say when a token expires
+EXPIRES_IN_KEYS = ("expires_in", "expiresIn", "ttl")
+EXPIRES_AT_KEYS = ("expires_at", "expiresAt", "expires", "expiry", "exp")
+
+
+def expiry_of(data, received):
+    """The wall clock expiry of a token response, or None if it does not say.
+
+    received is the wall clock time the response arrived.
+    """
+    if not isinstance(data, dict):
+        return None
+    for key in EXPIRES_IN_KEYS:
+        if isinstance(data.get(key), (int, float)):
+            return received + data[key]
+    for key in EXPIRES_AT_KEYS:
+        value = data.get(key)
+        if isinstance(value, (int, float)):
+            # milliseconds since the epoch from JavaScript servers
+            return value / 1000.0 if value > 1e11 else value
+        if isinstance(value, str):
+            try:
+                return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+            except ValueError:
+                pass
+    return None
+
+
+def write_atomic(path, text, mode=0o600):
+    """Replace path with text so readers see either the old or the new file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class TokenManager(threading.Thread):
+    """Hold a token and keep it fresh in the background.
+
+    request() must return the response text of a new token or None, and
+    renew(token) the response text of a successful renewal (possibly empty)
+    or None. lifetime is assumed when the server does not send an expiry;
+    the token is renewed margin seconds before it expires.
+    """
+
+    def __init__(self, path, request, renew, lifetime=30, margin=5, max_backoff=300):
+        threading.Thread.__init__(self, name="token-manager", daemon=True)
+        self.path = path
+        self.request = request
+        self.renew = renew
+        self.lifetime = lifetime
+        if margin >= lifetime:
+            # renewing margin seconds early would then mean renewing continuously
+            logging.warning("Token margin %ss is not less than the lifetime %ss, using %ss",
+                            margin, lifetime, lifetime / 2.0)
+            margin = lifetime / 2.0
+        self.margin = margin
+        self.max_backoff = max_backoff
+        self.token = None
+        self.expires = 0
+        self.backoff = 1
+        self.requests = 0
+        self.renewals = 0
+        self.failures = 0
+        self.invalidated = 0
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.load()
+
+    def load(self):
+        """Pick up the token saved by a previous run, if it can still be used."""
+        try:
+            with open(self.path, "r") as f:
+                text = f.read()
+            saved = os.path.getmtime(self.path)
+            token = json.loads(text)
+        except (OSError, ValueError) as e:
+            logging.info("No usable token in %s: %s", self.path, e)
+            return
+        expires = expiry_of(token, saved) or saved + self.lifetime
+        if expires > time.time():
+            self.token = token
+            self.expires = expires
+            logging.info("Token loaded from %s, expires in %.0fs", self.path, expires - time.time())
+
+    def get(self):
+        """The current token, or None while there is no valid one. Never blocks."""
+        if self.token is None or time.time() >= self.expires:
+            return None
+        return self.token
+
+    def invalidate(self):
+        """The server rejected the token (401): drop it and request a new one now."""
+        self.invalidated += 1
+        self.token = None
+        self.expires = 0
+        self.wakeup.set()
+
+    def _adopt(self, text, received):
+        token = json.loads(text)
+        write_atomic(self.path, text)
+        self.expires = expiry_of(token, received) or received + self.lifetime
+        self.token = token
+        logging.debug("Token written to %s, expires in %.0fs", self.path, self.expires - time.time())
+
+    def refresh(self):
+        """Renew the token, or request a new one if there is none; True on success."""
+        received = time.time()
+        try:
+            if self.token is not None:
+                text = self.renew(self.token)
+                if text is not None:
+                    self.renewals += 1
+                    try:
+                        data = json.loads(text) if text else None
+                    except ValueError:
+                        data = None
+                    if isinstance(data, dict) and "token" in data and data != self.token:
+                        # the server handed out a new token with the renewal
+                        self._adopt(text, received)
+                    else:
+                        self.expires = expiry_of(data, received) or received + self.lifetime
+                    return True
+                logging.info("Token renewal failed, requesting a new token")
+            text = self.request()
+            if text is None:
+                return False
+            self.requests += 1
+            self._adopt(text, received)
+            return True
+        except Exception as e:
+            logging.warning("Token refresh failed: %s", e)
+            return False
+
+    def run(self):
+        while not self.stopping.is_set():
+            if self.token is None or time.time() >= self.expires - self.margin:
+                if self.refresh():
+                    self.backoff = 1
+                else:
+                    self.failures += 1
+                    if self.token is not None and time.time() >= self.expires:
+                        self.token = None
+                    delay = random.uniform(0, self.backoff)
+                    self.backoff = min(self.backoff * 2, self.max_backoff)
+                    self.wakeup.wait(delay)
+                    self.wakeup.clear()
+                    continue
+            self.wakeup.wait(max(0.1, self.expires - self.margin - time.time()))
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def stats(self):
+        return {
+            "valid": self.get() is not None,
+            "expires_in": round(self.expires - time.time(), 1) if self.token is not None else None,
+            "requests": self.requests,
+            "renewals": self.renewals,
+            "failures": self.failures,
+            "invalidated": self.invalidated,
+        }